@@ -0,0 +1,58 @@
+"""
+Ad hoc benchmarks for the persistent_messages app.
+
+These are not part of the test suite. Each module is a script that runs
+against a throwaway in-memory SQLite database using the test settings,
+and can be run from the project root, e.g.:
+
+    python -m benchmarks.group_cache
+
+"""
+
+from __future__ import annotations
+
+import os
+import statistics
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+
+def setup_django() -> None:
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+    import django
+
+    django.setup()
+
+
+@contextmanager
+def test_database() -> Iterator[None]:
+    """Create (and destroy) a test database for the duration of the block."""
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def timeit(func: Callable[[], object], repeat: int = 5, number: int = 100) -> float:
+    """Return the median time (in ms) of a single call to func."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return statistics.median(timings) * 1000
+
+
+def report(label: str, ms: float, baseline: float | None = None) -> None:
+    line = f"{label:<40} {ms:>8.3f} ms"
+    if baseline:
+        line += f"  ({baseline / ms:.2f}x)"
+    print(line)  # noqa: T201
@@ -0,0 +1,72 @@
+"""
+Compare filter_user with and without PERSISTENT_MESSAGES_COMPILED_AUDIENCES.
+
+Builds a handful of messages each targeting a large number of users
+directly (via target_users), then times resolving the messages for a
+sample of users, and reports the memory used by the compiled audiences
+compared with the same ids held in a Python set.
+
+"""
+
+from __future__ import annotations
+
+import random
+import sys
+
+from . import report, setup_django, test_database, timeit
+
+USERS = 100_000
+MESSAGES = 10
+TARGETS_PER_MESSAGE = 50_000
+SAMPLE = 200
+
+
+def seed() -> list:
+    from django.contrib.auth.models import User
+
+    from persistent_messages.models import PersistentMessage
+
+    rng = random.Random(42)  # noqa: S311
+    User.objects.bulk_create(
+        (User(username=f"user{i}") for i in range(USERS)), batch_size=5000
+    )
+    user_ids = list(User.objects.values_list("id", flat=True))
+    for i in range(MESSAGES):
+        PersistentMessage.objects.create_for_users(
+            rng.sample(user_ids, TARGETS_PER_MESSAGE), content=f"Message {i}"
+        )
+    return list(User.objects.filter(id__in=rng.sample(user_ids, SAMPLE)))
+
+
+def main() -> None:
+    setup_django()
+    from django.test import override_settings
+
+    from persistent_messages.audience import audiences
+    from persistent_messages.models import PersistentMessage
+
+    with test_database():
+        users = seed()
+
+        def resolve() -> None:
+            for user in users:
+                list(PersistentMessage.objects.filter_user(user))
+
+        rows = MESSAGES * TARGETS_PER_MESSAGE
+        print(f"filter_user x {SAMPLE} users, {rows} target_users rows")  # noqa: T201
+        baseline = timeit(resolve, repeat=5, number=1)
+        report("target_users subquery", baseline)
+        with override_settings(PERSISTENT_MESSAGES_COMPILED_AUDIENCES=True):
+            resolve()  # compile the audiences
+            report("compiled audiences", timeit(resolve, repeat=5, number=1), baseline)
+            compiled = sum(a.nbytes for a in audiences.audiences.values())
+            as_sets = sum(
+                sys.getsizeof(ids) + sum(sys.getsizeof(i) for i in ids)
+                for ids in (set(a.user_ids) for a in audiences.audiences.values())
+            )
+        print(f"{'compiled audiences memory':<40} {compiled / 2**20:>8.1f} MB")  # noqa: T201
+        print(f"{'as Python sets':<40} {as_sets / 2**20:>8.1f} MB")  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compare filter_user with and without PERSISTENT_MESSAGES_CACHE_GROUP_IDS.
+
+Builds a large auth_user_groups table (every user is a member of many
+groups) and a handful of group-targeted messages, then times resolving
+the messages for a sample of users.
+
+"""
+
+from __future__ import annotations
+
+import random
+
+from . import report, setup_django, test_database, timeit
+
+USERS = 5000
+GROUPS = 500
+GROUPS_PER_USER = 20
+MESSAGES = 50
+SAMPLE = 200
+
+
+def seed() -> list:
+    from django.contrib.auth.models import Group, User
+
+    from persistent_messages.models import PersistentMessage
+
+    rng = random.Random(42)  # noqa: S311
+    User.objects.bulk_create(User(username=f"user{i}") for i in range(USERS))
+    Group.objects.bulk_create(Group(name=f"group{i}") for i in range(GROUPS))
+    user_ids = list(User.objects.values_list("id", flat=True))
+    group_ids = list(Group.objects.values_list("id", flat=True))
+    through = User.groups.through
+    through.objects.bulk_create(
+        (
+            through(user_id=user_id, group_id=group_id)
+            for user_id in user_ids
+            for group_id in rng.sample(group_ids, GROUPS_PER_USER)
+        ),
+        batch_size=5000,
+    )
+    for i in range(MESSAGES):
+        pm = PersistentMessage.objects.create(
+            content=f"Message {i}",
+            target=PersistentMessage.TargetType.USERS_OR_GROUPS,
+        )
+        pm.target_groups.add(*rng.sample(group_ids, 5))
+    return list(User.objects.filter(id__in=rng.sample(user_ids, SAMPLE)))
+
+
+def main() -> None:
+    setup_django()
+    from django.test import override_settings
+
+    from persistent_messages.models import PersistentMessage
+
+    with test_database():
+        users = seed()
+
+        def resolve() -> None:
+            for user in users:
+                list(PersistentMessage.objects.filter_user(user))
+
+        memberships = USERS * GROUPS_PER_USER
+        print(f"filter_user x {SAMPLE} users, {memberships} memberships")  # noqa: T201
+        baseline = timeit(resolve, repeat=5, number=1)
+        report("group subquery", baseline)
+        with override_settings(PERSISTENT_MESSAGES_CACHE_GROUP_IDS=True):
+            resolve()  # warm the cache
+            report("cached group ids", timeit(resolve, repeat=5, number=1), baseline)
+
+
+if __name__ == "__main__":
+    main()
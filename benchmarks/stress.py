@@ -0,0 +1,193 @@
+"""
+Concurrency stress harness for message resolution and dismissal.
+
+Simulates a mix of page views (resolving and rendering messages via the
+context processors and template tag) and dismissals (DELETE requests to
+the dismiss_message view, through the full middleware stack using the
+Django test client) from a pool of threads, against a file-backed SQLite
+database - so that SQLite locking behaves as it would in production.
+
+    python -m benchmarks.stress --threads 8 --requests 2000 --dismiss-ratio 0.2
+
+Reports throughput, latency percentiles and errors for each operation.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from . import setup_django, test_database
+
+
+def percentile(timings: list[float], pct: int) -> float:
+    if len(timings) < 2:
+        return timings[0] if timings else 0.0
+    return statistics.quantiles(timings, n=100, method="inclusive")[pct - 1]
+
+
+class Results:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.timings: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, Counter] = defaultdict(Counter)
+
+    def record(self, op: str, ms: float, error: str | None = None) -> None:
+        with self.lock:
+            self.timings[op].append(ms)
+            if error:
+                self.errors[op][error] += 1
+
+    def report(self, elapsed: float) -> None:
+        total = sum(len(t) for t in self.timings.values())
+        rate = total / elapsed
+        print(f"{total} requests in {elapsed:.2f}s ({rate:.1f} req/s)")  # noqa: T201
+        columns = ("count", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms")
+        print(f"{'op':<10}" + "".join(f"{c:>9}" for c in columns))  # noqa: T201
+        for op, timings in sorted(self.timings.items()):
+            print(  # noqa: T201
+                f"{op:<10}{len(timings):>9}{sum(self.errors[op].values()):>9}"
+                f"{percentile(timings, 50):>9.2f}{percentile(timings, 95):>9.2f}"
+                f"{percentile(timings, 99):>9.2f}{max(timings):>9.2f}"
+            )
+        for op, errors in sorted(self.errors.items()):
+            for error, count in errors.most_common():
+                print(f"  {op}: {count} x {error}")  # noqa: T201
+
+
+def seed(users: int, messages: int) -> tuple[list, list]:
+    from django.contrib.auth.models import User
+
+    from persistent_messages.models import PersistentMessage
+
+    User.objects.bulk_create(User(username=f"user{i}") for i in range(users))
+    for i in range(messages):
+        PersistentMessage.objects.create(
+            content=f"Message {i}", target=PersistentMessage.TargetType.ALL_USERS
+        )
+    return (
+        list(User.objects.all()),
+        list(PersistentMessage.objects.values_list("id", flat=True)),
+    )
+
+
+def make_ops(users: list, message_ids: list) -> dict[str, Callable[[], None]]:
+    from django.template import Context, Template
+    from django.test import Client, RequestFactory
+
+    from persistent_messages.context_processors import (
+        all_messages,
+        persistent_messages as persistent_messages_cp,
+    )
+
+    template = Template("{% load persistent_message_tags %}{% persistent_messages %}")
+    factory = RequestFactory()
+    local = threading.local()
+
+    def page_view() -> None:
+        request = factory.get("/")
+        request.user = random.choice(users)  # noqa: S311
+        request._messages = []
+        persistent_messages_cp(request)["persistent_messages"]()
+        all_messages(request)["all_messages"]()
+        template.render(Context({"request": request}))
+
+    def dismiss() -> None:
+        if not hasattr(local, "clients"):
+            local.clients = {}
+        user = random.choice(users)  # noqa: S311
+        if (client := local.clients.get(user.pk)) is None:
+            client = Client()
+            client.force_login(user)
+            local.clients[user.pk] = client
+        message_id = random.choice(message_ids)  # noqa: S311
+        response = client.delete(f"/alerts/dismiss/{message_id}/")
+        if response.status_code != 204:
+            raise Exception(f"HTTP {response.status_code}")
+
+    return {"view": page_view, "dismiss": dismiss}
+
+
+def run(args: argparse.Namespace) -> None:
+    from django.db import connection
+
+    users, message_ids = seed(args.users, args.messages)
+    ops = make_ops(users, message_ids)
+    results = Results()
+
+    def worker(op: str) -> None:
+        start = time.perf_counter()
+        error = None
+        try:
+            ops[op]()
+        except Exception as ex:  # noqa: BLE001
+            error = f"{type(ex).__name__}: {ex}"
+        finally:
+            connection.close()
+        results.record(op, (time.perf_counter() - start) * 1000, error)
+
+    rng = random.Random(args.seed)  # noqa: S311
+    plan = [
+        "dismiss" if rng.random() < args.dismiss_ratio else "view"
+        for _ in range(args.requests)
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(worker, plan))
+    results.report(time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--dismiss-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--sqlite-timeout",
+        type=float,
+        default=5,
+        help="Seconds SQLite waits for a lock before raising 'database is locked'.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Disable the fragment cache used by the persistent_messages tag.",
+    )
+    args = parser.parse_args()
+
+    setup_django()
+    from django.db import connections
+    from django.test import override_settings
+
+    # errors are counted and reported below, so silence the request logging
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # NB this must happen before the first database connection is made
+        settings_dict = connections["default"].settings_dict
+        settings_dict["TEST"]["NAME"] = os.path.join(tmpdir, "stress.db")
+        settings_dict["OPTIONS"]["timeout"] = args.sqlite_timeout
+        timeout = 0 if args.no_cache else 300
+        with override_settings(
+            PERSISTENT_MESSAGES_FRAGMENT_CACHE_TIMEOUT=timeout,
+            ALLOWED_HOSTS=["testserver"],
+            # keep session writes out of the database under test
+            SESSION_ENGINE="django.contrib.sessions.backends.signed_cookies",
+        ), test_database():
+            run(args)
+
+
+if __name__ == "__main__":
+    main()
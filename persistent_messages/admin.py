@@ -1,17 +1,31 @@
 from django.contrib import admin
-from django.db.models import QuerySet
+from django.db.models import QuerySet, Sum
 from django.http import HttpRequest
 from django.utils.safestring import mark_safe
 
-from .models import MessageDismissal, PersistentMessage
+from .models import (
+    MessageDismissal,
+    MessageImpressions,
+    PersistentMessage,
+    RecurringWindow,
+)
+from .sketch import HyperLogLog
+
+
+class RecurringWindowInline(admin.TabularInline):
+    model = RecurringWindow
+    extra = 0
 
 
 @admin.register(PersistentMessage)
 class PersistentMessageAdmin(admin.ModelAdmin):
+    inlines = (RecurringWindowInline,)
     list_display = (
         "content",
         "target",
         "level_tag",
+        "priority",
+        "rollout_percentage",
         "display_from",
         "display_until",
         "_is_active",
@@ -23,12 +37,20 @@ class PersistentMessageAdmin(admin.ModelAdmin):
         "_tags",
         "_message",
         "_dissmissed_by_count",
+        "_impressions",
+        "_unique_viewers",
         "created_at",
         "updated_at",
     )
     search_fields = ("content",)
     actions = ("deactivate_messages", "reactivate_messages")
-    list_filter = ("level", "target", "is_dismissable", "mark_content_safe")
+    list_filter = (
+        "level",
+        "target",
+        "is_dismissable",
+        "mark_content_safe",
+        "is_template",
+    )
 
     @admin.display(boolean=True)
     def _is_active(self, obj: PersistentMessage) -> bool:
@@ -54,6 +76,17 @@ class PersistentMessageAdmin(admin.ModelAdmin):
     def _dissmissed_by_count(self, obj: PersistentMessage) -> str:
         return obj.dismissed_by.count()
 
+    @admin.display(description="Impressions")
+    def _impressions(self, obj: PersistentMessage) -> int:
+        return obj.impressions.aggregate(total=Sum("count"))["total"] or 0
+
+    @admin.display(description="Unique viewers (estimate)")
+    def _unique_viewers(self, obj: PersistentMessage) -> int:
+        viewers = HyperLogLog()
+        for impressions in obj.impressions.all():
+            viewers.merge(impressions.viewers_sketch)
+        return viewers.count()
+
     @admin.action(description="Deactivate selected persistent messages")
     def deactivate_messages(
         self, request: HttpRequest, queryset: QuerySet[PersistentMessage]
@@ -84,3 +117,16 @@ class MessageDismissalAdmin(admin.ModelAdmin):
         "user__last_name",
     )
     list_filter = ("message__target", "dismissed_at")
+
+
+@admin.register(MessageImpressions)
+class MessageImpressionsAdmin(admin.ModelAdmin):
+    list_display = ("message", "bucket_start", "count", "_unique_viewers")
+    list_filter = ("bucket_start",)
+    raw_id_fields = ("message",)
+    readonly_fields = ("_unique_viewers",)
+    exclude = ("viewers",)
+
+    @admin.display(description="Unique viewers (estimate)")
+    def _unique_viewers(self, obj: MessageImpressions) -> int:
+        return obj.viewers_sketch.count()
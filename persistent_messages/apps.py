@@ -5,3 +5,16 @@ class PersistentMessageConfig(AppConfig):
     name = "persistent_messages"
     verbose_name = "Persistent messages"
     default_auto_field = "django.db.models.BigAutoField"
+
+    def ready(self) -> None:
+        from .conf import get_setting
+        from .signals import connect_signals
+        from .sources import get_sources
+
+        connect_signals()
+        # parse any static messages up front, so errors surface on startup
+        get_sources()
+        if get_setting("WARM_UP_ON_STARTUP"):
+            from .warmup import warm_up
+
+            warm_up()
@@ -0,0 +1,257 @@
+"""
+Compiled in-memory audiences for messages targeted at users or groups.
+
+Messages that target a very large number of users via `target_users`
+make every `filter_user` call join a very large through table. If
+PERSISTENT_MESSAGES_COMPILED_AUDIENCES is set, each process instead
+compiles the audience of each USERS_OR_GROUPS message on first use - a
+sorted array of the target user ids (8 bytes per user) and the set of
+target group ids - and tests membership in memory, using a binary
+search, in O(log n).
+
+Audiences are kept up to date as follows:
+
+* Changes made via the M2M managers (`target_users.add()` etc.) fire
+  `m2m_changed`, which applies the change to the local audience (if
+  compiled) and bumps a per-message audience version in the cache.
+* Other processes compare their compiled versions with the cache
+  whenever the message version changes, and recompile those that are
+  out of date.
+* Bulk updates that bypass the signals (e.g. `add_target_users`) call
+  `audiences.invalidate()` explicitly.
+
+"""
+
+from __future__ import annotations
+
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Callable, Collection, Iterable
+
+from django.db import transaction
+from django.utils.timezone import now as tz_now
+
+from .cache import (
+    bump_audience_version,
+    get_audience_version,
+    get_audience_versions,
+    get_message_version,
+)
+from .conf import get_setting
+
+# above this many changes an audience is rebuilt rather than patched
+MAX_INCREMENTAL_CHANGES = 100
+
+
+def _contains(values: array, value: int) -> bool:
+    i = bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+
+class Audience:
+    """The compiled target users and groups of a single message."""
+
+    __slots__ = ("user_ids", "group_ids", "version")
+
+    def __init__(
+        self, user_ids: Iterable[int], group_ids: Iterable[int], version: int
+    ) -> None:
+        self.user_ids = array("q", sorted(set(user_ids)))
+        self.group_ids = frozenset(group_ids)
+        self.version = version
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Return the (approximate) memory used by the user ids."""
+        return self.user_ids.itemsize * len(self.user_ids)
+
+    def has_user(self, user_id: int) -> bool:
+        return _contains(self.user_ids, user_id)
+
+    def includes(self, user_id: int, group_ids: Iterable[int]) -> bool:
+        """Return True if the user is targeted directly or via a group."""
+        return self.has_user(user_id) or not self.group_ids.isdisjoint(group_ids)
+
+    def update_users(self, add: Collection[int], remove: Collection[int]) -> None:
+        """Add / remove target user ids."""
+        if len(add) + len(remove) > MAX_INCREMENTAL_CHANGES:
+            updated = set(self.user_ids).union(add).difference(remove)
+            self.user_ids = array("q", sorted(updated))
+            return
+        # patch a copy, so that concurrent readers never see a partial update
+        user_ids = array("q", self.user_ids)
+        for user_id in add:
+            i = bisect_left(user_ids, user_id)
+            if i == len(user_ids) or user_ids[i] != user_id:
+                user_ids.insert(i, user_id)
+        for user_id in remove:
+            i = bisect_left(user_ids, user_id)
+            if i < len(user_ids) and user_ids[i] == user_id:
+                del user_ids[i]
+        self.user_ids = user_ids
+
+    def update_groups(self, add: Collection[int], remove: Collection[int]) -> None:
+        """Add / remove target group ids."""
+        self.group_ids = self.group_ids.union(add).difference(remove)
+
+
+def compile_audience(message_id: int) -> Audience:
+    """Build the audience of a message from the M2M tables."""
+    from .models import PersistentMessage, _m2m_attnames
+
+    # read the version first, so that any change made while the audience
+    # is being built will cause it to be recompiled.
+    version = get_audience_version(message_id)
+    audience = []
+    for field in (
+        PersistentMessage.target_users.field,
+        PersistentMessage.target_groups.field,
+    ):
+        message_attname, target_attname = _m2m_attnames(field)
+        audience.append(
+            field.remote_field.through.objects.filter(
+                **{message_attname: message_id}
+            ).values_list(target_attname, flat=True)
+        )
+    user_ids, group_ids = audience
+    return Audience(user_ids, group_ids, version)
+
+
+class AudienceIndex:
+    """Process-local index of compiled audiences, keyed by message id."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.audiences: dict[int, Audience] = {}
+        # ids of the (unexpired) USERS_OR_GROUPS messages
+        self.message_ids: frozenset[int] = frozenset()
+        self.message_version: int | None = None
+
+    def clear(self) -> None:
+        with self.lock:
+            self.audiences = {}
+            self.message_ids = frozenset()
+            self.message_version = None
+
+    def sync(self) -> None:
+        """
+        Reload the targeted message ids, and drop any stale audiences.
+
+        This is only done when the message version changes, so costs
+        a single query (and cache read) per change rather than per call.
+
+        """
+        if (version := get_message_version()) == self.message_version:
+            return
+        from .models import PersistentMessage
+
+        message_ids = frozenset(
+            PersistentMessage.objects.filter(
+                target=PersistentMessage.TargetType.USERS_OR_GROUPS
+            )
+            .exclude(display_until__lt=tz_now())
+            .values_list("id", flat=True)
+        )
+        with self.lock:
+            audiences = {k: v for k, v in self.audiences.items() if k in message_ids}
+            versions = get_audience_versions(audiences)
+            self.audiences = {
+                k: v for k, v in audiences.items() if v.version == versions[k]
+            }
+            self.message_ids = message_ids
+            self.message_version = version
+
+    def get(self, message_id: int) -> Audience:
+        """Return the compiled audience for a message, compiling it if required."""
+        if (audience := self.audiences.get(message_id)) is None:
+            audience = self.audiences[message_id] = compile_audience(message_id)
+        return audience
+
+    def compile_all(self) -> int:
+        """Compile the audiences of all targeted messages, returning the count."""
+        self.sync()
+        for message_id in self.message_ids:
+            self.get(message_id)
+        return len(self.message_ids)
+
+    def matching(
+        self, user_id: int, get_group_ids: Callable[[], Iterable[int]]
+    ) -> list[int]:
+        """
+        Return the ids of the USERS_OR_GROUPS messages that target the user.
+
+        The user's group ids are only fetched (using `get_group_ids`)
+        if any of the messages target groups. NB this includes messages
+        that are not yet, or no longer, active.
+
+        """
+        self.sync()
+        matching = []
+        group_ids: set[int] | None = None
+        for message_id in self.message_ids:
+            audience = self.get(message_id)
+            if audience.has_user(user_id):
+                matching.append(message_id)
+            elif audience.group_ids:
+                if group_ids is None:
+                    group_ids = set(get_group_ids())
+                if not audience.group_ids.isdisjoint(group_ids):
+                    matching.append(message_id)
+        return matching
+
+    def _apply(
+        self,
+        message_id: int,
+        users: tuple[Collection[int], Collection[int]] | None,
+        groups: tuple[Collection[int], Collection[int]] | None,
+    ) -> None:
+        version = bump_audience_version(message_id)
+        with self.lock:
+            audience = self.audiences.pop(message_id, None)
+            # only patch the audience if nothing else has changed it since
+            # it was compiled - otherwise it is recompiled on next use.
+            if audience is None or audience.version != version - 1:
+                return
+            if users:
+                audience.update_users(*users)
+            if groups:
+                audience.update_groups(*groups)
+            audience.version = version
+            self.audiences[message_id] = audience
+
+    def update(
+        self,
+        message_id: int,
+        users: tuple[Collection[int], Collection[int]] | None = None,
+        groups: tuple[Collection[int], Collection[int]] | None = None,
+    ) -> None:
+        """
+        Apply (added, removed) target users / groups to a message's audience.
+
+        If called inside a transaction the change is applied once it
+        commits (and discarded if it is rolled back).
+
+        """
+        if not get_setting("COMPILED_AUDIENCES"):
+            return
+        transaction.on_commit(lambda: self._apply(message_id, users, groups))
+
+    def invalidate(self, message_ids: Iterable[int]) -> None:
+        """Force the audiences of the given messages to be recompiled."""
+        if not get_setting("COMPILED_AUDIENCES"):
+            return
+        message_ids = list(message_ids)
+
+        def _invalidate() -> None:
+            for message_id in message_ids:
+                bump_audience_version(message_id)
+                self.audiences.pop(message_id, None)
+
+        transaction.on_commit(_invalidate)
+
+
+audiences = AudienceIndex()
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import math
+import time
+from typing import Iterable
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import BaseCache, caches
+from django.db import transaction
+from django.utils.timezone import now as tz_now
+
+from .conf import get_setting
+
+GROUP_IDS_KEY = "persistent_messages:group_ids:{user_id}"
+MESSAGE_VERSION_KEY = "persistent_messages:version"
+USER_VERSION_KEY = "persistent_messages:user_version:{user_id}"
+ACTIVE_SIGNATURE_KEY = "persistent_messages:active_signature:{version}"
+AUDIENCE_VERSION_KEY = "persistent_messages:audience_version:{message_id}"
+
+
+def get_cache() -> BaseCache:
+    """Return the cache configured by PERSISTENT_MESSAGES_CACHE."""
+    return caches[get_setting("CACHE")]
+
+
+def get_user_group_ids(user: settings.AUTH_USER_MODEL) -> list[int]:
+    """
+    Return the ids of the groups the user belongs to.
+
+    If PERSISTENT_MESSAGES_CACHE_GROUP_IDS is set the ids are cached
+    on first use, and invalidated whenever the user's groups change
+    (see signals.py). This function is public so that custom group
+    predicates can share the cached ids rather than re-querying.
+
+    """
+    if not get_setting("CACHE_GROUP_IDS"):
+        return list(user.groups.values_list("id", flat=True))
+    cache = get_cache()
+    key = GROUP_IDS_KEY.format(user_id=user.pk)
+    group_ids = cache.get(key)
+    if group_ids is None:
+        group_ids = list(user.groups.values_list("id", flat=True))
+        cache.set(key, group_ids, get_setting("GROUP_IDS_TIMEOUT"))
+    return group_ids
+
+
+def clear_user_group_ids(user_ids: Iterable[int]) -> None:
+    """Invalidate the cached group ids for the given users."""
+    get_cache().delete_many([GROUP_IDS_KEY.format(user_id=pk) for pk in user_ids])
+
+
+def _get_version(key: str) -> int:
+    # seed missing versions with the current time so that a version that
+    # has been evicted from the cache is never reused.
+    return get_cache().get_or_set(key, time.time_ns, None)
+
+
+def _bump_version(key: str) -> int:
+    cache = get_cache()
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # key has expired or been evicted - start again from a new seed
+        version = time.time_ns()
+        cache.set(key, version, None)
+        return version
+
+
+class _LocalVersion:
+    """Process-local copy of the message version, and when it was last read."""
+
+    value: int | None = None
+    checked_at: float = 0.0
+
+
+_local_version = _LocalVersion()
+
+
+def _read_message_version() -> int:
+    if get_setting("VERSION_BACKEND") == "database":
+        from .models import MessageGeneration
+
+        return MessageGeneration.objects.get_value()
+    return _get_version(MESSAGE_VERSION_KEY)
+
+
+def _bump_shared_message_version() -> None:
+    if get_setting("VERSION_BACKEND") == "database":
+        from .models import MessageGeneration
+
+        MessageGeneration.objects.increment()
+    else:
+        _bump_version(MESSAGE_VERSION_KEY)
+    # always re-read on the next check, so this process sees its own writes
+    _local_version.value = None
+
+
+def get_message_version() -> int:
+    """
+    Return the current version ("generation") of the global message set.
+
+    The version is shared across processes, stored either in the cache
+    (the default) or, if PERSISTENT_MESSAGES_VERSION_BACKEND is set to
+    "database", in the MessageGeneration table. All of the app caches
+    that depend on the set of messages are keyed off it.
+
+    To keep the check cheap, each process re-reads the shared value at
+    most once every PERSISTENT_MESSAGES_VERSION_CHECK_INTERVAL
+    milliseconds, so changes made in another process may take up to
+    that long to be picked up.
+
+    """
+    interval = get_setting("VERSION_CHECK_INTERVAL") / 1000
+    now = time.monotonic()
+    if _local_version.value is None or now - _local_version.checked_at >= interval:
+        _local_version.value = _read_message_version()
+        _local_version.checked_at = now
+    return _local_version.value
+
+
+def bump_message_version() -> None:
+    """
+    Invalidate everything cached against the current message version.
+
+    If called inside a transaction the version is bumped again once the
+    transaction commits, as another process could otherwise re-populate
+    the cache with the uncommitted (i.e. old) data under the new version.
+
+    """
+    _bump_shared_message_version()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(_bump_shared_message_version)
+
+
+def get_user_version(user: settings.AUTH_USER_MODEL | AnonymousUser) -> int:
+    """Return the version of the user's message state (dismissals, groups)."""
+    if user.is_anonymous:
+        return 0
+    return _get_version(USER_VERSION_KEY.format(user_id=user.pk))
+
+
+def bump_user_versions(user_ids: Iterable[int]) -> None:
+    """Invalidate everything cached against the given users' versions."""
+    for user_id in user_ids:
+        _bump_version(USER_VERSION_KEY.format(user_id=user_id))
+
+
+def get_audience_version(message_id: int) -> int:
+    """Return the version of a message's target users / groups."""
+    return _get_version(AUDIENCE_VERSION_KEY.format(message_id=message_id))
+
+
+def get_audience_versions(message_ids: Iterable[int]) -> dict[int, int | None]:
+    """Return message_id -> audience version (None if not set) in one call."""
+    keys = {AUDIENCE_VERSION_KEY.format(message_id=pk): pk for pk in message_ids}
+    versions = get_cache().get_many(keys)
+    return {pk: versions.get(key) for key, pk in keys.items()}
+
+
+def bump_audience_version(message_id: int) -> int:
+    """Invalidate a message's compiled audience, returning the new version."""
+    return _bump_version(AUDIENCE_VERSION_KEY.format(message_id=message_id))
+
+
+def get_active_signature() -> str:
+    """
+    Return a signature of the currently active set of messages.
+
+    The set of active messages changes over time as messages pass their
+    display_from / display_until dates, without anything being saved,
+    so the signature is cached (against the message version) only
+    until the next such boundary.
+
+    """
+    from .models import PersistentMessage
+
+    cache = get_cache()
+    key = ACTIVE_SIGNATURE_KEY.format(version=get_message_version())
+    if (signature := cache.get(key)) is not None:
+        return signature
+    signature, next_boundary = PersistentMessage.objects.active_signature()
+    timeout = get_setting("FRAGMENT_CACHE_TIMEOUT") or None
+    if next_boundary:
+        seconds = math.ceil((next_boundary - tz_now()).total_seconds())
+        timeout = max(1, min(timeout or seconds, seconds))
+    cache.set(key, signature, timeout)
+    return signature
+
+
+def user_cache_key(
+    prefix: str,
+    user: settings.AUTH_USER_MODEL | AnonymousUser,
+    rollout_bucket: int | None = None,
+) -> str:
+    """
+    Return a cache key for data derived from the messages a user can see.
+
+    The key incorporates the global message version, the active set
+    signature and the user's own version, so it changes whenever any
+    of them do - meaning entries never need to be deleted explicitly.
+    Anonymous users share entries, per rollout bucket (see rollout.py).
+
+    """
+    if user.is_anonymous:
+        user_key = "anon" if rollout_bucket is None else f"anon-{rollout_bucket}"
+    else:
+        user_key = user.pk
+    return ":".join(
+        [
+            "persistent_messages",
+            prefix,
+            str(get_message_version()),
+            get_active_signature(),
+            str(user_key),
+            str(get_user_version(user)),
+        ]
+    )
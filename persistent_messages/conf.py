@@ -0,0 +1,80 @@
+"""
+App settings, all of which are optional and prefixed PERSISTENT_MESSAGES_.
+
+Settings are read at call time (rather than import time) so that they
+can be overridden in tests using `override_settings`.
+
+"""
+
+from __future__ import annotations
+
+from typing import Any
+
+from django.conf import settings
+
+DEFAULTS: dict[str, Any] = {
+    # dotted paths of the MessageSource classes that messages are read from
+    "SOURCES": ["persistent_messages.sources.DatabaseSource"],
+    # messages (as dicts) for the StaticSource
+    "STATIC_MESSAGES": [],
+    # path of a JSON or YAML file of messages for the StaticSource
+    "STATIC_MESSAGES_FILE": None,
+    # placeholder name -> (dotted) user attribute, for templated content
+    "TEMPLATE_PLACEHOLDERS": {
+        "first_name": "first_name",
+        "last_name": "last_name",
+        "full_name": "get_full_name",
+        "username": "username",
+    },
+    # alias of the Django cache used by all of the app caches
+    "CACHE": "default",
+    # cache each user's group ids, invalidated when User.groups changes
+    "CACHE_GROUP_IDS": False,
+    # timeout (in seconds) for cached user group ids
+    "GROUP_IDS_TIMEOUT": 3600,
+    # match USERS_OR_GROUPS messages using in-memory compiled audiences
+    "COMPILED_AUDIENCES": False,
+    # where the shared message version is stored - "cache" or "database"
+    "VERSION_BACKEND": "cache",
+    # how often (in ms) each process re-reads the shared message version
+    "VERSION_CHECK_INTERVAL": 1000,
+    # timeout (in seconds) for cached rendered output - 0 disables caching
+    "FRAGMENT_CACHE_TIMEOUT": 300,
+    # time budget (in ms) for each custom group predicate call - None is no limit
+    "CUSTOM_GROUP_BUDGET": None,
+    # consecutive errors / overruns after which a custom group is switched off
+    "CUSTOM_GROUP_MAX_FAILURES": 3,
+    # time (in seconds) for which a failing custom group is switched off
+    "CUSTOM_GROUP_COOLDOWN": 60,
+    # size of the thread pool used to evaluate custom groups - 0 is no pool
+    "CUSTOM_GROUP_WORKERS": 0,
+    # number of days ahead to precompute recurring message occurrences
+    "OCCURRENCE_HORIZON_DAYS": 28,
+    # count how often (and by how many users) each message is shown
+    "TRACK_IMPRESSIONS": False,
+    # how often (in seconds) each process flushes impressions to the database
+    "IMPRESSIONS_FLUSH_INTERVAL": 60,
+    # size (in seconds) of the time buckets impressions are aggregated into
+    "IMPRESSIONS_BUCKET_SIZE": 3600,
+    # directory that the anonymous messages are exported to as static JSON
+    "EXPORT_DIR": None,
+    # re-export the anonymous messages whenever a message changes
+    "EXPORT_ON_CHANGE": False,
+    # name of the cookie that identifies anonymous users for rollouts
+    "ROLLOUT_COOKIE_NAME": "persistent_messages_rollout",
+    # lifetime (in seconds) of the rollout cookie - one year
+    "ROLLOUT_COOKIE_AGE": 60 * 60 * 24 * 365,
+    # preload the app caches in AppConfig.ready()
+    "WARM_UP_ON_STARTUP": False,
+    # maximum number of persistent messages shown to a user - None is no limit
+    "MAX_DISPLAYED": None,
+    # database alias (e.g. a read replica) used to resolve a user's messages
+    "READ_DATABASE": None,
+    # time (in seconds) after a user writes during which they read from primary
+    "RECENT_WRITE_TIMEOUT": 10,
+}
+
+
+def get_setting(name: str) -> Any:
+    """Return PERSISTENT_MESSAGES_{name}, falling back to the app default."""
+    return getattr(settings, f"PERSISTENT_MESSAGES_{name}", DEFAULTS[name])
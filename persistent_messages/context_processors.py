@@ -1,19 +1,137 @@
-from typing import Callable
+from __future__ import annotations
 
+from typing import Any, Iterator
+
+from django.contrib.messages import get_messages
 from django.http import HttpRequest
 
-from .models import PersistentMessage
-from .shortcuts import get_all_messages, get_persistent_messages
-from .templatetags.persistent_message_tags import serialize_messages
+from . import sources
+from .shortcuts import get_loaded_messages, get_persistent_messages, iter_all_messages
+from .templatetags.persistent_message_tags import serialize_message, serialize_messages
+
+
+class LazyMessages:
+    """
+    The persistent messages for a request, only loaded when needed.
+
+    Templates that just check whether there are any messages (`{% if %}`),
+    how many (`.count`) or show the first (`.first`) use an EXISTS /
+    COUNT / LIMIT 1 query instead of loading them all - unless they have
+    already been loaded, in which case those are used. Calling the object
+    returns the list of messages, as the lambda this replaces did.
+
+    NB `len()` (and so `|length`) loads the messages, as `{% for %}`
+    calls it before iterating, and would otherwise pay for a COUNT.
+
+    """
+
+    # templates must not call the object, as that would load the messages
+    do_not_call_in_templates = True
+
+    def __init__(self, request: HttpRequest) -> None:
+        self.request = request
+        self._count: int | None = None
+
+    def __call__(self) -> list:
+        return get_persistent_messages(self.request)
+
+    def __iter__(self) -> Iterator:
+        return iter(self())
+
+    def __len__(self) -> int:
+        return len(self())
+
+    def __repr__(self) -> str:
+        return repr(self())
+
+    def __getitem__(self, index: int | slice) -> Any:
+        # templates try a key lookup first (e.g. for `.first`) - which
+        # must fail without loading the messages
+        if not isinstance(index, (int, slice)):
+            raise TypeError(f"Invalid index {index!r}")
+        return self()[index]
+
+    def __bool__(self) -> bool:
+        if (messages := self._get_loaded()) is not None:
+            return bool(messages)
+        if self._count is not None:
+            return self._count > 0
+        return self._exists()
+
+    @property
+    def count(self) -> int:
+        """Return the number of messages, using a COUNT if they aren't loaded."""
+        if (messages := self._get_loaded()) is not None:
+            return len(messages)
+        if self._count is None:
+            self._count = self._count_messages()
+        return self._count
+
+    @property
+    def first(self) -> Any:
+        if (messages := self._get_loaded()) is not None:
+            return messages[0] if messages else None
+        return self._get_first()
+
+    def _get_loaded(self) -> list | None:
+        return get_loaded_messages(self.request)
+
+    def _exists(self) -> bool:
+        return sources.has_messages(self.request)
+
+    def _count_messages(self) -> int:
+        return sources.count_messages(self.request)
+
+    def _get_first(self) -> Any:
+        return sources.get_first_message(self.request)
+
+
+class LazyAllMessages(LazyMessages):
+    """
+    The flash and (serialized) persistent messages for a request.
+
+    As for LazyMessages, but the flash messages are included - these
+    are held in the session / cookie, so counting them costs no queries.
+    NB `first` marks the flash messages as used.
+
+    """
+
+    def __init__(self, request: HttpRequest) -> None:
+        super().__init__(request)
+        self._messages: list[dict] | None = None
+
+    def __call__(self) -> list[dict]:
+        if self._messages is None:
+            self._messages = serialize_messages(iter_all_messages(self.request))
+        return self._messages
+
+    def _get_loaded(self) -> list | None:
+        return self._messages
+
+    def _exists(self) -> bool:
+        return bool(len(get_messages(self.request))) or super()._exists()
+
+    def _count_messages(self) -> int:
+        if (persistent := get_loaded_messages(self.request)) is not None:
+            return len(get_messages(self.request)) + len(persistent)
+        return len(get_messages(self.request)) + super()._count_messages()
+
+    def _get_first(self) -> dict | None:
+        flash = get_messages(self.request)
+        if len(flash):
+            return serialize_message(next(iter(flash)))
+        if (persistent := get_loaded_messages(self.request)) is None:
+            first = super()._get_first()
+        else:
+            first = persistent[0] if persistent else None
+        return serialize_message(first) if first is not None else None
 
 
-def persistent_messages(
-    request: HttpRequest,
-) -> dict[str, Callable[[], list[PersistentMessage]]]:
+def persistent_messages(request: HttpRequest) -> dict[str, LazyMessages]:
     """Return just the persistent messages."""
-    return {"persistent_messages": lambda: get_persistent_messages(request)}
+    return {"persistent_messages": LazyMessages(request)}
 
 
-def all_messages(request: HttpRequest) -> dict[str, Callable[[], list[dict]]]:
+def all_messages(request: HttpRequest) -> dict[str, LazyAllMessages]:
     """Return contrib.messages and persistent_messages combined (and serialized)."""
-    return {"all_messages": lambda: serialize_messages(get_all_messages(request))}
+    return {"all_messages": LazyAllMessages(request)}
@@ -0,0 +1,195 @@
+"""
+Evaluation of custom group predicates (settings.MESSAGE_CUSTOM_GROUPS).
+
+The predicates are arbitrary callables, evaluated on every request for
+every active custom group message, so a slow or failing predicate can
+stall every page. To guard against this:
+
+* Each group is evaluated at most once per user, however many messages
+  target it.
+* The time taken by each call is measured against a budget of
+  PERSISTENT_MESSAGES_CUSTOM_GROUP_BUDGET milliseconds.
+* A group that raises an exception or exceeds its budget
+  PERSISTENT_MESSAGES_CUSTOM_GROUP_MAX_FAILURES times in a row trips a
+  (process-local) circuit breaker. It is then treated as not matching,
+  without being called, for PERSISTENT_MESSAGES_CUSTOM_GROUP_COOLDOWN
+  seconds.
+
+If PERSISTENT_MESSAGES_CUSTOM_GROUP_WORKERS is set, the groups are
+evaluated concurrently in a thread pool of that size, and calls still
+running when the budget expires are abandoned (treated as not matching
+and counted as failures) rather than waited for. NB the predicates must
+then be thread-safe.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Collection
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures of a single custom group."""
+
+    def __init__(self, group: str) -> None:
+        self.group = group
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_until = 0.0
+
+    def is_open(self) -> bool:
+        return time.monotonic() < self.opened_until
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self, reason: str) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.failures < get_setting("CUSTOM_GROUP_MAX_FAILURES"):
+                return
+            cooldown = get_setting("CUSTOM_GROUP_COOLDOWN")
+            self.opened_until = time.monotonic() + cooldown
+            self.failures = 0
+        logger.warning(
+            "Custom group %r tripped its circuit breaker (%s) - "
+            "treating as not matching for %ss",
+            self.group,
+            reason,
+            cooldown,
+        )
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_breaker(group: str) -> CircuitBreaker:
+    if (breaker := _breakers.get(group)) is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(group, CircuitBreaker(group))
+    return breaker
+
+
+def reset_breakers() -> None:
+    """Close all of the circuit breakers."""
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _breakers_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_setting("CUSTOM_GROUP_WORKERS"),
+                    thread_name_prefix="persistent_messages",
+                )
+    return _executor
+
+
+def _get_budget() -> float | None:
+    budget = get_setting("CUSTOM_GROUP_BUDGET")
+    return budget / 1000 if budget else None
+
+
+def _call(predicate: Callable[[Any], bool], user: Any) -> tuple[bool, float]:
+    """Call the predicate, returning (result, elapsed seconds)."""
+    start = time.perf_counter()
+    return bool(predicate(user)), time.perf_counter() - start
+
+
+def _call_in_worker(predicate: Callable[[Any], bool], user: Any) -> tuple[bool, float]:
+    try:
+        return _call(predicate, user)
+    finally:
+        # don't leak a database connection per worker thread
+        close_old_connections()
+
+
+def _record(group: str, elapsed: float, budget: float | None) -> None:
+    breaker = get_breaker(group)
+    if budget and elapsed > budget:
+        breaker.record_failure(f"took {elapsed * 1000:.0f}ms")
+    else:
+        breaker.record_success()
+
+
+def _record_error(group: str, ex: BaseException) -> None:
+    logger.error("Error evaluating custom group %r", group, exc_info=ex)
+    get_breaker(group).record_failure(f"raised {type(ex).__name__}")
+
+
+def in_custom_group(group: str, user: Any) -> bool:
+    """Return True if the user is in the custom group."""
+    return group in match_custom_groups([group], user)
+
+
+def match_custom_groups(groups: Collection[str], user: Any) -> set[str]:
+    """Return the custom groups (of those given) that the user is in."""
+    # raise KeyError for unknown groups, as this is a configuration error
+    predicates = {
+        group: settings.MESSAGE_CUSTOM_GROUPS[group]
+        for group in groups
+        if not get_breaker(group).is_open()
+    }
+    budget = _get_budget()
+    # a single group still goes through the pool if there is a budget, so
+    # that it can be abandoned rather than stall the request
+    if (
+        predicates
+        and get_setting("CUSTOM_GROUP_WORKERS")
+        and (budget or len(predicates) > 1)
+    ):
+        return _match_concurrently(predicates, user, budget)
+    matched = set()
+    for group, predicate in predicates.items():
+        try:
+            result, elapsed = _call(predicate, user)
+        except Exception as ex:
+            _record_error(group, ex)
+            continue
+        _record(group, elapsed, budget)
+        if result:
+            matched.add(group)
+    return matched
+
+
+def _match_concurrently(
+    predicates: dict[str, Callable[[Any], bool]], user: Any, budget: float | None
+) -> set[str]:
+    executor = _get_executor()
+    futures: dict[Future, str] = {
+        executor.submit(_call_in_worker, predicate, user): group
+        for group, predicate in predicates.items()
+    }
+    done, not_done = wait(futures, timeout=budget)
+    matched = set()
+    for future in done:
+        group = futures[future]
+        if (ex := future.exception()) is not None:
+            _record_error(group, ex)
+            continue
+        result, elapsed = future.result()
+        _record(group, elapsed, budget)
+        if result:
+            matched.add(group)
+    for future in not_done:
+        # the call can't be interrupted, but we don't wait for it
+        future.cancel()
+        get_breaker(futures[future]).record_failure("timed out")
+    return matched
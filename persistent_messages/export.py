@@ -0,0 +1,109 @@
+"""
+Static export of the messages shown to anonymous users.
+
+Pages that are served from a CDN (or any other full-page cache) cannot
+render the persistent messages without a round-trip to Django, so the
+anonymous messages can instead be written to a static JSON file (in the
+same format as the `serialize_messages` filter) and loaded client-side.
+
+Each export is written to PERSISTENT_MESSAGES_EXPORT_DIR twice:
+
+* persistent-messages.{version}.json - where version is a hash of the
+  content, so it can be served with a far-future cache header, and
+* persistent-messages.json - the latest version, for pages to load.
+
+Both are written atomically (to a temporary file that is then renamed)
+so that the web server never serves a partially written file.
+
+The export can be run using the `export_persistent_messages` management
+command, or automatically whenever a message changes by setting
+PERSISTENT_MESSAGES_EXPORT_ON_CHANGE. NB messages that become active
+(or inactive) because of their display dates do not trigger an export,
+so if these are used the command should also be run periodically.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, transaction
+from django.http import HttpRequest
+
+from .conf import get_setting
+from .sources import get_messages
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FILENAME = "persistent-messages"
+
+
+def get_export_dir() -> Path:
+    """Return PERSISTENT_MESSAGES_EXPORT_DIR, raising if it is not set."""
+    if not (export_dir := get_setting("EXPORT_DIR")):
+        raise ImproperlyConfigured("PERSISTENT_MESSAGES_EXPORT_DIR is not set")
+    return Path(export_dir)
+
+
+def _write_atomic(path: Path, content: bytes) -> None:
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable only by the owner
+        os.chmod(temp_path, 0o644)  # noqa: S103
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def export_anonymous_messages(export_dir: Path | str | None = None) -> Path:
+    """
+    Write the messages currently shown to anonymous users to a JSON file.
+
+    Returns the path of the versioned file. Files whose content hasn't
+    changed since the last export are not rewritten.
+
+    """
+    from .templatetags.persistent_message_tags import serialize_messages
+
+    export_dir = Path(export_dir) if export_dir else get_export_dir()
+    request = HttpRequest()
+    request.user = AnonymousUser()
+    messages = get_messages(request)
+    content = json.dumps(serialize_messages(messages), cls=DjangoJSONEncoder).encode()
+    version = hashlib.md5(content, usedforsecurity=False).hexdigest()[:12]
+    versioned_path = export_dir / f"{EXPORT_FILENAME}.{version}.json"
+    latest_path = export_dir / f"{EXPORT_FILENAME}.json"
+    export_dir.mkdir(parents=True, exist_ok=True)
+    # write the versioned file first, so that it exists before it is "latest"
+    if not versioned_path.exists():
+        _write_atomic(versioned_path, content)
+    if not latest_path.exists() or latest_path.read_bytes() != content:
+        _write_atomic(latest_path, content)
+    logger.debug("Exported anonymous persistent messages to %s", versioned_path)
+    return versioned_path
+
+
+def _export_on_commit() -> None:
+    try:
+        export_anonymous_messages()
+    except (DatabaseError, OSError) as ex:
+        logger.warning("Unable to export persistent messages - %s", ex)
+
+
+def schedule_export() -> None:
+    """Export the anonymous messages (once any transaction has committed)."""
+    if get_setting("EXPORT_ON_CHANGE"):
+        transaction.on_commit(_export_on_commit)
@@ -0,0 +1,162 @@
+"""
+Buffered impression tracking.
+
+If PERSISTENT_MESSAGES_TRACK_IMPRESSIONS is set, each time a user is
+shown their persistent messages an impression is recorded for each
+message. Rather than writing a row per impression, they are aggregated
+in memory (per process) into a count and a HyperLogLog sketch of
+distinct viewers for each (message, time bucket) pair, and flushed to
+the MessageImpressions table at most every
+PERSISTENT_MESSAGES_IMPRESSIONS_FLUSH_INTERVAL seconds.
+
+NB anything buffered when a process exits is lost, so the numbers are
+a (very slight) undercount.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Iterable
+
+from django.db import DatabaseError, transaction
+from django.http import HttpRequest
+
+from .conf import get_setting
+from .sketch import HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+# attribute set on the request to prevent double counting
+REQUEST_ATTR = "_persistent_messages_impressions"
+# attribute set on requests that should not be counted (see `skip_impressions`)
+SKIP_ATTR = "_persistent_messages_skip_impressions"
+
+
+class ImpressionBuffer:
+    """Thread-safe in-memory buffer of impressions awaiting flushing."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # (message_id, bucket_start) -> [count, viewers sketch]
+        self.entries: dict[tuple[int, datetime], list] = {}
+        self.flushed_at = time.monotonic()
+
+    def add(
+        self, message_ids: Iterable[int], viewer: str | None, bucket: datetime
+    ) -> None:
+        with self.lock:
+            for message_id in message_ids:
+                entry = self.entries.setdefault(
+                    (message_id, bucket), [0, HyperLogLog()]
+                )
+                entry[0] += 1
+                if viewer:
+                    entry[1].add(viewer)
+
+    def restore(self, entries: dict[tuple[int, datetime], list]) -> None:
+        """Merge drained entries back in, e.g. if they could not be written."""
+        with self.lock:
+            for key, (count, sketch) in entries.items():
+                entry = self.entries.setdefault(key, [0, HyperLogLog()])
+                entry[0] += count
+                entry[1].merge(sketch)
+
+    def is_due(self) -> bool:
+        interval = get_setting("IMPRESSIONS_FLUSH_INTERVAL")
+        return time.monotonic() - self.flushed_at >= interval
+
+    def drain(self) -> dict[tuple[int, datetime], list]:
+        with self.lock:
+            entries, self.entries = self.entries, {}
+            self.flushed_at = time.monotonic()
+        return entries
+
+
+buffer = ImpressionBuffer()
+
+
+def get_bucket(when: datetime) -> datetime:
+    """Return the start of the time bucket that `when` falls in."""
+    size = get_setting("IMPRESSIONS_BUCKET_SIZE")
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    seconds = int((when - epoch).total_seconds())
+    return epoch + timedelta(seconds=seconds - seconds % size)
+
+
+def get_viewer(request: HttpRequest) -> str | None:
+    """Return a key identifying the viewer, used to count unique viewers."""
+    if request.user.is_authenticated:
+        return f"user:{request.user.pk}"
+    session = getattr(request, "session", None)
+    if session is not None and session.session_key:
+        return f"session:{session.session_key}"
+    return None
+
+
+def skip_impressions(request: HttpRequest) -> None:
+    """Don't record impressions for the request (e.g. an internal request)."""
+    setattr(request, SKIP_ATTR, True)
+
+
+def track_impressions(request: HttpRequest, message_ids: Iterable[int]) -> None:
+    """Record an impression of each message, once per request."""
+    if not get_setting("TRACK_IMPRESSIONS") or getattr(request, SKIP_ATTR, False):
+        return
+    recorded: set[int] = getattr(request, REQUEST_ATTR, set())
+    if new_ids := set(message_ids) - recorded:
+        buffer.add(new_ids, get_viewer(request), get_bucket(datetime.now(timezone.utc)))
+        setattr(request, REQUEST_ATTR, recorded | new_ids)
+    if buffer.is_due():
+        try:
+            flush_impressions()
+        except DatabaseError:
+            logger.exception("Error flushing persistent message impressions")
+
+
+def flush_impressions() -> int:
+    """
+    Write buffered impressions to the database, returning the number of rows.
+
+    If the write fails, the impressions are put back in the buffer to be
+    retried on the next flush, and the exception is re-raised.
+
+    """
+    entries = buffer.drain()
+    try:
+        return _write_impressions(entries)
+    except DatabaseError:
+        buffer.restore(entries)
+        raise
+
+
+def _write_impressions(entries: dict[tuple[int, datetime], list]) -> int:
+    from .models import MessageImpressions, PersistentMessage
+
+    # messages may have been deleted since they were viewed
+    existing = set(
+        PersistentMessage.objects.filter(
+            id__in={message_id for message_id, _ in entries}
+        ).values_list("id", flat=True)
+    )
+    written = 0
+    with transaction.atomic():
+        # lock rows in a consistent order to avoid deadlocks between processes
+        for (message_id, bucket), (count, sketch) in sorted(entries.items()):
+            if message_id not in existing:
+                continue
+            obj, _ = MessageImpressions.objects.select_for_update().get_or_create(
+                message_id=message_id,
+                bucket_start=bucket,
+                defaults={"viewers": HyperLogLog().to_bytes()},
+            )
+            viewers = obj.viewers_sketch
+            viewers.merge(sketch)
+            obj.count += count
+            obj.viewers = viewers.to_bytes()
+            obj.save(update_fields=["count", "viewers"])
+            written += 1
+    return written
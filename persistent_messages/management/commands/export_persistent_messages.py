@@ -0,0 +1,23 @@
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from persistent_messages.export import export_anonymous_messages
+
+
+class Command(BaseCommand):
+    help = (
+        "Export the messages shown to anonymous users as static JSON files, "
+        "for pages served from a CDN. Defaults to PERSISTENT_MESSAGES_EXPORT_DIR."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--dir",
+            dest="export_dir",
+            help="Directory to export to (overrides the setting).",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        path = export_anonymous_messages(options["export_dir"])
+        self.stdout.write(f"Exported anonymous messages to {path}")
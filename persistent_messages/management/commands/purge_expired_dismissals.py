@@ -0,0 +1,24 @@
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from persistent_messages.models import PURGE_BATCH_SIZE, MessageDismissal
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete dismissals that have passed their message's dismissal_ttl. "
+        "These are already ignored, so this just keeps the table small."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=PURGE_BATCH_SIZE,
+            help="Number of dismissals to delete per query.",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        count = MessageDismissal.objects.purge_expired(options["batch_size"])
+        self.stdout.write(f"Deleted {count} expired dismissals")
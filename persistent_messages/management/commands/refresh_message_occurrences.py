@@ -0,0 +1,27 @@
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from persistent_messages.models import PersistentMessage
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the upcoming occurrences of all recurring messages. "
+        "Should be run (e.g. daily) more often than "
+        "PERSISTENT_MESSAGES_OCCURRENCE_HORIZON_DAYS."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--horizon",
+            type=int,
+            help="Number of days ahead to compute (defaults to the setting).",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        messages = PersistentMessage.objects.filter(recurring_windows__isnull=False)
+        count = 0
+        for message in messages.distinct():
+            count += message.refresh_occurrences(options["horizon"])
+        self.stdout.write(f"Created {count} occurrences")
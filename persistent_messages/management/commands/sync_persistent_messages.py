@@ -0,0 +1,40 @@
+from typing import Any
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from persistent_messages.sync import sync_messages
+
+
+class Command(BaseCommand):
+    help = (
+        "Sync messages from a JSON / YAML file to the database, matching them "
+        "by key and writing only the differences."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("path", help="JSON or YAML file of messages.")
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help="Delete messages with a key that is not in the file.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report the changes without making them.",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        try:
+            plan = sync_messages(
+                options["path"], prune=options["prune"], dry_run=options["dry_run"]
+            )
+        except ValidationError as ex:
+            raise CommandError("; ".join(ex.messages)) from ex
+        for line in plan.describe():
+            self.stdout.write(line)
+        if not plan:
+            self.stdout.write("No changes")
+        elif options["dry_run"]:
+            self.stdout.write("Dry run - no changes made")
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import argparse
+import sys
+from typing import Any, Iterator, TextIO
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from persistent_messages.models import (
+    TARGET_USERS_BATCH_SIZE,
+    PersistentMessage,
+    get_level,
+)
+
+
+def read_user_ids(stream: TextIO) -> Iterator[int]:
+    """Yield user ids from a stream, one per line, ignoring blanks and comments."""
+    for lineno, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            yield int(line)
+        except ValueError:
+            raise CommandError(f"Invalid user id on line {lineno}: {line!r}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Target a persistent message at a list of user ids, read from a file "
+        "or stdin (one id per line). Creates a new message unless --message "
+        "is used to add users to an existing one."
+    )
+
+    def add_arguments(self, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument(
+            "--file",
+            default="-",
+            help="File containing user ids, one per line (defaults to stdin).",
+        )
+        parser.add_argument(
+            "--message",
+            type=int,
+            help="Id of an existing message to add the users to.",
+        )
+        parser.add_argument(
+            "--content",
+            help="Content of the new message (ignored if --message is set).",
+        )
+        parser.add_argument(
+            "--level",
+            default="info",
+            help="Level tag of the new message - e.g. 'info', 'warning'.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=TARGET_USERS_BATCH_SIZE,
+            help="Number of rows to insert per query.",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options["file"] == "-":
+            self.target_users(sys.stdin, **options)
+            return
+        with open(options["file"]) as stream:
+            self.target_users(stream, **options)
+
+    def target_users(self, stream: TextIO, **options: Any) -> None:
+        user_ids = read_user_ids(stream)
+        batch_size = options["batch_size"]
+        if message_id := options["message"]:
+            try:
+                message = PersistentMessage.objects.get(pk=message_id)
+            except PersistentMessage.DoesNotExist:
+                raise CommandError(f"Persistent message {message_id} does not exist")
+            # NB this is atomic, so no users are added if any id is invalid
+            try:
+                count = message.add_target_users(user_ids, batch_size=batch_size)
+            except ValidationError as ex:
+                raise CommandError(ex.messages[0])
+            # NB users that were already targeted are included in the count
+            self.stdout.write(f"Targeted message {message.pk} at {count} user id(s)")
+            return
+        if not options["content"]:
+            raise CommandError("One of --message or --content is required")
+        try:
+            level = get_level(options["level"])
+        except KeyError:
+            raise CommandError(f"Unknown message level: {options['level']}")
+        # NB this is atomic, so an invalid id file leaves no message behind
+        try:
+            message = PersistentMessage.objects.create_for_users(
+                user_ids, batch_size=batch_size, content=options["content"], level=level
+            )
+        except ValidationError as ex:
+            raise CommandError(ex.messages[0])
+        count = message.target_users.count()
+        self.stdout.write(f"Created message {message.pk} targeting {count} user(s)")
@@ -0,0 +1,18 @@
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError
+
+from persistent_messages.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = (
+        "Preload the persistent messages caches (active message set and "
+        "anonymous payloads). Only useful if the configured cache is shared "
+        "between processes."
+    )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if not warm_up():
+            raise CommandError("Unable to warm up caches - database not ready")
+        self.stdout.write("Persistent messages caches warmed up")
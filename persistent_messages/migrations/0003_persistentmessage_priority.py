@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("persistent_messages", "0002_persistentmessage_target_custom_group_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="persistentmessage",
+            name="priority",
+            field=models.IntegerField(
+                default=0,
+                help_text="Messages with a higher priority are shown first, regardless of level.",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("persistent_messages", "0004_messagegeneration"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="persistentmessage",
+            index=models.Index(
+                fields=["created_at", "id"], name="persistent_created_id_idx"
+            ),
+        ),
+    ]
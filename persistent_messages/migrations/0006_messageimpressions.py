@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("persistent_messages", "0005_persistentmessage_created_id_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MessageImpressions",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "bucket_start",
+                    models.DateTimeField(
+                        help_text="The start of the time bucket the impressions fall in."
+                    ),
+                ),
+                ("count", models.PositiveBigIntegerField(default=0)),
+                (
+                    "viewers",
+                    models.BinaryField(
+                        help_text="HyperLogLog sketch of the distinct viewers."
+                    ),
+                ),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="impressions",
+                        to="persistent_messages.persistentmessage",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "Message impressions",
+                "unique_together": {("message", "bucket_start")},
+            },
+        ),
+    ]
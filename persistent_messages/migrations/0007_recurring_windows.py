@@ -0,0 +1,103 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("persistent_messages", "0006_messageimpressions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="persistentmessage",
+            name="is_recurring",
+            field=models.BooleanField(
+                default=False,
+                editable=False,
+                help_text="Set automatically if the message has recurring display windows.",
+            ),
+        ),
+        migrations.CreateModel(
+            name="RecurringWindow",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "weekday",
+                    models.IntegerField(
+                        choices=[
+                            (0, "Monday"),
+                            (1, "Tuesday"),
+                            (2, "Wednesday"),
+                            (3, "Thursday"),
+                            (4, "Friday"),
+                            (5, "Saturday"),
+                            (6, "Sunday"),
+                        ]
+                    ),
+                ),
+                (
+                    "start_time",
+                    models.TimeField(
+                        help_text="Time of day the window starts (in the site time zone)."
+                    ),
+                ),
+                (
+                    "duration",
+                    models.DurationField(
+                        help_text="How long the window lasts - may run past midnight."
+                    ),
+                ),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="recurring_windows",
+                        to="persistent_messages.persistentmessage",
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="MessageOccurrence",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("starts_at", models.DateTimeField()),
+                ("ends_at", models.DateTimeField()),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="occurrences",
+                        to="persistent_messages.persistentmessage",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["starts_at", "ends_at"],
+                        name="persistent_occurrence_idx",
+                    )
+                ],
+                "unique_together": {("message", "starts_at")},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:14
+
+import django.core.validators
+from django.db import migrations, models
+
+import persistent_messages.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("persistent_messages", "0007_recurring_windows"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="persistentmessage",
+            name="rollout_percentage",
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                help_text="Only show the message to this percentage of the targeted users (leave blank to show it to all of them).",
+                null=True,
+                validators=[django.core.validators.MaxValueValidator(100)],
+            ),
+        ),
+        migrations.AddField(
+            model_name="persistentmessage",
+            name="rollout_salt",
+            field=models.PositiveSmallIntegerField(
+                default=persistent_messages.models._random_rollout_salt,
+                help_text="Determines which users are in the rollout - change it to roll the message out to a different set of users.",
+            ),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:19
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("persistent_messages", "0008_persistentmessage_rollout"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="persistentmessage",
+            name="dismissal_ttl",
+            field=models.DurationField(
+                blank=True,
+                help_text="Show the message again this long after a user dismisses it (leave blank for dismissals to be permanent).",
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="messagedismissal",
+            name="dismissed_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name="messagedismissal",
+            index=models.Index(
+                fields=["user", "message", "dismissed_at"],
+                name="persistent_dismissal_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("persistent_messages", "0009_dismissal_ttl"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="persistentmessage",
+            name="key",
+            field=models.SlugField(
+                blank=True,
+                help_text="Stable identifier for messages managed by sync_persistent_messages.",
+                max_length=100,
+                null=True,
+                unique=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("persistent_messages", "0010_message_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="persistentmessage",
+            name="is_template",
+            field=models.BooleanField(
+                default=False,
+                help_text="Fill in {placeholders} in the content with details of the user, e.g. 'Hi {first_name}'.",
+            ),
+        ),
+    ]
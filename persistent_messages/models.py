@@ -1,19 +1,46 @@
 from __future__ import annotations
 
-from typing import Any
+import hashlib
+import secrets
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Any, Iterable, Iterator
 
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser, Group
 from django.contrib.messages.utils import get_level_tags
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.core.validators import MaxValueValidator
+from django.db import connections, models, router, transaction
+from django.db.models.functions import Mod
 from django.urls import reverse
 from django.utils.safestring import mark_safe
-from django.utils.timezone import now as tz_now
+from django.utils.timezone import (
+    get_default_timezone,
+    localtime,
+    make_aware,
+    now as tz_now,
+)
 from django.utils.translation import gettext as _, gettext_lazy as _lazy
 
+from .audience import audiences
+from .cache import bump_message_version, get_user_group_ids
+from .conf import get_setting
+from .content import render_content, validate_content
+from .custom_groups import in_custom_group, match_custom_groups
 from .exceptions import UndismissableMessage
+from .rollout import (
+    ROLLOUT_BUCKETS,
+    USER_KEY,
+    get_rollout_bucket,
+    get_user_rollout_bucket,
+)
+from .routing import db_for_read, mark_recent_write
+from .sketch import HyperLogLog
+from .utils import chunked, decode_cursor, encode_cursor
 
 # use the contrib func as it pulls in settings overrides
 LEVEL_TAGS = get_level_tags()
@@ -21,6 +48,19 @@ LEVEL_TAGS = get_level_tags()
 # NB this will fail if there are duplicate values in the original dict
 TAG_LEVELS = {tag: level for level, tag in LEVEL_TAGS.items()}
 
+# most important first - used for ordering messages in the database
+DISPLAY_ORDER = ("-priority", "-level", "-created_at", "-id")
+
+# default number of messages per page of a user's message history
+HISTORY_PAGE_SIZE = 20
+
+# number of users resolved per chunk (i.e. set of queries) by `for_users`
+FOR_USERS_CHUNK_SIZE = 500
+
+# number of M2M through rows written per INSERT when bulk targeting users
+TARGET_USERS_BATCH_SIZE = 1000
+PURGE_BATCH_SIZE = 1000
+
 
 def get_level(tag: str) -> int:
     """Convert a tag to a level."""
@@ -32,14 +72,88 @@ def get_tag(level: int) -> str:
     return LEVEL_TAGS[level]
 
 
+def _is_dismissed(user: settings.AUTH_USER_MODEL, now: datetime) -> models.Exists:
+    """
+    Return an expression that is True if the user has dismissed the message.
+
+    Dismissals older than the message's dismissal_ttl are ignored. This
+    is a correlated subquery using the (user, message, dismissed_at)
+    index, so there's no need to scan the user's dismissals.
+
+    """
+    return models.Exists(
+        MessageDismissal.objects.filter(
+            user=user, message=models.OuterRef("pk")
+        ).filter(
+            models.Q(message__dismissal_ttl__isnull=True)
+            | models.Q(
+                dismissed_at__gt=models.Value(now) - models.F("message__dismissal_ttl")
+            )
+        )
+    )
+
+
+def _random_rollout_salt() -> int:
+    return secrets.randbelow(ROLLOUT_BUCKETS)
+
+
 class PersistentMessageQuerySet(models.QuerySet):
     def active(self) -> models.QuerySet[PersistentMessage]:
-        """Filter messages to those that are currently active (based on dates)."""
-        start_date_filter = models.Q(display_from__lte=tz_now())
-        end_date_filter = models.Q(display_until__gte=tz_now()) | models.Q(
+        """
+        Filter messages to those that are currently active (based on dates).
+
+        Recurring messages must also be within one of their precomputed
+        occurrences (see `MessageOccurrence`), which is an indexed lookup
+        rather than an evaluation of the recurrence rules.
+
+        """
+        now = tz_now()
+        start_date_filter = models.Q(display_from__lte=now)
+        end_date_filter = models.Q(display_until__gte=now) | models.Q(
             display_until__isnull=True
         )
-        return self.filter(start_date_filter).filter(end_date_filter)
+        recurring_filter = models.Q(is_recurring=False) | models.Q(
+            id__in=MessageOccurrence.objects.current(now).values("message_id")
+        )
+        return (
+            self.filter(start_date_filter)
+            .filter(end_date_filter)
+            .filter(recurring_filter)
+        )
+
+    def active_signature(self) -> tuple[str, datetime | None]:
+        """
+        Return a signature of the active messages, and when it may next change.
+
+        The signature is a hash of the id and updated_at of each active
+        message. The second value is the next display_from/until date (or
+        recurring occurrence start/end) in the future, at which point the
+        set of active messages will change without any message being saved.
+
+        """
+        now = tz_now()
+        active = self.active().order_by("id").values_list("id", "updated_at")
+        digest = hashlib.md5(usedforsecurity=False)
+        for message_id, updated_at in active:
+            digest.update(f"{message_id}:{updated_at.isoformat()};".encode())
+        boundaries = self.aggregate(
+            next_start=models.Min(
+                "display_from", filter=models.Q(display_from__gt=now)
+            ),
+            next_end=models.Min(
+                "display_until", filter=models.Q(display_until__gt=now)
+            ),
+        )
+        boundaries |= MessageOccurrence.objects.aggregate(
+            next_occurrence_start=models.Min(
+                "starts_at", filter=models.Q(starts_at__gt=now)
+            ),
+            next_occurrence_end=models.Min("ends_at", filter=models.Q(ends_at__gt=now)),
+        )
+        next_boundary = min(
+            (dt for dt in boundaries.values() if dt is not None), default=None
+        )
+        return digest.hexdigest(), next_boundary
 
     def custom_group_query(self, user: settings.AUTH_USER_MODEL) -> models.Q:
         """Return a Q object that can be used to filter messages for the given user."""
@@ -51,10 +165,169 @@ class PersistentMessageQuerySet(models.QuerySet):
             .exclude(target_custom_group="")
             .active()
         )
-        return models.Q(id__in=[m.id for m in messages if m.user_in_custom_group(user)])
+        # evaluate each group once, however many messages target it
+        groups = match_custom_groups({m.target_custom_group for m in messages}, user)
+        return models.Q(
+            id__in=[m.id for m in messages if m.target_custom_group in groups]
+        )
+
+    def user_target_query(self, user: settings.AUTH_USER_MODEL) -> models.Q:
+        """
+        Return a Q object matching messages targeted at an authenticated user.
+
+        This covers AUTHENTICATED_ONLY messages, and USERS_OR_GROUPS
+        messages that target the user directly or via one of their groups.
+        It does not include ALL_USERS messages, or custom groups (which
+        need to be evaluated in Python).
+
+        """
+        # filter on AUTHENTICATED_ONLY messages as we know the user is authenticated
+        auth_filter = models.Q(target=PersistentMessage.TargetType.AUTHENTICATED_ONLY)
+
+        # filter on messages targeted at the user. NB the targeting filters
+        # use subqueries rather than joins, as joining on the M2M tables
+        # could return the same message more than once, which would break
+        # the LIMIT.
+        user_filter = models.Q(
+            target=PersistentMessage.TargetType.USERS_OR_GROUPS,
+            id__in=PersistentMessage.objects.filter(target_users=user).values("id"),
+        )
+
+        # filter on messages targeted at the user via a group they belong to.
+        # NB unless the group ids are cached, even though we are using
+        # another queryset in this filter, it's evaluated on the fly as part
+        # of the overall query - we don't do any extra queries here.
+        if get_setting("CACHE_GROUP_IDS"):
+            user_groups: Any = get_user_group_ids(user)
+        else:
+            user_groups = user.groups.all()
+        group_filter = models.Q(
+            target=PersistentMessage.TargetType.USERS_OR_GROUPS,
+            id__in=PersistentMessage.objects.filter(
+                target_groups__in=user_groups
+            ).values("id"),
+        )
+
+        return auth_filter | user_filter | group_filter
+
+    def compiled_target_query(self, user: settings.AUTH_USER_MODEL) -> models.Q:
+        """
+        Return the equivalent of `user_target_query` using compiled audiences.
+
+        Rather than filtering on the M2M tables, the targeted messages
+        are matched against their compiled audiences in memory - see
+        audience.py - and the matching ids are passed into the query.
+
+        """
+        auth_filter = models.Q(target=PersistentMessage.TargetType.AUTHENTICATED_ONLY)
+        matching_ids = audiences.matching(user.pk, lambda: get_user_group_ids(user))
+        return auth_filter | models.Q(
+            target=PersistentMessage.TargetType.USERS_OR_GROUPS, id__in=matching_ids
+        )
+
+    def for_users(
+        self, user_ids: Iterable[int], chunk_size: int = FOR_USERS_CHUNK_SIZE
+    ) -> Iterator[tuple[int, list[PersistentMessage]]]:
+        """
+        Yield (user_id, messages) for each of the given (authenticated) users.
+
+        This is the batch equivalent of calling `filter_user` for each
+        user, for use in background jobs (e.g. digest emails). It uses a
+        fixed number of queries per chunk of `chunk_size` users (see
+        `_BatchResolver`), and as it's a generator the user ids can be
+        streamed in and only one chunk is held in memory at a time. Use
+        `dict(...)` if you want the full mapping of user id to messages.
+
+        Each user's messages are returned in display order. NB the same
+        message objects are shared between users, so use `for_user` on
+        each before rendering templated content.
+
+        """
+        resolver = _BatchResolver(list(self.active().display_order()))
+        for chunk in chunked(user_ids, chunk_size):
+            yield from resolver.resolve(chunk)
+
+    def history(
+        self,
+        user: settings.AUTH_USER_MODEL,
+        cursor: str | None = None,
+        limit: int = HISTORY_PAGE_SIZE,
+    ) -> tuple[list[PersistentMessage], str | None]:
+        """
+        Return a page of the messages that have been shown to a user.
+
+        This includes messages that have been dismissed (each message is
+        annotated with `is_dismissed`, which is False once a dismissal has
+        passed the message's dismissal_ttl) or have expired, most
+        recent first. Messages targeted using custom groups are not
+        included, as there is no way to evaluate them historically.
+
+        Pagination uses a keyset (created_at, id) cursor rather than an
+        OFFSET, so each page is a single query using the (created_at, id)
+        index, however deep the cursor. Returns the page of messages and
+        the cursor for the next page (or None if this is the last page).
+        Raises ValueError if the cursor is invalid.
+
+        """
+        messages = (
+            self.filter(
+                models.Q(target=PersistentMessage.TargetType.ALL_USERS)
+                | self.user_target_query(user)
+            )
+            .filter(display_from__lte=tz_now())
+            .rollout(get_user_rollout_bucket(user))
+            .annotate(is_dismissed=_is_dismissed(user, tz_now()))
+            .order_by("-created_at", "-id")
+        )
+        if cursor:
+            created_at, pk = decode_cursor(cursor)
+            messages = messages.filter(
+                models.Q(created_at__lt=created_at)
+                | models.Q(created_at=created_at, id__lt=pk)
+            )
+        # fetch one extra message to find out if there's another page
+        page = [m.for_user(user) for m in messages[: limit + 1]]
+        if len(page) <= limit:
+            return page, None
+        page = page[:limit]
+        return page, encode_cursor(page[-1].created_at, page[-1].pk)
+
+    def rollout(self, bucket: int | None) -> models.QuerySet[PersistentMessage]:
+        """
+        Filter out messages whose rollout excludes the given bucket.
+
+        The bucket is evaluated against each message's percentage and salt
+        in the database - see rollout.py. If the bucket is None (anonymous
+        users without a rollout id) only messages with no rollout, or a
+        100% rollout, are included.
+
+        """
+        no_rollout = models.Q(rollout_percentage__isnull=True) | models.Q(
+            rollout_percentage__gte=ROLLOUT_BUCKETS
+        )
+        if bucket is None:
+            return self.filter(no_rollout)
+        return self.filter(
+            no_rollout
+            | models.Q(
+                rollout_percentage__gt=Mod(
+                    models.Value(bucket) + models.F("rollout_salt"), ROLLOUT_BUCKETS
+                )
+            )
+        )
+
+    def display_order(
+        self, limit: int | None = None
+    ) -> models.QuerySet[PersistentMessage]:
+        """Order by most important first, optionally limited to `limit` messages."""
+        messages = self.order_by(*DISPLAY_ORDER)
+        return messages[:limit] if limit else messages
 
     def filter_user(
-        self, user: settings.AUTH_USER_MODEL | AnonymousUser
+        self,
+        user: settings.AUTH_USER_MODEL | AnonymousUser,
+        limit: int | None = None,
+        rollout_id: str | None = None,
     ) -> models.QuerySet[PersistentMessage]:
         """
         Filter messages to those which should be shown to the given user.
@@ -63,54 +336,52 @@ class PersistentMessageQuerySet(models.QuerySet):
         that are targeted at the given user, or any group the user is a
         member of.
 
+        The messages are returned in display order (see `display_order`),
+        and if `limit` is set then the query is sliced - so the returned
+        queryset cannot be filtered any further.
+
+        Messages with a percentage rollout are only included if the user
+        falls within it (see rollout.py) - anonymous users are identified
+        by `rollout_id`, and only see rollouts if it is set.
+
         NB There is a built-in assumption in this method that there will
         never be a large number of undismissed messages for a given
         user, and so iterating through them is not a problem.
 
         """
-        messages = self.active()
+        # resolve from the read replica, if configured - see routing.py
+        queryset = self.using(alias) if (alias := db_for_read(user)) else self
+        messages = queryset.active().rollout(get_user_rollout_bucket(user, rollout_id))
 
         # filter on ALL_USERS messages as they are global
         all_filter = models.Q(target=PersistentMessage.TargetType.ALL_USERS)
 
         # custom user-attr filters - these need to be evaluated on the fly
-        custom_filter = self.custom_group_query(user)
+        custom_filter = queryset.custom_group_query(user)
 
         if user.is_anonymous:
             # filter on ALL_USERS messages as they are global
             anon_filter = models.Q(target=PersistentMessage.TargetType.ANONYMOUS_ONLY)
-            return messages.filter(all_filter | anon_filter | custom_filter)
+            return messages.filter(
+                all_filter | anon_filter | custom_filter
+            ).display_order(limit)
 
         # If the user is authenticated then we build up the message filter using
         # the following logic: all messages that are targeted at all users, or
         # all authenticated users apply; messaages that are targeted at specific
         # users or groups apply if the user is in the target list;
-        messages = messages.exclude(dismissed_by=user)
-
-        # filter on AUTHENTICATED_ONLY messages as we know the user is authenticated
-        auth_filter = models.Q(target=PersistentMessage.TargetType.AUTHENTICATED_ONLY)
-
-        # filter on messages targeted at the user
-        user_filter = models.Q(
-            target=PersistentMessage.TargetType.USERS_OR_GROUPS,
-            target_users=user,
-        )
+        messages = messages.exclude(_is_dismissed(user, tz_now()))
 
-        # filter on messages targeted at the user via a group they belong to.
-        # NB even though we are using another queryset in this filter, it's
-        # evaluated on the fly as part of the overall query - we don't do
-        # any extra queries here.
-        group_filter = models.Q(
-            target=PersistentMessage.TargetType.USERS_OR_GROUPS,
-            target_groups__in=user.groups.all(),
-        )
+        # filter on AUTHENTICATED_ONLY messages and those targeted at the user
+        if get_setting("COMPILED_AUDIENCES"):
+            target_filter = queryset.compiled_target_query(user)
+        else:
+            target_filter = self.user_target_query(user)
 
         # combine the filters together as an OR
-        or_filter = (
-            all_filter | auth_filter | user_filter | group_filter | custom_filter
-        )
+        or_filter = all_filter | target_filter | custom_filter
 
-        return messages.filter(or_filter)
+        return messages.filter(or_filter).display_order(limit)
 
 
 class PersistentMessageManager(models.Manager):
@@ -123,6 +394,66 @@ class PersistentMessageManager(models.Manager):
             obj.target_users.add(user)
         return obj
 
+    def create_for_users(
+        self,
+        user_ids: Iterable[int],
+        batch_size: int = TARGET_USERS_BATCH_SIZE,
+        **kwargs: Any,
+    ) -> PersistentMessage:
+        """
+        Create a single message targeted at each of the given user ids.
+
+        The user ids are streamed in chunks of `batch_size`, so this is
+        safe to call with a generator over a very large list of users.
+        This runs in a transaction, so if reading the ids fails part way
+        through - or one of the users doesn't exist (ValidationError) -
+        no message (or partial targeting) is left behind.
+
+        """
+        kwargs["target"] = PersistentMessage.TargetType.USERS_OR_GROUPS
+        with transaction.atomic():
+            obj = super().create(**kwargs)
+            obj.add_target_users(user_ids, batch_size=batch_size)
+        return obj
+
+    def bulk_create_for_users(
+        self,
+        objs: Iterable[PersistentMessage],
+        user_ids: Iterable[int],
+        batch_size: int = TARGET_USERS_BATCH_SIZE,
+    ) -> list[PersistentMessage]:
+        """
+        Create multiple messages, each targeted at all of the given user ids.
+
+        As `bulk_create` bypasses `save()` each message is validated
+        up front. The user ids are only iterated over once, with the
+        through rows for every message written a chunk at a time, all
+        in a single transaction. On backends where `bulk_create` can't
+        set the pks, the messages are saved one at a time instead.
+
+        """
+        instances = list(objs)
+        for obj in instances:
+            obj.target = PersistentMessage.TargetType.USERS_OR_GROUPS
+            obj.full_clean()
+        db = router.db_for_write(self.model)
+        with transaction.atomic(using=db):
+            if connections[db].features.can_return_rows_from_bulk_insert:
+                instances = self.bulk_create(instances)
+            else:
+                # bulk_create can't set the pks without RETURNING (e.g. MySQL)
+                for obj in instances:
+                    obj.save(using=db)
+            for chunk in chunked(user_ids, batch_size):
+                _check_user_ids(chunk)
+                _bulk_create_target_users(
+                    ((obj.pk, user_id) for obj in instances for user_id in chunk),
+                    batch_size=batch_size,
+                )
+        audiences.invalidate(obj.pk for obj in instances)
+        bump_message_version()
+        return instances
+
 
 class PersistentMessage(models.Model):
     """
@@ -143,12 +474,28 @@ class PersistentMessage(models.Model):
         ANONYMOUS_ONLY = "ANONYMOUS_USERS", "All anonymous users"
         USERS_OR_GROUPS = "USERS_OR_GROUPS", "Specific users or groups (inc. custom)"
 
+    key = models.SlugField(
+        max_length=100,
+        unique=True,
+        null=True,
+        blank=True,
+        help_text=_lazy(
+            "Stable identifier for messages managed by sync_persistent_messages."
+        ),
+    )
     content = models.TextField(blank=False)
 
     mark_content_safe = models.BooleanField(
         default=False,
         help_text=_lazy("Explicitly allow JS and/or HTML in this message."),
     )
+    is_template = models.BooleanField(
+        default=False,
+        help_text=_lazy(
+            "Fill in {placeholders} in the content with details of the user, "
+            "e.g. 'Hi {first_name}'."
+        ),
+    )
     level = models.IntegerField(
         default=messages.INFO,
         choices=LEVEL_TAG_CHOICES,
@@ -156,6 +503,28 @@ class PersistentMessage(models.Model):
             "The level of the message, mapped from django.contrib.messages.constants."
         ),
     )
+    priority = models.IntegerField(
+        default=0,
+        help_text=_lazy(
+            "Messages with a higher priority are shown first, regardless of level."
+        ),
+    )
+    rollout_percentage = models.PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        validators=[MaxValueValidator(ROLLOUT_BUCKETS)],
+        help_text=_lazy(
+            "Only show the message to this percentage of the targeted users "
+            "(leave blank to show it to all of them)."
+        ),
+    )
+    rollout_salt = models.PositiveSmallIntegerField(
+        default=_random_rollout_salt,
+        help_text=_lazy(
+            "Determines which users are in the rollout - change it to roll "
+            "the message out to a different set of users."
+        ),
+    )
     target = models.CharField(
         choices=TargetType.choices, default=TargetType.AUTHENTICATED_ONLY, max_length=50
     )
@@ -189,6 +558,21 @@ class PersistentMessage(models.Model):
         blank=True,
         null=True,
     )
+    is_recurring = models.BooleanField(
+        default=False,
+        editable=False,
+        help_text=_lazy(
+            "Set automatically if the message has recurring display windows."
+        ),
+    )
+    dismissal_ttl = models.DurationField(
+        null=True,
+        blank=True,
+        help_text=_lazy(
+            "Show the message again this long after a user dismisses it "
+            "(leave blank for dismissals to be permanent)."
+        ),
+    )
     is_dismissable = models.BooleanField(
         default=True,
         help_text=_lazy("Whether this message can be dismissed by the user."),
@@ -211,6 +595,15 @@ class PersistentMessage(models.Model):
 
     objects = PersistentMessageManager.from_queryset(PersistentMessageQuerySet)()
 
+    # the user that templated content is rendered for - see `for_user`
+    recipient: settings.AUTH_USER_MODEL | AnonymousUser | None = None
+
+    class Meta:
+        indexes = [
+            # used for keyset pagination of message history
+            models.Index(fields=["created_at", "id"], name="persistent_created_id_idx"),
+        ]
+
     def __str__(self) -> str:
         return self.message
 
@@ -220,6 +613,11 @@ class PersistentMessage(models.Model):
                 raise ValidationError(
                     _("Custom group not in settings.MESSAGE_CUSTOM_GROUPS")
                 )
+        if self.is_template:
+            try:
+                validate_content(self.content)
+            except ValueError as ex:
+                raise ValidationError({"content": str(ex)}) from ex
 
     def save(self, *args: Any, **kwargs: Any) -> None:
         self.full_clean()
@@ -227,9 +625,52 @@ class PersistentMessage(models.Model):
 
     @property
     def is_active(self) -> bool:
+        now = tz_now()
+        if self.is_recurring and not self.occurrences.current(now).exists():
+            return False
         if self.display_until:
-            return self.display_from <= tz_now() < self.display_until
-        return self.display_from <= tz_now()
+            return self.display_from <= now < self.display_until
+        return self.display_from <= now
+
+    def in_rollout(self, bucket: int | None) -> bool:
+        """Return True if the rollout includes the bucket - see `rollout()`."""
+        if self.rollout_percentage is None:
+            return True
+        if bucket is None:
+            return self.rollout_percentage >= ROLLOUT_BUCKETS
+        return (bucket + self.rollout_salt) % ROLLOUT_BUCKETS < self.rollout_percentage
+
+    def refresh_occurrences(self, horizon: int | None = None) -> int:
+        """
+        Recompute the upcoming occurrences of the recurring display windows.
+
+        Occurrences are precomputed for the next `horizon` days (default
+        PERSISTENT_MESSAGES_OCCURRENCE_HORIZON_DAYS), which means that this
+        must be called periodically (see the `refresh_message_occurrences`
+        management command) to keep them topped up. It is called
+        automatically whenever a window is changed. Returns the number of
+        occurrences created.
+
+        """
+        now = tz_now()
+        horizon = horizon or get_setting("OCCURRENCE_HORIZON_DAYS")
+        windows = list(self.recurring_windows.all())
+        occurrences = [
+            MessageOccurrence(message=self, starts_at=starts_at, ends_at=ends_at)
+            for window in windows
+            for starts_at, ends_at in window.get_occurrences(now, horizon)
+        ]
+        with transaction.atomic():
+            self.occurrences.all().delete()
+            MessageOccurrence.objects.bulk_create(occurrences, ignore_conflicts=True)
+            if self.is_recurring != bool(windows):
+                self.is_recurring = bool(windows)
+                PersistentMessage.objects.filter(pk=self.pk).update(
+                    is_recurring=self.is_recurring
+                )
+        # bulk operations don't fire signals, so invalidate explicitly
+        bump_message_version()
+        return len(occurrences)
 
     # === properties added for compatibility with the messages framework ===
     @property
@@ -243,12 +684,29 @@ class PersistentMessage(models.Model):
     @property
     def message(self) -> str:
         """Return the message content, with HTML escaped if required."""
+        content = self.content
+        if self.is_template:
+            content = render_content(content, self.recipient, self.mark_content_safe)
         if self.mark_content_safe:
-            return mark_safe(self.content)  # noqa: S308
-        return self.content
+            return mark_safe(content)  # noqa: S308
+        return content
 
     # /=== properties added for compatibility with the messages framework ===
 
+    def for_user(
+        self, user: settings.AUTH_USER_MODEL | AnonymousUser
+    ) -> PersistentMessage:
+        """
+        Set the user that templated content is rendered for, returning self.
+
+        The placeholders in templated content (see content.py) are left
+        blank unless this has been called - which is done for the messages
+        returned by `get_persistent_messages` and `history`.
+
+        """
+        self.recipient = user
+        return self
+
     @property
     def id_tag(self) -> str:
         """Return a unique pmid-* tag that is added to extra_tags."""
@@ -285,14 +743,60 @@ class PersistentMessage(models.Model):
         """
         Dismiss this message for the given user.
 
-        If the message is not dismissable, raises an exception.
+        If the message is not dismissable, raises an exception. If the
+        user has dismissed it before (i.e. the dismissal has expired - see
+        `dismissal_ttl`) then the dismissal time is reset.
 
         """
         if user.is_anonymous:
             return
         if not self.is_dismissable:
             raise UndismissableMessage
-        self.dismissed_by.add(user)
+        now = tz_now()
+        # write by id to the primary database, as this message may have
+        # been read from a replica - see routing.py. NB not update_or_create,
+        # whose SELECT ... FOR UPDATE is a no-op on SQLite - where upgrading
+        # its read transaction to a write fails at once ("database is
+        # locked") if another connection is writing.
+        dismissal, created = MessageDismissal.objects.using(
+            router.db_for_write(MessageDismissal)
+        ).get_or_create(
+            user_id=user.pk, message_id=self.pk, defaults={"dismissed_at": now}
+        )
+        if not created:
+            dismissal.dismissed_at = now
+            dismissal.save(update_fields=["dismissed_at"])
+        mark_recent_write([user.pk])
+
+    def add_target_users(
+        self, user_ids: Iterable[int], batch_size: int = TARGET_USERS_BATCH_SIZE
+    ) -> int:
+        """
+        Add users to target_users in batches, returning the number of ids read.
+
+        Unlike `target_users.add()`, which checks for existing rows
+        before inserting, this writes the through table rows directly
+        using `bulk_create`, ignoring any that already exist. The ids
+        are consumed `batch_size` at a time and never held in memory
+        all at once. NB the count includes any users that were already
+        targeted.
+
+        Raises ValidationError if any of the users don't exist - as this
+        runs in a transaction, no users are added in that case.
+
+        """
+        count = 0
+        with transaction.atomic():
+            for chunk in chunked(user_ids, batch_size):
+                _check_user_ids(chunk)
+                _bulk_create_target_users(
+                    ((self.pk, user_id) for user_id in chunk), batch_size=batch_size
+                )
+                count += len(chunk)
+        # bulk_create doesn't fire m2m_changed, so invalidate explicitly
+        audiences.invalidate([self.pk])
+        bump_message_version()
+        return count
 
     def deactivate(self) -> None:
         """Deactivate by setting the display_until property to now."""
@@ -305,9 +809,330 @@ class PersistentMessage(models.Model):
         self.save()
 
     def user_in_custom_group(self, user: settings.AUTH_USER_MODEL) -> bool:
+        """Return True if the user is in the custom group - see custom_groups.py."""
         if not self.target_custom_group:
             return False
-        return settings.MESSAGE_CUSTOM_GROUPS[self.target_custom_group](user)
+        return in_custom_group(self.target_custom_group, user)
+
+
+def _m2m_attnames(field: models.ManyToManyField) -> tuple[str, str]:
+    """
+    Return the through table (source, target) FK attnames for an M2M field.
+
+    These are resolved dynamically as they depend on the model names, and
+    for user relations the model name depends on AUTH_USER_MODEL.
+
+    """
+    return f"{field.m2m_field_name()}_id", f"{field.m2m_reverse_field_name()}_id"
+
+
+def _check_user_ids(user_ids: list[int]) -> None:
+    """Raise ValidationError if any of the user ids don't exist."""
+    found = set(
+        get_user_model().objects.filter(pk__in=user_ids).values_list("pk", flat=True)
+    )
+    if missing := set(user_ids) - found:
+        raise ValidationError(_("Unknown user ids: %(ids)s") % {"ids": sorted(missing)})
+
+
+def _bulk_create_target_users(
+    pairs: Iterable[tuple[int, int]], batch_size: int
+) -> None:
+    """Write (message_id, user_id) pairs directly to the target_users table."""
+    field = PersistentMessage.target_users.field
+    through = field.remote_field.through
+    message_attname, user_attname = _m2m_attnames(field)
+    through.objects.bulk_create(
+        [
+            through(**{message_attname: message_id, user_attname: user_id})
+            for message_id, user_id in pairs
+        ],
+        batch_size=batch_size,
+        ignore_conflicts=True,
+    )
+
+
+class _BatchResolver:
+    """
+    Resolve the messages for many users at once - see `for_users`.
+
+    The active messages and their target groups are loaded up front, and
+    then each chunk of users costs a fixed number of queries (target
+    users, group memberships, dismissals and - if there are any custom
+    group messages - the users themselves), regardless of chunk size.
+
+    """
+
+    def __init__(self, messages: list[PersistentMessage]) -> None:
+        self.messages = messages
+        self.targeted = [
+            m
+            for m in messages
+            if m.target == PersistentMessage.TargetType.USERS_OR_GROUPS
+        ]
+        self.targeted_ids = [m.id for m in self.targeted]
+        self.custom = [m for m in self.targeted if m.target_custom_group]
+        if get_setting("COMPILED_AUDIENCES"):
+            audiences.sync()
+        # group_id -> ids of messages that target the group
+        self.group_targets: dict[int, set[int]] = defaultdict(set)
+        field = PersistentMessage.target_groups.field
+        message_attname, group_attname = _m2m_attnames(field)
+        rows = field.remote_field.through.objects.filter(
+            **{f"{message_attname}__in": self.targeted_ids}
+        ).values_list(message_attname, group_attname)
+        for message_id, group_id in rows:
+            self.group_targets[group_id].add(message_id)
+
+    def _target_users(self, user_ids: list[int]) -> dict[int, set[int]]:
+        """Return user_id -> ids of messages that target the user directly."""
+        if get_setting("COMPILED_AUDIENCES"):
+            return _group_pairs(
+                (user_id, message_id)
+                for message_id in self.targeted_ids
+                for user_id in user_ids
+                if audiences.get(message_id).has_user(user_id)
+            )
+        field = PersistentMessage.target_users.field
+        message_attname, user_attname = _m2m_attnames(field)
+        rows = field.remote_field.through.objects.filter(
+            **{
+                f"{message_attname}__in": self.targeted_ids,
+                f"{user_attname}__in": user_ids,
+            }
+        ).values_list(user_attname, message_attname)
+        return _group_pairs(rows)
+
+    def _group_memberships(self, user_ids: list[int]) -> dict[int, set[int]]:
+        """Return user_id -> ids of the user's groups that are targeted."""
+        if not self.group_targets:
+            return {}
+        field = get_user_model().groups.field
+        user_attname, group_attname = _m2m_attnames(field)
+        rows = field.remote_field.through.objects.filter(
+            **{
+                f"{user_attname}__in": user_ids,
+                f"{group_attname}__in": list(self.group_targets),
+            }
+        ).values_list(user_attname, group_attname)
+        return _group_pairs(rows)
+
+    def _dismissals(self, user_ids: list[int]) -> dict[int, set[int]]:
+        """Return user_id -> ids of messages the user has (still) dismissed."""
+        now = tz_now()
+        ttls = {m.id: m.dismissal_ttl for m in self.messages}
+        rows = MessageDismissal.objects.filter(
+            user_id__in=user_ids, message_id__in=list(ttls)
+        ).values_list("user_id", "message_id", "dismissed_at")
+        return _group_pairs(
+            (user_id, message_id)
+            for user_id, message_id, dismissed_at in rows
+            if ttls[message_id] is None or dismissed_at > now - ttls[message_id]
+        )
+
+    def _custom_groups(self, user_ids: list[int]) -> dict[int, set[int]]:
+        """Return user_id -> ids of custom group messages that match the user."""
+        if not self.custom:
+            return {}
+        custom_groups = {m.target_custom_group for m in self.custom}
+        matched = {}
+        for user in get_user_model().objects.filter(pk__in=user_ids):
+            groups = match_custom_groups(custom_groups, user)
+            matched[user.pk] = {
+                m.id for m in self.custom if m.target_custom_group in groups
+            }
+        return matched
+
+    def _is_targeted(self, message: PersistentMessage, targeted_ids: set[int]) -> bool:
+        if message.target == PersistentMessage.TargetType.USERS_OR_GROUPS:
+            return message.id in targeted_ids
+        return message.target in (
+            PersistentMessage.TargetType.ALL_USERS,
+            PersistentMessage.TargetType.AUTHENTICATED_ONLY,
+        )
+
+    def resolve(
+        self, user_ids: list[int]
+    ) -> Iterator[tuple[int, list[PersistentMessage]]]:
+        direct = self._target_users(user_ids)
+        groups = self._group_memberships(user_ids)
+        dismissed = self._dismissals(user_ids)
+        custom = self._custom_groups(user_ids)
+        for user_id in user_ids:
+            targeted_ids = direct.get(user_id, set()) | custom.get(user_id, set())
+            for group_id in groups.get(user_id, ()):
+                targeted_ids |= self.group_targets[group_id]
+            excluded_ids = dismissed.get(user_id, set())
+            bucket = get_rollout_bucket(USER_KEY.format(user_id=user_id))
+            yield user_id, [
+                m
+                for m in self.messages
+                if m.id not in excluded_ids
+                and self._is_targeted(m, targeted_ids)
+                and m.in_rollout(bucket)
+            ]
+
+
+def _group_pairs(rows: Iterable[tuple[int, int]]) -> dict[int, set[int]]:
+    """Convert (key, value) pairs into a dict of key -> set of values."""
+    grouped: dict[int, set[int]] = defaultdict(set)
+    for key, value in rows:
+        grouped[key].add(value)
+    return grouped
+
+
+class RecurringWindow(models.Model):
+    """
+    A weekly recurring window during which a message is displayed.
+
+    e.g. "every Sunday from 02:00 for 2 hours". Times are in the default
+    time zone (settings.TIME_ZONE). The windows are expanded into concrete
+    MessageOccurrence rows so that they never need to be evaluated when
+    resolving messages.
+
+    """
+
+    class Weekday(models.IntegerChoices):
+        MONDAY = 0, _lazy("Monday")
+        TUESDAY = 1, _lazy("Tuesday")
+        WEDNESDAY = 2, _lazy("Wednesday")
+        THURSDAY = 3, _lazy("Thursday")
+        FRIDAY = 4, _lazy("Friday")
+        SATURDAY = 5, _lazy("Saturday")
+        SUNDAY = 6, _lazy("Sunday")
+
+    message = models.ForeignKey(
+        PersistentMessage,
+        on_delete=models.CASCADE,
+        related_name="recurring_windows",
+    )
+    weekday = models.IntegerField(choices=Weekday.choices)
+    start_time = models.TimeField(
+        help_text=_lazy("Time of day the window starts (in the site time zone).")
+    )
+    duration = models.DurationField(
+        help_text=_lazy("How long the window lasts - may run past midnight.")
+    )
+
+    def __str__(self) -> str:
+        return f"{self.get_weekday_display()} {self.start_time} ({self.duration})"
+
+    def clean(self) -> None:
+        if self.duration is not None and not (
+            timedelta(0) < self.duration <= timedelta(days=7)
+        ):
+            raise ValidationError(_("Duration must be between 0 and 7 days"))
+
+    def get_occurrences(
+        self, since: datetime, horizon: int
+    ) -> Iterator[tuple[datetime, datetime]]:
+        """Yield (start, end) of each occurrence that ends between since and horizon."""
+        # NB not the active time zone, which may be set per user (e.g. for
+        # the admin editing the window) - see settings.TIME_ZONE
+        tz = get_default_timezone()
+        today = localtime(since, tz).date()
+        # start a week back to catch any window that is still running
+        for offset in range(-7, horizon + 1):
+            day: date = today + timedelta(days=offset)
+            if day.weekday() != self.weekday:
+                continue
+            starts_at = make_aware(datetime.combine(day, self.start_time), tz)
+            ends_at = starts_at + self.duration
+            if ends_at > since:
+                yield starts_at, ends_at
+
+
+class MessageOccurrenceQuerySet(models.QuerySet):
+    def current(self, now: datetime | None = None) -> models.QuerySet:
+        """Filter to occurrences that are running now."""
+        now = now or tz_now()
+        return self.filter(starts_at__lte=now, ends_at__gt=now)
+
+
+class MessageOccurrence(models.Model):
+    """
+    A concrete interval during which a recurring message is displayed.
+
+    These are precomputed from the RecurringWindow rows (see
+    `PersistentMessage.refresh_occurrences`) so that `active()` can use
+    a cheap indexed lookup.
+
+    """
+
+    message = models.ForeignKey(
+        PersistentMessage,
+        on_delete=models.CASCADE,
+        related_name="occurrences",
+    )
+    starts_at = models.DateTimeField()
+    ends_at = models.DateTimeField()
+
+    objects = MessageOccurrenceQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ("message", "starts_at")
+        indexes = [
+            models.Index(
+                fields=["starts_at", "ends_at"], name="persistent_occurrence_idx"
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.message_id}: {self.starts_at} - {self.ends_at}"
+
+
+class MessageDismissalQuerySet(models.QuerySet):
+    """
+    Queryset that invalidates cached messages on bulk operations.
+
+    Individual dismissals fire post_save / post_delete signals, which
+    invalidate the affected user's cached messages (see signals.py), but
+    the bulk operations don't fire any signals, and may affect any number
+    of users, so they bump the global message version instead.
+
+    """
+
+    def bulk_create(self, *args: Any, **kwargs: Any) -> list[MessageDismissal]:
+        objs = super().bulk_create(*args, **kwargs)
+        bump_message_version()
+        return objs
+
+    def bulk_update(self, *args: Any, **kwargs: Any) -> int:
+        count = super().bulk_update(*args, **kwargs)
+        bump_message_version()
+        return count
+
+    def update(self, **kwargs: Any) -> int:
+        count = super().update(**kwargs)
+        bump_message_version()
+        return count
+
+    def delete(self) -> tuple[int, dict[str, int]]:
+        deleted = super().delete()
+        bump_message_version()
+        return deleted
+
+    def expired(self) -> models.QuerySet[MessageDismissal]:
+        """Filter to dismissals that have passed their message's dismissal_ttl."""
+        return self.filter(
+            message__dismissal_ttl__isnull=False,
+            dismissed_at__lte=models.Value(tz_now())
+            - models.F("message__dismissal_ttl"),
+        )
+
+    def purge_expired(self, batch_size: int = PURGE_BATCH_SIZE) -> int:
+        """
+        Delete expired dismissals, `batch_size` at a time, returning the count.
+
+        Deleting in batches keeps each transaction (and the locks it holds)
+        small, so this is safe to run against a busy table.
+
+        """
+        count = 0
+        while ids := list(self.expired().values_list("id", flat=True)[:batch_size]):
+            self.filter(id__in=ids).delete()
+            count += len(ids)
+        return count
 
 
 class MessageDismissal(models.Model):
@@ -323,7 +1148,87 @@ class MessageDismissal(models.Model):
         on_delete=models.CASCADE,
         related_name="message_dismissals",
     )
-    dismissed_at = models.DateTimeField(auto_now_add=True)
+    dismissed_at = models.DateTimeField(default=tz_now)
+
+    objects = MessageDismissalQuerySet.as_manager()
 
     class Meta:
         unique_together = ("user", "message")
+        indexes = [
+            # covers the dismissal_ttl check in filter_user
+            models.Index(
+                fields=["user", "message", "dismissed_at"],
+                name="persistent_dismissal_idx",
+            ),
+        ]
+
+
+class MessageGenerationManager(models.Manager):
+    # there is only ever a single row in the table
+    SINGLETON_ID = 1
+
+    def get_value(self) -> int:
+        """Return the current generation, creating it if required."""
+        obj, _ = self.get_or_create(
+            id=self.SINGLETON_ID, defaults={"value": time.time_ns()}
+        )
+        return obj.value
+
+    def increment(self) -> None:
+        """Increment the current generation, creating it if required."""
+        updated = self.filter(id=self.SINGLETON_ID).update(
+            value=models.F("value") + 1, updated_at=tz_now()
+        )
+        if not updated:
+            self.get_value()
+
+
+class MessageGeneration(models.Model):
+    """
+    Shared version stamp of the set of messages.
+
+    Used as the version store if PERSISTENT_MESSAGES_VERSION_BACKEND is
+    "database" - see cache.get_message_version.
+
+    """
+
+    value = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = MessageGenerationManager()
+
+
+class MessageImpressions(models.Model):
+    """
+    Aggregated count of the number of times a message has been shown.
+
+    Impressions are counted in memory and flushed periodically (see
+    impressions.py), so there is one row per message per time bucket,
+    rather than one per page view. `viewers` is a HyperLogLog sketch of
+    the distinct viewers in the bucket (see sketch.py).
+
+    """
+
+    message = models.ForeignKey(
+        PersistentMessage,
+        on_delete=models.CASCADE,
+        related_name="impressions",
+    )
+    bucket_start = models.DateTimeField(
+        help_text=_lazy("The start of the time bucket the impressions fall in.")
+    )
+    count = models.PositiveBigIntegerField(default=0)
+    viewers = models.BinaryField(
+        help_text=_lazy("HyperLogLog sketch of the distinct viewers."),
+    )
+
+    class Meta:
+        verbose_name_plural = "Message impressions"
+        unique_together = ("message", "bucket_start")
+
+    def __str__(self) -> str:
+        return f"{self.message_id} @ {self.bucket_start}: {self.count}"
+
+    @property
+    def viewers_sketch(self) -> HyperLogLog:
+        return HyperLogLog.from_bytes(bytes(self.viewers))
@@ -0,0 +1,95 @@
+"""
+Deterministic percentage rollouts.
+
+A message with `rollout_percentage` set is only shown to that percentage
+of the users it targets. Each user is assigned to one of 100 buckets by
+hashing a stable key - their id if they are logged in, or a random id
+stored in a cookie if not - and a message is shown to the user if:
+
+    (bucket + message.rollout_salt) % 100 < message.rollout_percentage
+
+This can be evaluated in SQL (see `PersistentMessageQuerySet.rollout`)
+or in Python (see `PersistentMessage.in_rollout`). Increasing the
+percentage only ever adds users, so ramping up a rollout is a single
+field update, and the salt means that each message is rolled out to a
+different set of users.
+
+The cookie is set by `RolloutMiddleware`. Anonymous users without it
+are only shown messages with no rollout (or a 100% rollout).
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import uuid
+from typing import Callable
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpRequest, HttpResponse
+
+from .conf import get_setting
+
+ROLLOUT_BUCKETS = 100
+
+# attribute set on the request by RolloutMiddleware
+REQUEST_ATTR = "persistent_messages_rollout_id"
+
+# keys hashed to assign users to buckets
+USER_KEY = "user:{user_id}"
+ANONYMOUS_KEY = "anon:{rollout_id}"
+
+
+def get_rollout_bucket(key: str) -> int:
+    """Return the rollout bucket (0-99) for a stable key."""
+    digest = hashlib.md5(key.encode(), usedforsecurity=False).digest()
+    return int.from_bytes(digest[:4], "big") % ROLLOUT_BUCKETS
+
+
+def get_user_rollout_bucket(
+    user: settings.AUTH_USER_MODEL | AnonymousUser, rollout_id: str | None = None
+) -> int | None:
+    """Return the user's bucket - or None if they are anonymous with no id."""
+    if user.is_authenticated:
+        return get_rollout_bucket(USER_KEY.format(user_id=user.pk))
+    if rollout_id:
+        return get_rollout_bucket(ANONYMOUS_KEY.format(rollout_id=rollout_id))
+    return None
+
+
+def get_rollout_id(request: HttpRequest) -> str | None:
+    """Return the anonymous rollout id for the request (if any)."""
+    if rollout_id := getattr(request, REQUEST_ATTR, None):
+        return rollout_id
+    return request.COOKIES.get(get_setting("ROLLOUT_COOKIE_NAME"))
+
+
+def get_request_rollout_bucket(request: HttpRequest) -> int | None:
+    """Return the rollout bucket of the request user."""
+    return get_user_rollout_bucket(request.user, get_rollout_id(request))
+
+
+class RolloutMiddleware:
+    """Assign each anonymous visitor a random id, stored in a cookie."""
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]) -> None:
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        cookie_name = get_setting("ROLLOUT_COOKIE_NAME")
+        rollout_id = request.COOKIES.get(cookie_name)
+        if not rollout_id:
+            rollout_id = uuid.uuid4().hex
+            setattr(request, REQUEST_ATTR, rollout_id)
+        response = self.get_response(request)
+        if cookie_name not in request.COOKIES:
+            response.set_cookie(
+                cookie_name,
+                rollout_id,
+                max_age=get_setting("ROLLOUT_COOKIE_AGE"),
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
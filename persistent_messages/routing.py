@@ -0,0 +1,45 @@
+"""
+Routing of message resolution queries to a read replica.
+
+If PERSISTENT_MESSAGES_READ_DATABASE is set then the (read-only) queries
+used to resolve a user's messages are sent to that database alias. To
+avoid replication lag causing a just-dismissed message to reappear, a
+user who has recently written (e.g. dismissed a message) is marked in
+the cache for PERSISTENT_MESSAGES_RECENT_WRITE_TIMEOUT seconds, during
+which time their reads go to the primary database instead.
+
+"""
+
+from __future__ import annotations
+
+from typing import Iterable
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+
+from .cache import get_cache
+from .conf import get_setting
+
+RECENT_WRITE_KEY = "persistent_messages:recent_write:{user_id}"
+
+
+def mark_recent_write(user_ids: Iterable[int]) -> None:
+    """Route reads for the given users to the primary database for a while."""
+    if not get_setting("READ_DATABASE"):
+        return
+    get_cache().set_many(
+        {RECENT_WRITE_KEY.format(user_id=user_id): True for user_id in user_ids},
+        get_setting("RECENT_WRITE_TIMEOUT"),
+    )
+
+
+def db_for_read(user: settings.AUTH_USER_MODEL | AnonymousUser) -> str | None:
+    """Return the database alias to resolve the user's messages from, if set."""
+    if not (alias := get_setting("READ_DATABASE")):
+        return None
+    # anonymous users can't write, so can always use the replica
+    if user.is_authenticated and get_cache().get(
+        RECENT_WRITE_KEY.format(user_id=user.pk)
+    ):
+        return None
+    return alias
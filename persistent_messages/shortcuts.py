@@ -1,25 +1,77 @@
 from __future__ import annotations
 
-from functools import cache
+from itertools import chain
+from typing import Iterator
 
 from django.contrib.messages import get_messages
 from django.contrib.messages.storage.base import Message
 from django.http import HttpRequest
 
+from . import sources
+from .impressions import track_impressions
 from .models import PersistentMessage
+from .sorting import merge_messages
 
+# attribute used to store the persistent messages on the request
+REQUEST_ATTR = "_persistent_messages"
 
-@cache
-def get_persistent_messages(request: HttpRequest) -> list[PersistentMessage]:
-    """Return the persistent messages for the given user."""
-    return list(
-        PersistentMessage.objects.filter_user(request.user).active()
-        # order by most important first (CRITICAL -> DEBUG)
-        .order_by("-level", "-created_at")
-    )
 
+def get_persistent_messages(
+    request: HttpRequest,
+) -> list[PersistentMessage | sources.StaticMessage]:
+    """
+    Return the persistent messages for the given user.
 
-@cache
-def get_all_messages(request: HttpRequest) -> list[PersistentMessage | Message]:
-    """Return flash messages and persistent messages for the given user."""
-    return list(get_messages(request)) + get_persistent_messages(request)
+    Messages are read from each of the configured sources (see sources.py),
+    ordered by most important first (see `DISPLAY_ORDER`), and capped at
+    PERSISTENT_MESSAGES_MAX_DISPLAYED (in the query itself, for the
+    database). If impression tracking is enabled, the messages are
+    counted as seen. The result is stored on the request, so the
+    messages are only loaded once per request.
+
+    """
+    if (messages := get_loaded_messages(request)) is None:
+        messages = sources.get_messages(request)
+        # static messages have no id, and are not tracked
+        track_impressions(request, [m.id for m in messages if m.id])
+        setattr(request, REQUEST_ATTR, messages)
+    return messages
+
+
+def get_loaded_messages(
+    request: HttpRequest,
+) -> list[PersistentMessage | sources.StaticMessage] | None:
+    """Return the persistent messages if they have already been loaded, else None."""
+    return getattr(request, REQUEST_ATTR, None)
+
+
+def iter_all_messages(
+    request: HttpRequest, sort_by: str = ""
+) -> Iterator[PersistentMessage | sources.StaticMessage | Message]:
+    """
+    Lazily combine flash messages and persistent messages for the given user.
+
+    If sort_by is not set the flash messages are returned first, followed
+    by the persistent messages. If it is set (e.g. "-level" or
+    "-level,created_at") the two are merged into a single sorted stream -
+    see `sorting.merge_messages` - without building a combined list.
+
+    """
+    flash = get_messages(request)
+    persistent = get_persistent_messages(request)
+    if sort_by:
+        return merge_messages(flash, persistent, sort_by=sort_by)
+    return chain(flash, persistent)
+
+
+def get_all_messages(
+    request: HttpRequest, sort_by: str = ""
+) -> list[PersistentMessage | sources.StaticMessage | Message]:
+    """
+    Return flash messages and persistent messages for the given user.
+
+    NB the persistent messages are stored on the request (see above),
+    so calling this more than once per request doesn't query them again.
+
+    """
+    return list(iter_all_messages(request, sort_by))
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+from typing import Any
+
+from django.contrib.auth import get_user_model
+from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from .audience import audiences
+from .cache import bump_message_version, bump_user_versions, clear_user_group_ids
+from .export import schedule_export
+from .models import (
+    MessageDismissal,
+    PersistentMessage,
+    RecurringWindow,
+    _m2m_attnames,
+)
+
+
+def on_user_groups_changed(
+    sender: type[models.Model],
+    instance: models.Model,
+    action: str,
+    reverse: bool,
+    pk_set: set[int] | None,
+    **kwargs: Any,
+) -> None:
+    """Invalidate cached group ids when users are added to / removed from groups."""
+    user_ids: Any = []
+    if not reverse:
+        # user.groups.add(...) etc. - instance is the user
+        if action in ("post_add", "post_remove", "post_clear"):
+            user_ids = [instance.pk]
+    # group.user_set.add(...) etc. - instance is the group
+    elif action in ("post_add", "post_remove"):
+        user_ids = pk_set or []
+    elif action == "pre_clear":
+        # pk_set is not set for clear() so we need to look up the members
+        # before they are removed.
+        user_ids = list(instance.user_set.values_list("pk", flat=True))
+    if user_ids:
+        clear_user_group_ids(user_ids)
+        bump_user_versions(user_ids)
+
+
+def on_message_changed(sender: type[models.Model], **kwargs: Any) -> None:
+    """Invalidate cached output when a message or its targeting changes."""
+    if kwargs.get("action", "post_").startswith("post_"):
+        bump_message_version()
+        schedule_export()
+
+
+def on_audience_changed(
+    sender: type[models.Model],
+    instance: models.Model,
+    action: str,
+    reverse: bool,
+    pk_set: set[int] | None,
+    **kwargs: Any,
+) -> None:
+    """Keep compiled audiences in sync with target_users / target_groups."""
+    if sender is PersistentMessage.target_groups.through:
+        field, kind = PersistentMessage.target_groups.field, "groups"
+    else:
+        field, kind = PersistentMessage.target_users.field, "users"
+    if action == "pre_clear" and reverse:
+        # instance is the user / group - record the messages that target it
+        message_attname, target_attname = _m2m_attnames(field)
+        instance._persistent_messages_cleared = list(
+            sender.objects.filter(**{target_attname: instance.pk}).values_list(
+                message_attname, flat=True
+            )
+        )
+    elif action == "post_clear":
+        if reverse:
+            audiences.invalidate(getattr(instance, "_persistent_messages_cleared", []))
+        else:
+            audiences.invalidate([instance.pk])
+    elif action in ("post_add", "post_remove") and pk_set:
+        if reverse:
+            # instance is the user / group, pk_set the message ids
+            changes = {message_id: {instance.pk} for message_id in pk_set}
+        else:
+            changes = {instance.pk: pk_set}
+        for message_id, targets in changes.items():
+            delta = (targets, ()) if action == "post_add" else ((), targets)
+            audiences.update(message_id, **{kind: delta})
+
+
+def on_dismissal_changed(
+    sender: type[models.Model], instance: MessageDismissal, **kwargs: Any
+) -> None:
+    """Invalidate the user's cached messages when they (un)dismiss a message."""
+    # the message version is already bumped when the dismissal is deleted
+    # along with its message, or in bulk (see MessageDismissalQuerySet)
+    if isinstance(kwargs.get("origin"), (PersistentMessage, models.QuerySet)):
+        return
+    bump_user_versions([instance.user_id])
+
+
+def on_window_changed(
+    sender: type[models.Model], instance: RecurringWindow, **kwargs: Any
+) -> None:
+    """Recompute a message's occurrences when its recurring windows change."""
+    # nothing to do if the window is being deleted along with its message
+    if isinstance(kwargs.get("origin"), PersistentMessage):
+        return
+    instance.message.refresh_occurrences()
+    schedule_export()
+
+
+def connect_signals() -> None:
+    """Connect the app signal handlers - called from AppConfig.ready."""
+    user_model = get_user_model()
+    # custom user models may not use PermissionsMixin
+    if groups := getattr(user_model, "groups", None):
+        m2m_changed.connect(
+            on_user_groups_changed,
+            sender=groups.through,
+            dispatch_uid="persistent_messages.on_user_groups_changed",
+        )
+    post_save.connect(
+        on_message_changed,
+        sender=PersistentMessage,
+        dispatch_uid="persistent_messages.on_message_saved",
+    )
+    post_delete.connect(
+        on_message_changed,
+        sender=PersistentMessage,
+        dispatch_uid="persistent_messages.on_message_deleted",
+    )
+    post_save.connect(
+        on_dismissal_changed,
+        sender=MessageDismissal,
+        dispatch_uid="persistent_messages.on_dismissal_saved",
+    )
+    post_delete.connect(
+        on_dismissal_changed,
+        sender=MessageDismissal,
+        dispatch_uid="persistent_messages.on_dismissal_deleted",
+    )
+    post_save.connect(
+        on_window_changed,
+        sender=RecurringWindow,
+        dispatch_uid="persistent_messages.on_window_saved",
+    )
+    post_delete.connect(
+        on_window_changed,
+        sender=RecurringWindow,
+        dispatch_uid="persistent_messages.on_window_deleted",
+    )
+    # NB must be connected before on_message_changed, so that the audience
+    # version is always bumped before the message version - see audience.py
+    for through in (
+        PersistentMessage.target_users.through,
+        PersistentMessage.target_groups.through,
+    ):
+        m2m_changed.connect(
+            on_audience_changed,
+            sender=through,
+            dispatch_uid=f"persistent_messages.on_audience_changed.{through.__name__}",
+        )
+    # NB dismissed_by.add() etc. may affect many users, so invalidate everything
+    for through in (
+        PersistentMessage.target_users.through,
+        PersistentMessage.target_groups.through,
+        PersistentMessage.dismissed_by.through,
+    ):
+        m2m_changed.connect(
+            on_message_changed,
+            sender=through,
+            dispatch_uid=f"persistent_messages.on_targets_changed.{through.__name__}",
+        )
@@ -0,0 +1,98 @@
+"""
+Sorting and merging of mixed flash / persistent messages.
+
+Messages may be PersistentMessage objects, contrib.messages Message
+objects, or serialized dicts. A sort spec is a comma-separated list of
+attribute names, each optionally prefixed with "-" for descending order,
+e.g. "-level,created_at".
+
+"""
+
+from __future__ import annotations
+
+import heapq
+from typing import Any, Iterable, Iterator, Sequence, TypeVar
+
+T = TypeVar("T")
+
+
+class _Reversed:
+    """Wrap a value so that it sorts in reverse order within a key tuple."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Reversed) and self.value == other.value
+
+    def __lt__(self, other: _Reversed) -> bool:
+        return other.value < self.value
+
+
+def parse_sort_spec(sort_by: str) -> list[tuple[str, bool]]:
+    """Convert "-level,created_at" into [("level", True), ("created_at", False)]."""
+    fields = [f.strip() for f in (sort_by or "level").split(",") if f.strip()]
+    return [(f.lstrip("-"), f.startswith("-")) for f in fields]
+
+
+def sort_key(message: Any, spec: Sequence[tuple[str, bool]]) -> tuple:
+    """
+    Return the sort key tuple for a message.
+
+    This will fail hard if the message has no such attribute (or key,
+    in the case of a dict).
+
+    """
+    values = []
+    for field, descending in spec:
+        if isinstance(message, dict):
+            value = message[field]
+        else:
+            value = getattr(message, field)
+        values.append(_Reversed(value) if descending else value)
+    return tuple(values)
+
+
+def _decorate(messages: Iterable[T], spec: Sequence[tuple[str, bool]]) -> list:
+    # the index keeps the sort stable, and ensures that the messages
+    # themselves are never compared.
+    return [(sort_key(m, spec), i, m) for i, m in enumerate(messages)]
+
+
+def _is_sorted(decorated: list) -> bool:
+    return all(not (b[0] < a[0]) for a, b in zip(decorated, decorated[1:]))
+
+
+def sort_messages(messages: Iterable[T], sort_by: str) -> list[T]:
+    """Return messages sorted by sort_by, computing each key only once."""
+    decorated = _decorate(messages, parse_sort_spec(sort_by))
+    decorated.sort()
+    return [m for _, _, m in decorated]
+
+
+def merge_messages(*sources: Iterable[T], sort_by: str) -> Iterator[T]:
+    """
+    Lazily merge multiple sources of messages into a single sorted stream.
+
+    Each source is expected to be small (a page of flash or persistent
+    messages), and will often already be sorted - e.g. persistent messages
+    come from the database in display order - so rather than sorting the
+    combined list, each source is only sorted if it needs to be, and the
+    results are merged. All of the keys are computed up front, on the
+    first iteration (so any errors surface immediately), but the merged
+    output is produced one message at a time.
+
+    Messages that compare equal are returned in source order.
+
+    """
+    spec = parse_sort_spec(sort_by)
+    decorated_sources = []
+    for n, source in enumerate(sources):
+        decorated = [(k, n, i, m) for k, i, m in _decorate(source, spec)]
+        if not _is_sorted(decorated):
+            decorated.sort()
+        decorated_sources.append(decorated)
+    for *_, message in heapq.merge(*decorated_sources):
+        yield message
@@ -0,0 +1,302 @@
+"""
+Pluggable sources of persistent messages.
+
+`get_persistent_messages` combines the messages from each of the sources
+listed in PERSISTENT_MESSAGES_SOURCES (dotted paths to MessageSource
+classes), merged in display order. The default is just the database:
+
+    PERSISTENT_MESSAGES_SOURCES = ["persistent_messages.sources.DatabaseSource"]
+
+Messages that are effectively static config (legal notices, the cookie
+banner, etc.) can instead be defined in settings, or in a JSON / YAML
+file, by adding "persistent_messages.sources.StaticSource":
+
+    PERSISTENT_MESSAGES_STATIC_MESSAGES = [
+        {
+            "key": "cookies",
+            "content": "We use cookies",
+            "level": "info",
+            "target": "ANONYMOUS_USERS",
+        },
+    ]
+    PERSISTENT_MESSAGES_STATIC_MESSAGES_FILE = BASE_DIR / "messages.yaml"
+
+These are parsed once, when the app is loaded, into immutable
+StaticMessage objects, so they cost no queries to display. They cannot
+be dismissed, and can only be targeted at all / authenticated /
+anonymous users. YAML files require PyYAML to be installed.
+
+"""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, fields
+from datetime import datetime, timezone
+from functools import cache
+from pathlib import Path
+from typing import Any, ClassVar
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db.models import QuerySet
+from django.dispatch import receiver
+from django.http import HttpRequest
+from django.utils.module_loading import import_string
+from django.utils.safestring import mark_safe
+
+from .conf import get_setting
+from .models import DISPLAY_ORDER, LEVEL_TAGS, TAG_LEVELS, PersistentMessage
+from .rollout import get_rollout_id
+from .sorting import merge_messages
+
+# static messages sort after database messages of the same priority / level
+STATIC_CREATED_AT = datetime.min.replace(tzinfo=timezone.utc)
+
+# the static message targets - USERS_OR_GROUPS requires the database
+STATIC_TARGETS = (
+    PersistentMessage.TargetType.ALL_USERS,
+    PersistentMessage.TargetType.AUTHENTICATED_ONLY,
+    PersistentMessage.TargetType.ANONYMOUS_ONLY,
+)
+
+
+@dataclass(frozen=True)
+class StaticMessage:
+    """
+    An immutable, undismissable message defined in settings or a file.
+
+    This has the same interface as PersistentMessage as far as templates,
+    sorting and serialization are concerned - but has no id.
+
+    """
+
+    key: str
+    content: str
+    level: int = messages.INFO
+    priority: int = 0
+    target: str = str(PersistentMessage.TargetType.ALL_USERS)
+    mark_content_safe: bool = False
+    custom_tags: str = ""
+    created_at: datetime = STATIC_CREATED_AT
+
+    id: ClassVar[None] = None
+    pk: ClassVar[None] = None
+    is_dismissable: ClassVar[bool] = False
+    is_active: ClassVar[bool] = True
+
+    def __str__(self) -> str:
+        return f"Static message {self.key!r}"
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> StaticMessage:
+        """Create a message from a dict, raising ImproperlyConfigured if invalid."""
+        data = dict(data)
+        if unknown := set(data) - {f.name for f in fields(cls)}:
+            raise ImproperlyConfigured(f"Unknown static message fields: {unknown}")
+        if isinstance(level := data.get("level"), str):
+            if level not in TAG_LEVELS:
+                raise ImproperlyConfigured(f"Unknown static message level: {level}")
+            data["level"] = TAG_LEVELS[level]
+        if data.get("target", STATIC_TARGETS[0]) not in STATIC_TARGETS:
+            raise ImproperlyConfigured(
+                f"Invalid static message target: {data['target']}"
+            )
+        try:
+            return cls(**data)
+        except TypeError as ex:
+            raise ImproperlyConfigured(f"Invalid static message: {ex}") from ex
+
+    @property
+    def tags(self) -> str:
+        return " ".join(tag for tag in [self.extra_tags, self.level_tag] if tag)
+
+    @property
+    def level_tag(self) -> str:
+        return LEVEL_TAGS.get(self.level, "")
+
+    @property
+    def message(self) -> str:
+        """Return the message content, with HTML escaped if required."""
+        if self.mark_content_safe:
+            return mark_safe(self.content)  # noqa: S308
+        return self.content
+
+    @property
+    def extra_tags(self) -> str:
+        safe = "safe" if self.mark_content_safe else "unsafe"
+        all_tags = dict.fromkeys(
+            ["persistent", "undismissable", safe] + self.custom_tags.split()
+        )
+        return " ".join(all_tags.keys())
+
+    def dismiss_url(self) -> str:
+        return ""
+
+    def is_visible_to(self, user: settings.AUTH_USER_MODEL | AnonymousUser) -> bool:
+        target = PersistentMessage.TargetType(self.target)
+        if target == PersistentMessage.TargetType.AUTHENTICATED_ONLY:
+            return user.is_authenticated
+        if target == PersistentMessage.TargetType.ANONYMOUS_ONLY:
+            return user.is_anonymous
+        return True
+
+
+class MessageSource:
+    """Base class for message sources."""
+
+    def get_messages(self, request: HttpRequest) -> list:
+        """Return the messages for the request user, in display order."""
+        raise NotImplementedError
+
+    # the following can be overridden to avoid loading all of the messages
+
+    def count_messages(self, request: HttpRequest) -> int:
+        """Return the number of messages for the request user."""
+        return len(self.get_messages(request))
+
+    def has_messages(self, request: HttpRequest) -> bool:
+        """Return True if there are any messages for the request user."""
+        return self.count_messages(request) > 0
+
+    def get_first_message(self, request: HttpRequest) -> Any:
+        """Return the first message (in display order), or None."""
+        return next(iter(self.get_messages(request)), None)
+
+
+class DatabaseSource(MessageSource):
+    """Messages stored in the database as PersistentMessage objects."""
+
+    # attribute used to store the user's queryset on the request
+    REQUEST_ATTR = "_persistent_messages_queryset"
+
+    def get_queryset(self, request: HttpRequest) -> QuerySet[PersistentMessage]:
+        """
+        Return the user's messages, building the queryset once per request.
+
+        Building it evaluates the custom group predicates (see
+        `custom_group_query`), so storing it on the request means that they
+        are only called once, however many of the methods below are used.
+
+        """
+        if (queryset := getattr(request, self.REQUEST_ATTR, None)) is None:
+            queryset = PersistentMessage.objects.filter_user(
+                request.user,
+                limit=get_setting("MAX_DISPLAYED"),
+                rollout_id=get_rollout_id(request),
+            )
+            setattr(request, self.REQUEST_ATTR, queryset)
+        return queryset
+
+    def get_messages(self, request: HttpRequest) -> list[PersistentMessage]:
+        return [m.for_user(request.user) for m in self.get_queryset(request)]
+
+    def count_messages(self, request: HttpRequest) -> int:
+        return self.get_queryset(request).count()
+
+    def has_messages(self, request: HttpRequest) -> bool:
+        return self.get_queryset(request).exists()
+
+    def get_first_message(self, request: HttpRequest) -> PersistentMessage | None:
+        if message := self.get_queryset(request).first():
+            return message.for_user(request.user)
+        return None
+
+
+def _load_file(path: Path) -> list[dict]:
+    if path.suffix in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError as ex:
+            raise ImproperlyConfigured(
+                "PyYAML is required to load static messages from YAML files"
+            ) from ex
+        with path.open() as f:
+            return yaml.safe_load(f) or []
+    with path.open() as f:
+        return json.load(f)
+
+
+def load_static_messages() -> list[StaticMessage]:
+    """
+    Parse the messages in PERSISTENT_MESSAGES_STATIC_MESSAGES(_FILE).
+
+    The messages are returned in display order. Raises ImproperlyConfigured
+    if any of them are invalid, or the keys are not unique.
+
+    """
+    data = list(get_setting("STATIC_MESSAGES"))
+    if path := get_setting("STATIC_MESSAGES_FILE"):
+        data += _load_file(Path(path))
+    static_messages = [StaticMessage.from_dict(d) for d in data]
+    keys = [m.key for m in static_messages]
+    if len(keys) != len(set(keys)):
+        raise ImproperlyConfigured("Static message keys must be unique")
+    return sorted(static_messages, key=lambda m: (-m.priority, -m.level))
+
+
+class StaticSource(MessageSource):
+    """Immutable messages defined in settings or a JSON / YAML file."""
+
+    def __init__(self) -> None:
+        self.messages = tuple(load_static_messages())
+
+    def get_messages(self, request: HttpRequest) -> list[StaticMessage]:
+        return [m for m in self.messages if m.is_visible_to(request.user)]
+
+
+@cache
+def get_sources() -> list[MessageSource]:
+    """Return the (cached) configured message sources."""
+    return [import_string(path)() for path in get_setting("SOURCES")]
+
+
+@receiver(setting_changed)
+def _clear_sources(setting: str, **kwargs: Any) -> None:
+    if setting.startswith(
+        ("PERSISTENT_MESSAGES_SOURCES", "PERSISTENT_MESSAGES_STATIC")
+    ):
+        get_sources.cache_clear()
+
+
+def get_messages(request: HttpRequest) -> list[PersistentMessage | StaticMessage]:
+    """
+    Return the messages for the request user from all of the sources.
+
+    The messages from each source are merged in display order (see
+    `DISPLAY_ORDER`) and capped at PERSISTENT_MESSAGES_MAX_DISPLAYED.
+
+    """
+    results = [source.get_messages(request) for source in get_sources()]
+    if len(results) == 1:
+        merged = results[0]
+    else:
+        merged = list(merge_messages(*results, sort_by=",".join(DISPLAY_ORDER)))
+    return merged[: get_setting("MAX_DISPLAYED")]
+
+
+def count_messages(request: HttpRequest) -> int:
+    """Return the number of messages `get_messages` would return, without them."""
+    count = sum(source.count_messages(request) for source in get_sources())
+    if (limit := get_setting("MAX_DISPLAYED")) is not None:
+        return min(count, limit)
+    return count
+
+
+def has_messages(request: HttpRequest) -> bool:
+    """Return True if `get_messages` would return any messages."""
+    return any(source.has_messages(request) for source in get_sources())
+
+
+def get_first_message(request: HttpRequest) -> PersistentMessage | StaticMessage | None:
+    """Return the first message `get_messages` would return (or None)."""
+    firsts = [
+        [message]
+        for source in get_sources()
+        if (message := source.get_first_message(request)) is not None
+    ]
+    merged = merge_messages(*firsts, sort_by=",".join(DISPLAY_ORDER))
+    return next(iter(merged), None)
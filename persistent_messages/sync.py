@@ -0,0 +1,327 @@
+"""
+Sync messages from a declarative file ("messages as code").
+
+Messages kept in version control can be pushed into each environment
+using the `sync_persistent_messages` management command. The file is a
+JSON or YAML list of messages, each with a unique `key`:
+
+    - key: maintenance
+      content: The site will be down for maintenance on Sunday
+      level: warning
+      priority: 10
+      target: USERS_OR_GROUPS
+      target_groups: [staff]
+      target_users: [alice, bob]
+      display_until: 2026-01-01T00:00:00Z
+
+Any of the fields in `SYNC_FIELDS` can be set. Fields that are not set
+revert to their defaults, apart from `display_from`, which is left as
+it is. Users are identified by their USERNAME_FIELD and groups by name.
+
+The file is diffed against the messages in the database with the same
+keys, and only the differences are written: new messages are created
+with a single `bulk_create`, changed messages with a single
+`bulk_update`, and the target users / groups are reconciled as sets,
+so that only the missing through rows are inserted and the extra ones
+deleted. Syncing the same file twice is a no-op. Messages with a key
+that are not in the file are deleted if `prune` is set; messages with
+no key (e.g. those created in the admin) are never touched.
+
+As the bulk operations don't fire any signals, the message version is
+bumped (and the compiled audiences invalidated) explicitly.
+
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterable
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.exceptions import ValidationError
+from django.db import connections, models, router, transaction
+from django.utils.timezone import now as tz_now
+
+from .audience import audiences
+from .cache import bump_message_version
+from .export import schedule_export
+from .models import TAG_LEVELS, PersistentMessage, _m2m_attnames
+from .sources import _load_file
+
+# the fields that can be set in the file
+SYNC_FIELDS = (
+    "content",
+    "mark_content_safe",
+    "is_template",
+    "level",
+    "priority",
+    "rollout_percentage",
+    "target",
+    "target_custom_group",
+    "display_from",
+    "display_until",
+    "dismissal_ttl",
+    "is_dismissable",
+    "custom_tags",
+)
+# fields that are left unchanged if not set, as their default is dynamic
+KEEP_IF_UNSET = ("display_from",)
+TARGET_FIELDS = ("target_users", "target_groups")
+
+
+@dataclass
+class MessageSpec:
+    """A single message, as declared in the file."""
+
+    key: str
+    values: dict[str, Any]
+    target_users: set[str]
+    target_groups: set[str]
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> MessageSpec:
+        """Parse and validate a message from the file, raising ValidationError."""
+        data = dict(data)
+        key = PersistentMessage._meta.get_field("key").clean(
+            data.pop("key", None), None
+        )
+        if not key:
+            raise ValidationError("Message is missing a key")
+        target_users = set(data.pop("target_users", None) or [])
+        target_groups = set(data.pop("target_groups", None) or [])
+        if unknown := set(data) - set(SYNC_FIELDS):
+            raise ValidationError(f"{key}: unknown fields {sorted(unknown)}")
+        if isinstance(level := data.get("level"), str):
+            if level not in TAG_LEVELS:
+                raise ValidationError(f"{key}: unknown level {level!r}")
+            data["level"] = TAG_LEVELS[level]
+        values = _clean_values(key, data)
+        # model-level validation (e.g. custom groups) - NB this is cheap,
+        # unlike full_clean(), which queries the database for each message.
+        try:
+            PersistentMessage(**values).clean()
+        except ValidationError as ex:
+            raise ValidationError(f"{key}: {ex.messages[0]}") from ex
+        return cls(key, values, target_users, target_groups)
+
+
+def _clean_values(key: str, data: dict[str, Any]) -> dict[str, Any]:
+    """Return the cleaned SYNC_FIELDS values, using defaults for those not set."""
+    values = {}
+    for name in SYNC_FIELDS:
+        model_field = PersistentMessage._meta.get_field(name)
+        if name not in data and name in KEEP_IF_UNSET:
+            continue
+        try:
+            values[name] = model_field.clean(
+                data.get(name, model_field.get_default()), None
+            )
+        except ValidationError as ex:
+            raise ValidationError(f"{key}: {name}: {ex.messages[0]}") from ex
+    return values
+
+
+def load_message_specs(path: str | Path) -> list[MessageSpec]:
+    """Load the messages from a JSON / YAML file, raising ValidationError."""
+    specs = [MessageSpec.from_dict(d) for d in _load_file(Path(path))]
+    keys = [spec.key for spec in specs]
+    if len(keys) != len(set(keys)):
+        raise ValidationError("Message keys must be unique")
+    return specs
+
+
+@dataclass
+class SyncPlan:
+    """The changes required to bring the database in line with the file."""
+
+    create: list[PersistentMessage] = field(default_factory=list)
+    # message, names of the changed fields
+    update: list[tuple[PersistentMessage, list[str]]] = field(default_factory=list)
+    delete: list[PersistentMessage] = field(default_factory=list)
+    # target field name -> key -> target ids to add / remove
+    add_targets: dict[str, dict[str, set[int]]] = field(
+        default_factory=lambda: {name: {} for name in TARGET_FIELDS}
+    )
+    remove_targets: dict[str, dict[str, set[int]]] = field(
+        default_factory=lambda: {name: {} for name in TARGET_FIELDS}
+    )
+    # key -> id of the existing messages
+    message_ids: dict[str, int] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return any(
+            [
+                self.create,
+                self.update,
+                self.delete,
+                *self.add_targets.values(),
+                *self.remove_targets.values(),
+            ]
+        )
+
+    def describe(self) -> list[str]:
+        """Return a line per changed message, for the dry-run report."""
+        lines = [f"+ {obj.key}" for obj in self.create]
+        lines += [f"~ {obj.key}: {', '.join(names)}" for obj, names in self.update]
+        lines += [f"- {obj.key}" for obj in self.delete]
+        for name in TARGET_FIELDS:
+            added, removed = self.add_targets[name], self.remove_targets[name]
+            for key in sorted(added.keys() | removed.keys()):
+                lines.append(
+                    f"~ {key}: {name} +{len(added.get(key, ()))} "
+                    f"-{len(removed.get(key, ()))}"
+                )
+        return lines
+
+
+def _resolve_targets(
+    model: type[models.Model], lookup: str, specs: list[MessageSpec], attr: str
+) -> dict[str, set[int]]:
+    """Return key -> target ids, looking up all of the names in one query."""
+    names = set().union(*(getattr(spec, attr) for spec in specs))
+    ids = dict(
+        model.objects.filter(**{f"{lookup}__in": names}).values_list(lookup, "pk")
+    )
+    if missing := names - ids.keys():
+        raise ValidationError(f"Unknown {attr}: {sorted(missing)}")
+    return {spec.key: {ids[name] for name in getattr(spec, attr)} for spec in specs}
+
+
+def _current_targets(name: str, message_ids: Iterable[int]) -> dict[int, set[int]]:
+    """Return message id -> current target ids for an M2M field."""
+    model_field = PersistentMessage._meta.get_field(name)
+    message_attname, target_attname = _m2m_attnames(model_field)
+    targets: dict[int, set[int]] = defaultdict(set)
+    for message_id, target_id in model_field.remote_field.through.objects.filter(
+        **{f"{message_attname}__in": message_ids}
+    ).values_list(message_attname, target_attname):
+        targets[message_id].add(target_id)
+    return targets
+
+
+def _diff_targets(plan: SyncPlan, specs: list[MessageSpec]) -> None:
+    """Add the target users / groups to add and remove to the plan."""
+    user_model = get_user_model()
+    desired = {
+        "target_users": _resolve_targets(
+            user_model, user_model.USERNAME_FIELD, specs, "target_users"
+        ),
+        "target_groups": _resolve_targets(Group, "name", specs, "target_groups"),
+    }
+    for name in TARGET_FIELDS:
+        current = _current_targets(name, plan.message_ids.values())
+        for spec in specs:
+            message_id = plan.message_ids.get(spec.key)
+            have = current.get(message_id, set()) if message_id else set()
+            want = desired[name][spec.key]
+            if added := want - have:
+                plan.add_targets[name][spec.key] = added
+            if removed := have - want:
+                plan.remove_targets[name][spec.key] = removed
+
+
+def plan_sync(specs: list[MessageSpec], prune: bool = False) -> SyncPlan:
+    """Diff the specs against the database, returning the changes to make."""
+    existing = {
+        obj.key: obj
+        for obj in PersistentMessage.objects.filter(key__isnull=False).order_by("id")
+    }
+    plan = SyncPlan(message_ids={key: obj.pk for key, obj in existing.items()})
+    for spec in specs:
+        if (obj := existing.get(spec.key)) is None:
+            plan.create.append(PersistentMessage(key=spec.key, **spec.values))
+            continue
+        if changed := [k for k, v in spec.values.items() if getattr(obj, k) != v]:
+            for name in changed:
+                setattr(obj, name, spec.values[name])
+            plan.update.append((obj, changed))
+    if prune:
+        keys = {spec.key for spec in specs}
+        plan.delete = [obj for key, obj in existing.items() if key not in keys]
+    _diff_targets(plan, specs)
+    return plan
+
+
+def _apply_targets(plan: SyncPlan, ids: dict[str, int]) -> set[int]:
+    """Insert / delete the through rows, returning the ids of the messages changed."""
+    changed_ids: set[int] = set()
+    for name in TARGET_FIELDS:
+        model_field = PersistentMessage._meta.get_field(name)
+        through = model_field.remote_field.through
+        message_attname, target_attname = _m2m_attnames(model_field)
+        through.objects.bulk_create(
+            [
+                through(**{message_attname: ids[key], target_attname: target_id})
+                for key, target_ids in plan.add_targets[name].items()
+                for target_id in target_ids
+            ],
+            ignore_conflicts=True,
+        )
+        removed = models.Q()
+        for key, target_ids in plan.remove_targets[name].items():
+            removed |= models.Q(
+                **{message_attname: ids[key], f"{target_attname}__in": target_ids}
+            )
+        if removed:
+            through.objects.filter(removed).delete()
+        changed_ids.update(
+            ids[key]
+            for key in plan.add_targets[name].keys() | plan.remove_targets[name].keys()
+        )
+    return changed_ids
+
+
+def _get_created_ids(created: list[PersistentMessage]) -> dict[str, int]:
+    """Return key -> id of the messages created by bulk_create."""
+    db = router.db_for_write(PersistentMessage)
+    if not created or connections[db].features.can_return_rows_from_bulk_insert:
+        return {obj.key: obj.pk for obj in created}
+    # bulk_create can't set the pks without RETURNING (e.g. MySQL), but
+    # the keys are unique, so read them back
+    return dict(
+        PersistentMessage.objects.using(db)
+        .filter(key__in=[obj.key for obj in created])
+        .values_list("key", "pk")
+    )
+
+
+def apply_sync(plan: SyncPlan) -> None:
+    """Write the changes in a plan to the database, in a single transaction."""
+    if not plan:
+        return
+    with transaction.atomic():
+        created = PersistentMessage.objects.bulk_create(plan.create)
+        created_ids = _get_created_ids(created)
+        if plan.update:
+            # bulk_update doesn't set auto_now fields
+            now = tz_now()
+            names = {"updated_at"}
+            for obj, changed in plan.update:
+                obj.updated_at = now
+                names.update(changed)
+            PersistentMessage.objects.bulk_update(
+                [obj for obj, _ in plan.update], sorted(names)
+            )
+        if plan.delete:
+            PersistentMessage.objects.filter(
+                pk__in=[obj.pk for obj in plan.delete]
+            ).delete()
+        changed_ids = _apply_targets(plan, {**plan.message_ids, **created_ids})
+        # bulk operations don't fire signals, so invalidate explicitly - NB
+        # the audience versions must be bumped before the message version.
+        audiences.invalidate(changed_ids)
+        transaction.on_commit(bump_message_version)
+        schedule_export()
+
+
+def sync_messages(
+    path: str | Path, prune: bool = False, dry_run: bool = False
+) -> SyncPlan:
+    """Sync the messages in a file to the database, returning the changes."""
+    plan = plan_sync(load_message_specs(path), prune=prune)
+    if not dry_run:
+        apply_sync(plan)
+    return plan
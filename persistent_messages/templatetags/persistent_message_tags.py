@@ -1,16 +1,39 @@
+import json
 import logging
-from datetime import datetime
-from typing import Iterable
+from typing import Callable, Iterable
 
 from django import template
 from django.conf import settings
+from django.contrib.messages import get_messages
 from django.contrib.messages.storage.base import Message
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpRequest
+from django.template.loader import render_to_string
+from django.utils.html import format_html
+from django.utils.safestring import SafeString, mark_safe
 
+from persistent_messages import sorting
+from persistent_messages.cache import get_cache, user_cache_key
+from persistent_messages.conf import get_setting
+from persistent_messages.impressions import track_impressions
 from persistent_messages.models import PersistentMessage
+from persistent_messages.rollout import get_request_rollout_bucket
+from persistent_messages.shortcuts import get_persistent_messages
+from persistent_messages.sources import StaticMessage
 
 register = template.Library()
 logger = logging.getLogger(__name__)
 
+DEFAULT_MESSAGES_TEMPLATE = "persistent_messages/messages.html"
+DEFAULT_JSON_ELEMENT_ID = "persistent-messages"
+
+# same escaping as django.utils.html.json_script
+JSON_SCRIPT_ESCAPES = {
+    ord(">"): "\\u003E",
+    ord("<"): "\\u003C",
+    ord("&"): "\\u0026",
+}
+
 
 def _serialize_message(message: Message) -> dict:
     tags = message.tags.split()
@@ -30,7 +53,7 @@ def _serialize_message(message: Message) -> dict:
     }
 
 
-def _serialize_persistent_message(message: PersistentMessage) -> dict:
+def _serialize_persistent_message(message: PersistentMessage | StaticMessage) -> dict:
     return {
         "pk": message.pk,
         "level": message.level,
@@ -46,8 +69,8 @@ def _serialize_persistent_message(message: PersistentMessage) -> dict:
 
 
 @register.filter("serialize_message")
-def serialize_message(message: PersistentMessage | Message) -> dict:
-    if isinstance(message, PersistentMessage):
+def serialize_message(message: PersistentMessage | StaticMessage | Message) -> dict:
+    if isinstance(message, (PersistentMessage, StaticMessage)):
         return _serialize_persistent_message(message)
     elif isinstance(message, Message):
         return _serialize_message(message)
@@ -65,24 +88,115 @@ def serialize_messages(messages: Iterable[PersistentMessage | Message]) -> list[
 @register.filter("sort_messages")
 def sort_messages(
     messages: Iterable[PersistentMessage | Message], sort_by: str = "level"
-) -> list[Message]:
-    sort_by = sort_by or "level"
-    reverse = sort_by.startswith("-")
+) -> list[PersistentMessage | Message]:
+    """
+    Sort messages by one or more comma-separated fields, e.g. "-level,message".
 
-    def key(message: PersistentMessage | Message | dict) -> str | int | datetime:
-        if isinstance(message, dict):
-            # will fail hard if the field doesn't exist
-            return message[sort_by.lstrip("-")]
-        return getattr(message, sort_by.lstrip("-"))
+    If the messages cannot be sorted (e.g. the field doesn't exist) then
+    the exception is raised if settings.DEBUG is set, else the messages
+    are returned unsorted.
 
+    """
+    # materialize once, so that the unsorted fallback works for generators
+    messages = list(messages)
     try:
-        return sorted(
-            messages,
-            key=key,
-            reverse=reverse,
-        )
+        return sorting.sort_messages(messages, sort_by)
     except Exception as ex:
         if settings.DEBUG:
             raise Exception(f"Error sorting messages: {ex}") from ex
         logger.warning("Error sorting messages - returning unsorted")
-        return list(messages)
+        return messages
+
+
+def _get_cached_output(
+    request: HttpRequest,
+    prefix: str,
+    build: Callable[[list[PersistentMessage | StaticMessage]], str],
+) -> str:
+    """
+    Return output built from the user's persistent messages, using the cache.
+
+    The ids of the messages are cached along with the output, so that
+    impressions can still be tracked when the output comes from the cache.
+
+    """
+
+    def get() -> tuple[list[int], str]:
+        messages = get_persistent_messages(request)
+        return [m.id for m in messages if m.id], build(messages)
+
+    if not (timeout := get_setting("FRAGMENT_CACHE_TIMEOUT")):
+        return get()[1]
+    key = user_cache_key(prefix, request.user, get_request_rollout_bucket(request))
+    message_ids, output = get_cache().get_or_set(key, get, timeout)
+    # a cache hit bypasses get_persistent_messages, so track impressions here
+    track_impressions(request, message_ids)
+    return output
+
+
+@register.simple_tag(takes_context=True)
+def persistent_messages(
+    context: template.Context, template_name: str = DEFAULT_MESSAGES_TEMPLATE
+) -> SafeString:
+    """
+    Render the persistent messages for the current user.
+
+    The output is cached for PERSISTENT_MESSAGES_FRAGMENT_CACHE_TIMEOUT
+    seconds, keyed on the message version, the user's own version (which
+    changes when they dismiss a message) and the active set signature -
+    so a cache hit requires neither a database query nor template
+    rendering. The template is passed `messages` and `request`.
+
+    NB messages targeted using a custom group are cached along with
+    the rest, so changes to the user attributes that the custom group
+    depends on will not be picked up until the cache expires.
+
+    """
+    request = context.get("request")
+    if request is None:
+        logger.warning("Unable to render persistent messages - no request found")
+        return mark_safe("")  # noqa: S308
+
+    def render(messages: list[PersistentMessage | StaticMessage]) -> str:
+        return render_to_string(
+            template_name, {"messages": messages, "request": request}
+        )
+
+    html = _get_cached_output(request, f"fragment:{template_name}", render)
+    return mark_safe(html)  # noqa: S308
+
+
+def _encode_messages(messages: Iterable[PersistentMessage | Message]) -> str:
+    """Return JSON array items (no brackets), escaped for use inside <script>."""
+    return ", ".join(
+        json.dumps(serialize_message(m), cls=DjangoJSONEncoder) for m in messages
+    ).translate(JSON_SCRIPT_ESCAPES)
+
+
+@register.simple_tag(takes_context=True)
+def persistent_messages_json(
+    context: template.Context, element_id: str = DEFAULT_JSON_ELEMENT_ID
+) -> SafeString:
+    """
+    Output all messages as JSON in a <script type="application/json"> tag.
+
+    The output is the same as `all_messages|serialize_messages|json_script`,
+    but the (escaped) JSON for the persistent messages is cached using
+    the same keys as the `persistent_messages` tag, and spliced together
+    with the flash messages for the current request - so only the flash
+    messages (if any) are encoded on each request.
+
+    """
+    request = context.get("request")
+    if request is None:
+        logger.warning("Unable to render persistent messages - no request found")
+        return mark_safe("")  # noqa: S308
+
+    persistent_json = _get_cached_output(request, "json", _encode_messages)
+    flash_json = _encode_messages(get_messages(request))
+    payload = ", ".join(part for part in (flash_json, persistent_json) if part)
+    return format_html(
+        '<script id="{}" type="application/json">{}</script>',
+        element_id,
+        mark_safe(f"[{payload}]"),  # noqa: S308
+    )
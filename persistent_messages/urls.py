@@ -6,4 +6,5 @@ app_name = "persistent_messages"
 
 urlpatterns = [
     path("dismiss/<int:message_id>/", views.dismiss_message, name="dismiss_message"),
+    path("history/", views.message_history, name="message_history"),
 ]
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import base64
+from datetime import datetime
+from itertools import islice
+from typing import Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[list[T]]:
+    """
+    Yield successive lists of at most `size` items from `iterable`.
+
+    The iterable is consumed lazily, so only one chunk is ever held in
+    memory - which means it's safe to pass in a generator over a very
+    large file or queryset.
+
+    """
+    if size < 1:
+        raise ValueError("Chunk size must be a positive integer.")
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def encode_cursor(created_at: datetime, pk: int) -> str:
+    """Return an opaque keyset pagination cursor for a (created_at, pk) pair."""
+    value = f"{created_at.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Decode a cursor created by encode_cursor, raising ValueError if invalid."""
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, pk = value.split("|")
+        return datetime.fromisoformat(created_at), int(pk)
+    except (TypeError, UnicodeError, ValueError) as ex:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from ex
@@ -1,16 +1,20 @@
 import logging
 
 from django.contrib.auth.decorators import login_required
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import require_GET, require_http_methods
 
 from .exceptions import PersistentMessageException
-from .models import PersistentMessage
+from .models import HISTORY_PAGE_SIZE, PersistentMessage
+from .templatetags.persistent_message_tags import serialize_message
 
 logger = logging.getLogger(__name__)
 
+# maximum number of messages that can be requested per page of history
+MAX_HISTORY_PAGE_SIZE = 100
+
 
 @csrf_exempt  # we're dismissing notifications, not deleting data
 @require_http_methods(["DELETE"])
@@ -38,3 +42,34 @@ def dismiss_message(request: HttpRequest, message_id: int) -> HttpResponse:
         logger.exception("Error dismissing persistent message %s", message_id)
         return HttpResponse(status=400)
     return HttpResponse(status=204)
+
+
+@require_GET
+@login_required
+def message_history(request: HttpRequest) -> HttpResponse:
+    """
+    Return a page of the current user's message history as JSON.
+
+    Accepts optional `cursor` (from the previous page's `next_cursor`)
+    and `limit` querystring params. Returns a 400 if either is invalid.
+
+    """
+    try:
+        limit = int(request.GET.get("limit", HISTORY_PAGE_SIZE))
+        if not 0 < limit <= MAX_HISTORY_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_HISTORY_PAGE_SIZE}")
+        messages, next_cursor = PersistentMessage.objects.history(
+            request.user, cursor=request.GET.get("cursor"), limit=limit
+        )
+    except ValueError as ex:
+        return JsonResponse({"error": str(ex)}, status=400)
+    return JsonResponse(
+        {
+            "messages": [
+                serialize_message(m)
+                | {"created_at": m.created_at, "is_dismissed": m.is_dismissed}
+                for m in messages
+            ],
+            "next_cursor": next_cursor,
+        }
+    )
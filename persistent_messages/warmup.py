@@ -0,0 +1,72 @@
+"""
+Cache warm-up, to avoid every fresh worker paying the cold-path cost.
+
+Enabled by setting PERSISTENT_MESSAGES_WARM_UP_ON_STARTUP, in which case
+`warm_up` is called from PersistentMessageConfig.ready(), or it can be
+run on demand using the `warm_persistent_messages` management command
+(which is only useful if the configured cache is shared).
+
+"""
+
+from __future__ import annotations
+
+import logging
+import warnings
+
+from django.contrib.auth.models import AnonymousUser
+from django.db import DatabaseError
+from django.http import HttpRequest
+from django.template import Context
+from django.template.loader import get_template
+
+from .audience import audiences
+from .cache import get_active_signature, get_message_version
+from .conf import get_setting
+from .impressions import skip_impressions
+
+logger = logging.getLogger(__name__)
+
+
+def _anonymous_request() -> HttpRequest:
+    request = HttpRequest()
+    request.user = AnonymousUser()
+    # warming up is not a real view of the messages
+    skip_impressions(request)
+    return request
+
+
+def warm_up() -> bool:
+    """
+    Preload the message version, active set and anonymous payloads.
+
+    If PERSISTENT_MESSAGES_COMPILED_AUDIENCES is set, all of the audiences
+    are compiled too, so the first authenticated request doesn't have to.
+    Returns True if the caches were warmed, or False if the database
+    was not available (e.g. the tables have not been created yet, or
+    we're running a management command without a database) - in which
+    case the warm-up is skipped rather than raising an exception.
+
+    """
+    from .templatetags.persistent_message_tags import (
+        DEFAULT_MESSAGES_TEMPLATE,
+        persistent_messages,
+        persistent_messages_json,
+    )
+
+    try:
+        with warnings.catch_warnings():
+            # "Accessing the database during app initialization is discouraged"
+            warnings.simplefilter("ignore", RuntimeWarning)
+            get_message_version()
+            get_active_signature()
+            get_template(DEFAULT_MESSAGES_TEMPLATE)
+            context = Context({"request": _anonymous_request()})
+            persistent_messages(context)
+            persistent_messages_json(context)
+            if get_setting("COMPILED_AUDIENCES"):
+                audiences.compile_all()
+    except DatabaseError as ex:
+        logger.warning("Unable to warm up persistent messages - %s", ex)
+        return False
+    logger.debug("Persistent messages caches warmed up")
+    return True
@@ -1,6 +1,10 @@
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from pytest import fixture
 
+from persistent_messages.audience import audiences
+from persistent_messages.cache import _local_version
+from persistent_messages.custom_groups import reset_breakers
 from persistent_messages.models import PersistentMessage
 
 
@@ -12,3 +16,12 @@ def pm() -> PersistentMessage:
 @fixture
 def user() -> User:
     return User.objects.create_user(username="testuser", password="testpassword")
+
+
+@fixture(autouse=True)
+def clear_cache() -> None:
+    cache.clear()
+    # force the process-local message version to be re-read
+    _local_version.value = None
+    audiences.clear()
+    reset_breakers()
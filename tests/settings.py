@@ -4,7 +4,11 @@ DEBUG = True
 TEMPLATE_DEBUG = True
 USE_TZ = True
 
-DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": "test.db"}}
+DATABASES = {
+    "default": {"ENGINE": "django.db.backends.sqlite3", "NAME": "test.db"},
+    # used to test PERSISTENT_MESSAGES_READ_DATABASE
+    "replica": {"ENGINE": "django.db.backends.sqlite3", "NAME": "replica.db"},
+}
 
 INSTALLED_APPS = (
     "django.contrib.admin",
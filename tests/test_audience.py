@@ -0,0 +1,125 @@
+import pytest
+from django.contrib.auth.models import Group, User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from persistent_messages.audience import Audience, audiences
+from persistent_messages.cache import bump_audience_version, bump_message_version
+from persistent_messages.models import PersistentMessage
+
+
+class TestAudience:
+    def test_includes(self) -> None:
+        audience = Audience([5, 1, 3, 3], [10], version=1)
+        assert list(audience.user_ids) == [1, 3, 5]
+        assert audience.includes(3, [])
+        assert not audience.includes(4, [11])
+        assert audience.includes(4, [11, 10])
+        assert audience.nbytes == 24
+
+    @pytest.mark.parametrize("size", [1, 500])
+    def test_update_users(self, size: int) -> None:
+        audience = Audience([1, 3, 5], [], version=1)
+        added = {2 * i for i in range(size)}
+        audience.update_users(added, [3])
+        assert list(audience.user_ids) == sorted(added | {1, 5})
+
+    def test_update_groups(self) -> None:
+        audience = Audience([], [1, 2], version=1)
+        audience.update_groups([3], [1])
+        assert audience.group_ids == {2, 3}
+
+
+@pytest.mark.django_db
+class TestCompiledAudiences:
+    @pytest.fixture(autouse=True)
+    def compiled(self, settings) -> None:
+        settings.PERSISTENT_MESSAGES_COMPILED_AUDIENCES = True
+
+    @pytest.fixture
+    def group(self, user: User) -> Group:
+        group = Group.objects.create(name="group")
+        user.groups.add(group)
+        return group
+
+    @pytest.fixture
+    def messages(self, user: User, group: Group) -> list[PersistentMessage]:
+        TargetType = PersistentMessage.TargetType
+        PersistentMessage.objects.create(content="direct", user=user)
+        by_group = PersistentMessage.objects.create(
+            content="group", target=TargetType.USERS_OR_GROUPS
+        )
+        by_group.target_groups.add(group)
+        PersistentMessage.objects.create(
+            content="other", user=User.objects.create_user(username="other")
+        )
+        PersistentMessage.objects.create(content="auth")
+        return list(PersistentMessage.objects.all())
+
+    def resolve(self, user: User) -> list[str]:
+        return [m.content for m in PersistentMessage.objects.filter_user(user)]
+
+    def test_filter_user(self, settings, user: User, messages: list) -> None:
+        compiled = self.resolve(user)
+        assert sorted(compiled) == ["auth", "direct", "group"]
+        settings.PERSISTENT_MESSAGES_COMPILED_AUDIENCES = False
+        assert self.resolve(user) == compiled
+
+    def test_filter_user__no_joins(self, user: User, messages: list) -> None:
+        self.resolve(user)
+        through = PersistentMessage.target_users.through._meta.db_table
+        with CaptureQueriesContext(connection) as ctx:
+            self.resolve(user)
+        assert not any(through in q["sql"] for q in ctx.captured_queries)
+
+    def test_for_users(self, user: User, messages: list) -> None:
+        other = User.objects.get(username="other")
+        results = dict(PersistentMessage.objects.for_users([user.pk, other.pk]))
+        assert results[user.pk] == list(PersistentMessage.objects.filter_user(user))
+        assert [m.content for m in results[other.pk]] == ["auth", "other"]
+
+    def test_incremental_update(
+        self, user: User, messages: list, django_capture_on_commit_callbacks
+    ) -> None:
+        direct = messages[0]
+        self.resolve(user)
+        audience = audiences.get(direct.pk)
+        other = User.objects.get(username="other")
+        with django_capture_on_commit_callbacks(execute=True):
+            direct.target_users.add(other)
+        # patched in place, not recompiled
+        assert audiences.get(direct.pk) is audience
+        assert audience.has_user(other.pk)
+        assert "direct" in self.resolve(other)
+        with django_capture_on_commit_callbacks(execute=True):
+            other.persistent_messages.remove(direct)
+        assert not audience.has_user(other.pk)
+        assert "direct" not in self.resolve(other)
+
+    def test_clear(
+        self, user: User, messages: list, django_capture_on_commit_callbacks
+    ) -> None:
+        self.resolve(user)
+        with django_capture_on_commit_callbacks(execute=True):
+            user.persistent_messages.clear()
+        assert "direct" not in self.resolve(user)
+
+    def test_changed_elsewhere(self, user: User, messages: list) -> None:
+        direct = messages[0]
+        self.resolve(user)
+        # simulate a change made in another process
+        PersistentMessage.target_users.through.objects.filter(
+            persistentmessage=direct
+        ).delete()
+        bump_audience_version(direct.pk)
+        bump_message_version()
+        assert "direct" not in self.resolve(user)
+
+    def test_add_target_users(
+        self, user: User, messages: list, django_capture_on_commit_callbacks
+    ) -> None:
+        other = User.objects.get(username="other")
+        assert "direct" not in self.resolve(other)
+        with django_capture_on_commit_callbacks(execute=True):
+            messages[0].add_target_users([other.pk])
+        assert "direct" in self.resolve(other)
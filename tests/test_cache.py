@@ -0,0 +1,167 @@
+import time
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now as tz_now
+
+from persistent_messages.cache import (
+    MESSAGE_VERSION_KEY,
+    bump_message_version,
+    get_active_signature,
+    get_message_version,
+    get_user_group_ids,
+    get_user_version,
+)
+from persistent_messages.models import (
+    MessageDismissal,
+    MessageGeneration,
+    PersistentMessage,
+)
+
+
+@pytest.mark.django_db
+class TestUserGroupIds:
+    @pytest.fixture(autouse=True)
+    def enable_cache(self, settings) -> None:
+        settings.PERSISTENT_MESSAGES_CACHE_GROUP_IDS = True
+
+    @pytest.fixture
+    def group(self) -> Group:
+        return Group.objects.create(name="test")
+
+    def test_cached(self, user: User, group: Group) -> None:
+        user.groups.add(group)
+        assert get_user_group_ids(user) == [group.pk]
+        with CaptureQueriesContext(connection) as ctx:
+            assert get_user_group_ids(user) == [group.pk]
+        assert len(ctx) == 0
+
+    def test_uncached(self, settings, user: User, group: Group) -> None:
+        settings.PERSISTENT_MESSAGES_CACHE_GROUP_IDS = False
+        user.groups.add(group)
+        assert get_user_group_ids(user) == [group.pk]
+        with CaptureQueriesContext(connection) as ctx:
+            get_user_group_ids(user)
+        assert len(ctx) == 1
+
+    def test_invalidation(self, user: User, group: Group) -> None:
+        assert get_user_group_ids(user) == []
+        user.groups.add(group)
+        assert get_user_group_ids(user) == [group.pk]
+        user.groups.remove(group)
+        assert get_user_group_ids(user) == []
+        user.groups.add(group)
+        assert get_user_group_ids(user) == [group.pk]
+        user.groups.clear()
+        assert get_user_group_ids(user) == []
+
+    def test_invalidation__reverse(self, user: User, group: Group) -> None:
+        assert get_user_group_ids(user) == []
+        group.user_set.add(user)
+        assert get_user_group_ids(user) == [group.pk]
+        group.user_set.clear()
+        assert get_user_group_ids(user) == []
+
+    def test_filter_user(self, user: User, group: Group) -> None:
+        pm = PersistentMessage.objects.create(
+            content="Hello", target=PersistentMessage.TargetType.USERS_OR_GROUPS
+        )
+        pm.target_groups.add(group)
+        assert not PersistentMessage.objects.filter_user(user).exists()
+        user.groups.add(group)
+        assert PersistentMessage.objects.filter_user(user).get() == pm
+
+
+@pytest.mark.django_db
+class TestActiveSignature:
+    def test_signature(self, pm: PersistentMessage) -> None:
+        signature, boundary = PersistentMessage.objects.active_signature()
+        assert boundary is None
+        pm.content = "Updated"
+        pm.save()
+        assert PersistentMessage.objects.active_signature()[0] != signature
+
+    def test_boundary(self, pm: PersistentMessage) -> None:
+        until = tz_now() + timedelta(hours=1)
+        PersistentMessage.objects.create(
+            content="Future", display_from=until + timedelta(hours=1)
+        )
+        pm.display_until = until
+        pm.save()
+        signature, boundary = PersistentMessage.objects.active_signature()
+        assert boundary == until
+
+    def test_get_active_signature(self, pm: PersistentMessage) -> None:
+        signature = get_active_signature()
+        with CaptureQueriesContext(connection) as ctx:
+            assert get_active_signature() == signature
+        assert len(ctx) == 0
+        pm.deactivate()
+        assert get_active_signature() != signature
+
+
+@pytest.mark.django_db
+class TestMessageVersion:
+    def test_bumped_on_save(self, pm: PersistentMessage) -> None:
+        version = get_message_version()
+        pm.save()
+        assert get_message_version() > version
+
+    def test_bumped_on_targeting(self, pm: PersistentMessage, user: User) -> None:
+        version = get_message_version()
+        pm.target_users.add(user)
+        assert get_message_version() > version
+
+    def test_bumped_on_bulk_dismissal(self, pm: PersistentMessage, user: User) -> None:
+        pm.dismiss(user)
+        version = get_message_version()
+        MessageDismissal.objects.all().delete()
+        assert get_message_version() > version
+
+    def test_user_version(self, pm: PersistentMessage, user: User) -> None:
+        version = get_user_version(user)
+        message_version = get_message_version()
+        pm.dismiss(user)
+        assert get_user_version(user) > version
+        assert get_message_version() == message_version
+        version = get_user_version(user)
+        user.dismissed_messages.get().delete()
+        assert get_user_version(user) > version
+
+    def test_user_version__bulk_delete(self, pm: PersistentMessage) -> None:
+        users = [User.objects.create_user(username=f"user{i}") for i in range(3)]
+        for user in users:
+            pm.dismiss(user)
+        with mock.patch("persistent_messages.signals.bump_user_versions") as bump:
+            MessageDismissal.objects.filter(user=users[0]).delete()
+            pm.delete()
+        bump.assert_not_called()
+
+    def test_check_interval(self, settings) -> None:
+        settings.PERSISTENT_MESSAGES_VERSION_CHECK_INTERVAL = 1000
+        version = get_message_version()
+        # simulate another process bumping the shared version
+        cache.incr(MESSAGE_VERSION_KEY)
+        assert get_message_version() == version
+        with mock.patch("time.monotonic", return_value=time.monotonic() + 1):
+            assert get_message_version() == version + 1
+
+    def test_bumped_on_commit(self, django_capture_on_commit_callbacks) -> None:
+        version = get_message_version()
+        with django_capture_on_commit_callbacks(execute=True) as callbacks:
+            bump_message_version()
+        assert len(callbacks) == 1
+        assert get_message_version() == version + 2
+
+    def test_database_backend(self, settings, pm: PersistentMessage) -> None:
+        settings.PERSISTENT_MESSAGES_VERSION_BACKEND = "database"
+        version = get_message_version()
+        assert MessageGeneration.objects.get().value == version
+        pm.save()
+        assert get_message_version() == version + 1
+        assert MessageGeneration.objects.get().value == version + 1
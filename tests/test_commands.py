@@ -0,0 +1,104 @@
+import datetime
+from io import StringIO
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+
+from persistent_messages.models import PersistentMessage, RecurringWindow
+
+
+@pytest.mark.django_db
+class TestTargetPersistentMessage:
+    @pytest.fixture
+    def id_file(self, tmp_path, user: User) -> str:
+        other = User.objects.create_user(username="other")
+        path = tmp_path / "ids.txt"
+        path.write_text(f"# users\n{user.pk}\n\n{other.pk}\n")
+        return str(path)
+
+    def test_create(self, id_file: str) -> None:
+        out = StringIO()
+        call_command(
+            "target_persistent_message",
+            file=id_file,
+            content="Hello",
+            level="warning",
+            stdout=out,
+        )
+        pm = PersistentMessage.objects.get()
+        assert pm.level == 30
+        assert pm.target_users.count() == 2
+        assert "targeting 2 user(s)" in out.getvalue()
+
+    def test_existing_message(self, id_file: str, pm: PersistentMessage) -> None:
+        out = StringIO()
+        call_command(
+            "target_persistent_message", file=id_file, message=pm.pk, stdout=out
+        )
+        assert pm.target_users.count() == 2
+        assert f"Targeted message {pm.pk} at 2 user id(s)" in out.getvalue()
+
+    def test_stdin(self, monkeypatch, user: User) -> None:
+        monkeypatch.setattr("sys.stdin", StringIO(f"{user.pk}\n"))
+        call_command("target_persistent_message", content="Hello")
+        assert PersistentMessage.objects.get().target_users.get() == user
+
+    def test_invalid_id(self, tmp_path) -> None:
+        path = tmp_path / "ids.txt"
+        path.write_text("1\nfoo\n")
+        with pytest.raises(CommandError):
+            call_command("target_persistent_message", file=str(path), content="x")
+        assert not PersistentMessage.objects.exists()
+
+    def test_unknown_user(self, tmp_path, user: User) -> None:
+        path = tmp_path / "ids.txt"
+        path.write_text(f"{user.pk}\n999999\n")
+        with pytest.raises(CommandError, match="999999"):
+            call_command("target_persistent_message", file=str(path), content="x")
+        assert not PersistentMessage.objects.exists()
+
+    def test_unknown_user__existing_message(
+        self, tmp_path, pm: PersistentMessage, user: User
+    ) -> None:
+        path = tmp_path / "ids.txt"
+        path.write_text(f"{user.pk}\n999999\n")
+        with pytest.raises(CommandError, match="999999"):
+            call_command(
+                "target_persistent_message",
+                file=str(path),
+                message=pm.pk,
+                batch_size=1,
+            )
+        assert not pm.target_users.exists()
+
+    def test_missing_content(self, id_file: str) -> None:
+        with pytest.raises(CommandError):
+            call_command("target_persistent_message", file=id_file)
+
+
+@pytest.mark.django_db
+def test_refresh_message_occurrences(pm: PersistentMessage) -> None:
+    RecurringWindow.objects.create(
+        message=pm,
+        weekday=0,
+        start_time=datetime.time(2),
+        duration=datetime.timedelta(hours=2),
+    )
+    pm.occurrences.all().delete()
+    out = StringIO()
+    call_command("refresh_message_occurrences", horizon=14, stdout=out)
+    assert pm.occurrences.count() in (2, 3)
+    assert "occurrences" in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_purge_expired_dismissals(pm: PersistentMessage, user: User) -> None:
+    pm.dismissal_ttl = datetime.timedelta(days=1)
+    pm.save()
+    pm.dismiss(user)
+    user.dismissed_messages.update(dismissed_at=pm.created_at - pm.dismissal_ttl)
+    out = StringIO()
+    call_command("purge_expired_dismissals", batch_size=10, stdout=out)
+    assert not user.dismissed_messages.exists()
+    assert "Deleted 1 expired dismissals" in out.getvalue()
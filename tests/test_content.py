@@ -0,0 +1,97 @@
+import datetime
+
+import pytest
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import ValidationError
+
+from persistent_messages.content import compile_content, render_content
+from persistent_messages.models import PersistentMessage
+from persistent_messages.shortcuts import get_persistent_messages
+from persistent_messages.templatetags.persistent_message_tags import (
+    serialize_message,
+)
+
+
+class TestCompileContent:
+    def test_compile(self) -> None:
+        assert compile_content("Hi {first_name}, ends {end:%d %b}!") == (
+            ("Hi ", "first_name", ""),
+            (", ends ", "end", "%d %b"),
+            ("!", None, ""),
+        )
+
+    def test_cached(self) -> None:
+        assert compile_content("Hi {first_name}") is compile_content("Hi {first_name}")
+
+    @pytest.mark.parametrize(
+        "content", ["Hi {", "Hi {}", "Hi {0}", "Hi {user.password}", "Hi {x!r}"]
+    )
+    def test_invalid(self, content: str) -> None:
+        with pytest.raises(ValueError):
+            compile_content(content)
+
+
+class TestRenderContent:
+    @pytest.fixture
+    def user(self) -> User:
+        return User(username="fred", first_name="Fred", last_name="<Bloggs>")
+
+    def test_render(self, user: User) -> None:
+        assert render_content("Hi {first_name} ({username})", user) == "Hi Fred (fred)"
+
+    def test_callable(self, user: User) -> None:
+        assert render_content("Hi {full_name}", user) == "Hi Fred <Bloggs>"
+
+    def test_escape(self, user: User) -> None:
+        assert render_content("<b>{last_name}</b>", user, escape_values=True) == (
+            "<b>&lt;Bloggs&gt;</b>"
+        )
+
+    def test_anonymous(self) -> None:
+        assert render_content("Hi {first_name}!", AnonymousUser()) == "Hi !"
+        assert render_content("Hi {first_name}!", None) == "Hi !"
+
+    def test_dotted_and_format_spec(self, settings, user: User) -> None:
+        settings.PERSISTENT_MESSAGES_TEMPLATE_PLACEHOLDERS = {
+            "joined": "date_joined",
+            "year": "date_joined.year",
+        }
+        user.date_joined = datetime.datetime(2024, 3, 1)
+        assert render_content("{joined:%d %b} {year}", user) == "01 Mar 2024"
+
+    def test_unknown_placeholder(self, user: User) -> None:
+        assert render_content("Hi {password}", user) == "Hi "
+
+    def test_invalid(self, user: User) -> None:
+        assert render_content("Hi {", user) == "Hi {"
+
+
+@pytest.mark.django_db
+class TestTemplatedMessage:
+    @pytest.fixture
+    def pm(self) -> PersistentMessage:
+        return PersistentMessage.objects.create(
+            content="<b>Hi {first_name}</b>", is_template=True, mark_content_safe=True
+        )
+
+    def test_clean(self) -> None:
+        with pytest.raises(ValidationError):
+            PersistentMessage.objects.create(content="Hi {password}", is_template=True)
+        # not validated if not a template
+        PersistentMessage.objects.create(content="Hi {password}")
+
+    def test_message(self, rf, pm: PersistentMessage) -> None:
+        request = rf.get("/")
+        request.user = User.objects.create_user(username="x", first_name="<Fred>")
+        (message,) = get_persistent_messages(request)
+        assert message.message == "<b>Hi &lt;Fred&gt;</b>"
+        assert serialize_message(message)["message"] == "<b>Hi &lt;Fred&gt;</b>"
+
+    def test_message__no_user(self, pm: PersistentMessage) -> None:
+        assert pm.message == "<b>Hi </b>"
+
+    def test_history(self, pm: PersistentMessage, user: User) -> None:
+        user.first_name = "Fred"
+        user.save()
+        page, _ = PersistentMessage.objects.history(user)
+        assert page[0].message == "<b>Hi Fred</b>"
@@ -1,7 +1,17 @@
 import pytest
+from django.contrib import messages
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.db import connection
+from django.template import Context, Template
+from django.test.utils import CaptureQueriesContext
 
-from persistent_messages.context_processors import all_messages, persistent_messages
+from persistent_messages.context_processors import (
+    LazyAllMessages,
+    all_messages,
+    persistent_messages,
+)
 from persistent_messages.models import PersistentMessage
+from persistent_messages.shortcuts import get_loaded_messages
 from persistent_messages.templatetags.persistent_message_tags import serialize_message
 
 
@@ -41,3 +51,99 @@ class TestContextProcessors:
         context = all_messages(request)
         # context is a lambda so we need to call it to get the actual value
         assert context["all_messages"]() == [serialize_message(pm)]
+
+
+@pytest.mark.django_db
+class TestLazyMessages:
+    @pytest.fixture
+    def request_(self, rf, user):
+        request = rf.get("/")
+        request.user = user
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        return request
+
+    @pytest.fixture
+    def calls(self, settings) -> list:
+        calls: list = []
+        settings.MESSAGE_CUSTOM_GROUPS = {"all": lambda user: calls.append(user) or 1}
+        PersistentMessage.objects.create(
+            content="Custom",
+            target=PersistentMessage.TargetType.USERS_OR_GROUPS,
+            target_custom_group="all",
+        )
+        return calls
+
+    def render(self, request, source: str) -> str:
+        context = Context(persistent_messages(request))
+        return Template(source).render(context)
+
+    def test_bool_count_first(self, request_, pm: PersistentMessage, calls) -> None:
+        other = PersistentMessage.objects.create(content="Other", priority=1)
+        lazy = persistent_messages(request_)["persistent_messages"]
+        with CaptureQueriesContext(connection) as ctx:
+            assert lazy
+            assert lazy.count == 3
+            assert lazy.first == other
+        # the custom group query, then one query each
+        sql = [q["sql"] for q in ctx.captured_queries]
+        assert len(sql) == 4
+        assert sql[1].startswith("SELECT 1 AS")
+        assert sql[2].startswith("SELECT COUNT(*)")
+        assert sql[3].endswith("LIMIT 1")
+        assert len(calls) == 1
+        assert get_loaded_messages(request_) is None
+
+    def test_for(self, request_, pm: PersistentMessage, calls) -> None:
+        source = "{% for m in persistent_messages %}{{ m.content }},{% endfor %}"
+        with CaptureQueriesContext(connection) as ctx:
+            output = self.render(request_, source)
+        assert output == "Custom,This is a test message,"
+        # the custom group query and the messages - no COUNT
+        assert len(ctx) == 2
+        assert len(calls) == 1
+
+    def test_if_for(self, request_, pm: PersistentMessage, calls) -> None:
+        source = (
+            "{% if persistent_messages %}{{ persistent_messages|length }}:"
+            "{% for m in persistent_messages %}{{ m.content }},{% endfor %}{% endif %}"
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            output = self.render(request_, source)
+        assert output == "2:Custom,This is a test message,"
+        # the custom group query, EXISTS and the messages
+        assert len(ctx) == 3
+        assert len(calls) == 1
+
+    def test_loaded(self, request_, pm: PersistentMessage) -> None:
+        lazy = persistent_messages(request_)["persistent_messages"]
+        assert list(lazy) == [pm]
+        with CaptureQueriesContext(connection) as ctx:
+            assert lazy
+            assert len(lazy) == lazy.count == 1
+            assert lazy.first == pm
+            assert lazy() == [pm]
+        assert len(ctx) == 0
+
+    def test_empty(self, request_) -> None:
+        lazy = persistent_messages(request_)["persistent_messages"]
+        assert not lazy
+        assert lazy.count == 0
+        assert lazy.first is None
+
+    def test_template(self, request_, pm: PersistentMessage) -> None:
+        source = (
+            "{% if persistent_messages %}{{ persistent_messages.count }}: "
+            "{{ persistent_messages.first.content }}{% endif %}"
+        )
+        assert self.render(request_, source) == "1: This is a test message"
+        assert get_loaded_messages(request_) is None
+
+    def test_all_messages(self, request_, pm: PersistentMessage) -> None:
+        lazy = all_messages(request_)["all_messages"]
+        assert lazy.count == 1
+        messages.info(request_, "Flash")
+        assert LazyAllMessages(request_).count == 2
+        assert lazy.first["message"] == "Flash"
+        assert [m["message"] for m in lazy] == ["Flash", pm.content]
+        assert len(lazy) == 2
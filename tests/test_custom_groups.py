@@ -0,0 +1,126 @@
+import time
+
+import pytest
+from django.contrib.auth.models import User
+
+from persistent_messages.custom_groups import get_breaker, match_custom_groups
+from persistent_messages.models import PersistentMessage
+
+
+def slow(user: User) -> bool:
+    time.sleep(0.05)
+    return True
+
+
+def broken(user: User) -> bool:
+    raise ValueError("Service unavailable")
+
+
+class Counter:
+    def __init__(self, result: bool = True) -> None:
+        self.calls = 0
+        self.result = result
+
+    def __call__(self, user: User) -> bool:
+        self.calls += 1
+        return self.result
+
+
+@pytest.fixture
+def groups(settings) -> dict:
+    groups = {"fast": Counter(), "slow": slow, "broken": broken}
+    settings.MESSAGE_CUSTOM_GROUPS = groups
+    settings.PERSISTENT_MESSAGES_CUSTOM_GROUP_BUDGET = 20
+    settings.PERSISTENT_MESSAGES_CUSTOM_GROUP_MAX_FAILURES = 2
+    return groups
+
+
+class TestMatchCustomGroups:
+    def test_match(self, groups: dict) -> None:
+        assert match_custom_groups(["fast", "slow", "broken"], User()) == {
+            "fast",
+            "slow",
+        }
+
+    def test_unknown_group(self, groups: dict) -> None:
+        with pytest.raises(KeyError):
+            match_custom_groups(["unknown"], User())
+
+    @pytest.mark.parametrize("group", ["slow", "broken"])
+    def test_breaker(self, groups: dict, group: str, caplog) -> None:
+        match_custom_groups([group], User())
+        assert not get_breaker(group).is_open()
+        match_custom_groups([group], User())
+        assert get_breaker(group).is_open()
+        assert "tripped its circuit breaker" in caplog.text
+        # while open the group is not called, and doesn't match
+        start = time.perf_counter()
+        assert match_custom_groups([group], User()) == set()
+        assert time.perf_counter() - start < 0.01
+
+    def test_breaker__cooldown(self, settings, groups: dict) -> None:
+        settings.PERSISTENT_MESSAGES_CUSTOM_GROUP_COOLDOWN = 0
+        match_custom_groups(["broken"], User())
+        match_custom_groups(["broken"], User())
+        assert not get_breaker("broken").is_open()
+
+    def test_success_resets_failures(self, settings) -> None:
+        calls = []
+
+        def flaky(user: User) -> bool:
+            calls.append(user)
+            if len(calls) % 2:
+                raise ValueError
+            return True
+
+        settings.MESSAGE_CUSTOM_GROUPS = {"flaky": flaky}
+        settings.PERSISTENT_MESSAGES_CUSTOM_GROUP_MAX_FAILURES = 2
+        for _ in range(6):
+            match_custom_groups(["flaky"], User())
+        assert not get_breaker("flaky").is_open()
+
+    def test_concurrent(self, settings, groups: dict) -> None:
+        settings.PERSISTENT_MESSAGES_CUSTOM_GROUP_WORKERS = 4
+        settings.PERSISTENT_MESSAGES_CUSTOM_GROUP_BUDGET = 200
+        groups["slow2"] = slow
+        start = time.perf_counter()
+        matched = match_custom_groups(["fast", "slow", "slow2", "broken"], User())
+        assert matched == {"fast", "slow", "slow2"}
+        # the slow groups ran in parallel
+        assert time.perf_counter() - start < 0.09
+
+    def test_concurrent__timeout(self, settings, groups: dict) -> None:
+        settings.PERSISTENT_MESSAGES_CUSTOM_GROUP_WORKERS = 2
+        start = time.perf_counter()
+        assert match_custom_groups(["fast", "slow"], User()) == {"fast"}
+        # the slow group is abandoned once the budget is used up
+        assert time.perf_counter() - start < 0.045
+        assert get_breaker("slow").failures == 1
+
+    def test_concurrent__single_group_timeout(self, settings, groups: dict) -> None:
+        settings.PERSISTENT_MESSAGES_CUSTOM_GROUP_WORKERS = 2
+        start = time.perf_counter()
+        assert match_custom_groups(["slow"], User()) == set()
+        assert time.perf_counter() - start < 0.045
+        assert get_breaker("slow").failures == 1
+
+
+@pytest.mark.django_db
+class TestFilterUser:
+    def test_group_evaluated_once(self, groups: dict, user: User) -> None:
+        for _ in range(3):
+            PersistentMessage.objects.create(
+                content="Custom",
+                target=PersistentMessage.TargetType.USERS_OR_GROUPS,
+                target_custom_group="fast",
+            )
+        assert len(PersistentMessage.objects.filter_user(user)) == 3
+        assert groups["fast"].calls == 1
+
+    def test_broken_group(self, groups: dict, user: User) -> None:
+        PersistentMessage.objects.create(
+            content="Custom",
+            target=PersistentMessage.TargetType.USERS_OR_GROUPS,
+            target_custom_group="broken",
+        )
+        assert not PersistentMessage.objects.filter_user(user).exists()
@@ -0,0 +1,63 @@
+import json
+from pathlib import Path
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+
+from persistent_messages.export import export_anonymous_messages
+from persistent_messages.models import PersistentMessage
+from persistent_messages.templatetags.persistent_message_tags import (
+    serialize_messages,
+)
+
+
+@pytest.mark.django_db
+class TestExport:
+    @pytest.fixture
+    def export_dir(self, settings, tmp_path: Path) -> Path:
+        settings.PERSISTENT_MESSAGES_EXPORT_DIR = str(tmp_path / "static")
+        return tmp_path / "static"
+
+    def test_export(self, export_dir: Path, pm: PersistentMessage) -> None:
+        anon = PersistentMessage.objects.create(
+            content="Cookies", target=PersistentMessage.TargetType.ALL_USERS
+        )
+        path = export_anonymous_messages()
+        assert path.parent == export_dir
+        data = json.loads(path.read_text())
+        assert data == serialize_messages([anon])
+        assert (export_dir / "persistent-messages.json").read_text() == path.read_text()
+        # no temporary files are left behind
+        assert len(list(export_dir.iterdir())) == 2
+
+    def test_export__versioned(self, export_dir: Path) -> None:
+        first = export_anonymous_messages()
+        assert export_anonymous_messages() == first
+        PersistentMessage.objects.create(
+            content="Cookies", target=PersistentMessage.TargetType.ALL_USERS
+        )
+        second = export_anonymous_messages()
+        assert second != first
+        assert first.exists()
+        latest = export_dir / "persistent-messages.json"
+        assert latest.read_text() == second.read_text()
+
+    def test_export__not_configured(self) -> None:
+        with pytest.raises(ImproperlyConfigured):
+            export_anonymous_messages()
+
+    def test_export_on_change(
+        self, settings, export_dir: Path, django_capture_on_commit_callbacks
+    ) -> None:
+        settings.PERSISTENT_MESSAGES_EXPORT_ON_CHANGE = True
+        with django_capture_on_commit_callbacks(execute=True):
+            PersistentMessage.objects.create(
+                content="Cookies", target=PersistentMessage.TargetType.ALL_USERS
+            )
+        data = json.loads((export_dir / "persistent-messages.json").read_text())
+        assert [m["message"] for m in data] == ["Cookies"]
+
+    def test_command(self, tmp_path: Path) -> None:
+        call_command("export_persistent_messages", export_dir=str(tmp_path))
+        assert json.loads((tmp_path / "persistent-messages.json").read_text()) == []
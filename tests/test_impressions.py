@@ -0,0 +1,124 @@
+from datetime import datetime, timezone
+from unittest import mock
+
+import pytest
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import DatabaseError
+from django.template import Context, Template
+
+from persistent_messages.admin import PersistentMessageAdmin
+from persistent_messages.impressions import buffer, flush_impressions, get_bucket
+from persistent_messages.models import MessageImpressions, PersistentMessage
+from persistent_messages.shortcuts import get_persistent_messages
+from persistent_messages.sketch import HyperLogLog
+from persistent_messages.warmup import warm_up
+
+
+class TestHyperLogLog:
+    @pytest.mark.parametrize("n", [0, 10, 1000, 20000])
+    def test_count(self, n: int) -> None:
+        sketch = HyperLogLog()
+        for i in range(n):
+            sketch.add(str(i))
+            sketch.add(str(i))
+        assert abs(sketch.count() - n) <= max(1, n * 0.1)
+
+    def test_merge(self) -> None:
+        a, b = HyperLogLog(), HyperLogLog()
+        for i in range(1000):
+            a.add(str(i))
+            b.add(str(i + 500))
+        a.merge(b)
+        assert abs(a.count() - 1500) <= 150
+        assert HyperLogLog.from_bytes(a.to_bytes()).count() == a.count()
+
+    def test_merge__precision(self) -> None:
+        with pytest.raises(ValueError):
+            HyperLogLog(10).merge(HyperLogLog(12))
+
+
+def test_get_bucket(settings) -> None:
+    settings.PERSISTENT_MESSAGES_IMPRESSIONS_BUCKET_SIZE = 3600
+    when = datetime(2024, 1, 1, 10, 35, 12, tzinfo=timezone.utc)
+    assert get_bucket(when) == datetime(2024, 1, 1, 10, tzinfo=timezone.utc)
+
+
+@pytest.mark.django_db
+class TestTrackImpressions:
+    @pytest.fixture(autouse=True)
+    def enable_tracking(self, settings) -> None:
+        settings.PERSISTENT_MESSAGES_TRACK_IMPRESSIONS = True
+        settings.PERSISTENT_MESSAGES_IMPRESSIONS_FLUSH_INTERVAL = 3600
+        # one bucket for the whole test run, so tests can't straddle a boundary
+        settings.PERSISTENT_MESSAGES_IMPRESSIONS_BUCKET_SIZE = 10**9
+        buffer.drain()
+
+    def view(self, rf, user) -> None:
+        request = rf.get("/")
+        request.user = user
+        get_persistent_messages(request)
+        template = Template(
+            "{% load persistent_message_tags %}{% persistent_messages %}"
+        )
+        template.render(Context({"request": request}))
+
+    def test_track(self, rf, user: User, pm: PersistentMessage) -> None:
+        other = User.objects.create_user(username="other")
+        # the second view of each user is a fragment cache hit
+        for viewer in (user, user, other, other, AnonymousUser()):
+            self.view(rf, viewer)
+        assert flush_impressions() == 1
+        impressions = MessageImpressions.objects.get()
+        assert impressions.message == pm
+        assert impressions.count == 4
+        assert impressions.viewers_sketch.count() == 2
+        # subsequent flushes are merged into the same bucket
+        self.view(rf, user)
+        self.view(rf, User.objects.create_user(username="third"))
+        flush_impressions()
+        impressions.refresh_from_db()
+        assert impressions.count == 6
+        assert impressions.viewers_sketch.count() == 3
+
+    def test_disabled(self, settings, rf, user: User, pm: PersistentMessage) -> None:
+        settings.PERSISTENT_MESSAGES_TRACK_IMPRESSIONS = False
+        self.view(rf, user)
+        assert flush_impressions() == 0
+
+    def test_flush_interval(
+        self, settings, rf, user: User, pm: PersistentMessage
+    ) -> None:
+        settings.PERSISTENT_MESSAGES_IMPRESSIONS_FLUSH_INTERVAL = 0
+        self.view(rf, user)
+        assert MessageImpressions.objects.get().count == 1
+
+    def test_deleted_message(self, rf, user: User, pm: PersistentMessage) -> None:
+        self.view(rf, user)
+        pm.delete()
+        assert flush_impressions() == 0
+
+    def test_flush_error(self, rf, user: User, pm: PersistentMessage) -> None:
+        self.view(rf, user)
+        with mock.patch(
+            "persistent_messages.models.MessageImpressions.objects.select_for_update",
+            side_effect=DatabaseError("locked"),
+        ):
+            with pytest.raises(DatabaseError):
+                flush_impressions()
+        # the impressions are retried on the next flush
+        assert flush_impressions() == 1
+        assert MessageImpressions.objects.get().count == 1
+
+    def test_warm_up(self, pm: PersistentMessage) -> None:
+        pm.target = PersistentMessage.TargetType.ALL_USERS
+        pm.save()
+        assert warm_up()
+        assert flush_impressions() == 0
+
+    def test_admin(self, rf, user: User, pm: PersistentMessage) -> None:
+        self.view(rf, user)
+        flush_impressions()
+        admin = PersistentMessageAdmin(PersistentMessage, site)
+        assert admin._impressions(pm) == 1
+        assert admin._unique_viewers(pm) == 1
@@ -1,9 +1,28 @@
+import datetime
+import zoneinfo
+from typing import Iterator
+from unittest import mock
+
 import pytest
-from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.auth.models import AnonymousUser, Group, User
 from django.contrib.messages import constants as message_constants
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.timezone import localtime, now as tz_now
 
+from persistent_messages.cache import get_message_version
 from persistent_messages.exceptions import UndismissableMessage
-from persistent_messages.models import LEVEL_TAGS, TAG_LEVELS, PersistentMessage
+from persistent_messages.models import (
+    LEVEL_TAGS,
+    TAG_LEVELS,
+    MessageDismissal,
+    MessageOccurrence,
+    PersistentMessage,
+    RecurringWindow,
+)
+from persistent_messages.shortcuts import get_persistent_messages
 
 
 def test_custom_MESSAGE_TAGS() -> None:
@@ -111,6 +130,39 @@ class TestMessageDismissal:
         pm.dismiss(AnonymousUser)
         assert pm.dismissed_by.count() == 0
 
+    def test_dismissal_ttl(self, pm: PersistentMessage, user: User) -> None:
+        pm.dismissal_ttl = datetime.timedelta(days=7)
+        pm.save()
+        pm.dismiss(user)
+        assert not PersistentMessage.objects.filter_user(user).exists()
+        dismissal = user.dismissed_messages.get()
+        dismissal.dismissed_at -= datetime.timedelta(days=8)
+        dismissal.save()
+        assert list(PersistentMessage.objects.filter_user(user)) == [pm]
+        assert dict(PersistentMessage.objects.for_users([user.pk])) == {user.pk: [pm]}
+        page, _ = PersistentMessage.objects.history(user)
+        assert not page[0].is_dismissed
+        # dismissing again resets the clock
+        pm.dismiss(user)
+        assert not PersistentMessage.objects.filter_user(user).exists()
+        assert user.dismissed_messages.count() == 1
+
+    def test_purge_expired(self, user: User) -> None:
+        week = datetime.timedelta(days=7)
+        expiring = PersistentMessage.objects.create(content="1", dismissal_ttl=week)
+        permanent = PersistentMessage.objects.create(content="2")
+        recent = PersistentMessage.objects.create(content="3", dismissal_ttl=week)
+        for pm in (expiring, permanent, recent):
+            pm.dismiss(user)
+        user.dismissed_messages.exclude(message=recent).update(
+            dismissed_at=tz_now() - datetime.timedelta(days=8)
+        )
+        assert MessageDismissal.objects.purge_expired(batch_size=1) == 1
+        assert set(user.dismissed_messages.values_list("message", flat=True)) == {
+            permanent.pk,
+            recent.pk,
+        }
+
 
 @pytest.mark.django_db
 class TestPersistentMessageQuerySet:
@@ -121,3 +173,292 @@ class TestPersistentMessageQuerySet:
         assert PersistentMessage.objects.active().get() == pm
         pm.deactivate()
         assert not PersistentMessage.objects.active().exists()
+
+
+@pytest.mark.django_db
+class TestBulkTargeting:
+    @pytest.fixture
+    def users(self) -> list[User]:
+        return [User.objects.create_user(username=f"user{i}") for i in range(5)]
+
+    def test_add_target_users(self, pm: PersistentMessage, users: list[User]) -> None:
+        user_ids = (u.pk for u in users)
+        assert pm.add_target_users(user_ids, batch_size=2) == 5
+        assert set(pm.target_users.all()) == set(users)
+        # re-adding existing users is a no-op
+        assert pm.add_target_users([users[0].pk], batch_size=2) == 1
+        assert pm.target_users.count() == 5
+
+    def test_create_for_users(self, users: list[User]) -> None:
+        pm = PersistentMessage.objects.create_for_users(
+            (u.pk for u in users), batch_size=2, content="Hello"
+        )
+        assert pm.target == PersistentMessage.TargetType.USERS_OR_GROUPS
+        assert pm.target_users.count() == 5
+        for user in users:
+            assert PersistentMessage.objects.filter_user(user).get() == pm
+
+    def test_create_for_users__rollback(self, users: list[User]) -> None:
+        def user_ids() -> Iterator[int]:
+            yield users[0].pk
+            raise ValueError("Invalid user id")
+
+        with pytest.raises(ValueError):
+            PersistentMessage.objects.create_for_users(
+                user_ids(), batch_size=1, content="Hello"
+            )
+        assert not PersistentMessage.objects.exists()
+        assert not PersistentMessage.target_users.through.objects.exists()
+
+    def test_bulk_create_for_users__no_returning(self, users: list[User]) -> None:
+        features = type(connection.features)
+        with mock.patch.object(features, "can_return_rows_from_bulk_insert", False):
+            objs = PersistentMessage.objects.bulk_create_for_users(
+                [PersistentMessage(content="foo"), PersistentMessage(content="bar")],
+                (u.pk for u in users[:3]),
+            )
+        for obj in objs:
+            assert set(obj.target_users.all()) == set(users[:3])
+
+    def test_add_target_users__unknown(
+        self, pm: PersistentMessage, users: list[User]
+    ) -> None:
+        with pytest.raises(ValidationError):
+            pm.add_target_users([users[0].pk, 999999], batch_size=1)
+        assert not pm.target_users.exists()
+
+    def test_bulk_create_for_users(self, users: list[User]) -> None:
+        objs = PersistentMessage.objects.bulk_create_for_users(
+            [PersistentMessage(content="foo"), PersistentMessage(content="bar")],
+            (u.pk for u in users[:3]),
+            batch_size=2,
+        )
+        for obj in objs:
+            assert obj.target == PersistentMessage.TargetType.USERS_OR_GROUPS
+            assert set(obj.target_users.all()) == set(users[:3])
+        assert not PersistentMessage.objects.filter_user(users[4]).exists()
+
+
+@pytest.mark.django_db
+class TestFilterUserOrdering:
+    def test_display_order(self, user: User) -> None:
+        info = PersistentMessage.objects.create(content="info", level=20)
+        error = PersistentMessage.objects.create(content="error", level=40)
+        prioritised = PersistentMessage.objects.create(
+            content="priority", level=10, priority=1
+        )
+        assert list(PersistentMessage.objects.filter_user(user)) == [
+            prioritised,
+            error,
+            info,
+        ]
+        assert list(PersistentMessage.objects.filter_user(user, limit=2)) == [
+            prioritised,
+            error,
+        ]
+
+    def test_limit__no_duplicates(self, user: User) -> None:
+        groups = [Group.objects.create(name=f"group{i}") for i in range(3)]
+        user.groups.add(*groups)
+        pm = PersistentMessage.objects.create(content="groups", user=user)
+        pm.target_groups.add(*groups)
+        other = PersistentMessage.objects.create(content="all", level=10)
+        assert list(PersistentMessage.objects.filter_user(user, limit=2)) == [
+            pm,
+            other,
+        ]
+
+    def test_max_displayed(self, settings, rf, user: User) -> None:
+        settings.PERSISTENT_MESSAGES_MAX_DISPLAYED = 1
+        PersistentMessage.objects.create(content="info", level=20)
+        error = PersistentMessage.objects.create(content="error", level=40)
+        request = rf.get("/")
+        request.user = user
+        assert get_persistent_messages(request) == [error]
+
+
+@pytest.mark.django_db
+class TestHistory:
+    def test_history(self, user: User) -> None:
+        messages = [PersistentMessage.objects.create(content=f"{i}") for i in range(5)]
+        messages[1].dismiss(user)
+        messages[2].deactivate()
+        # not targeted at the user
+        PersistentMessage.objects.create(
+            content="anon", target=PersistentMessage.TargetType.ANONYMOUS_ONLY
+        )
+        page, cursor = PersistentMessage.objects.history(user, limit=2)
+        assert page == [messages[4], messages[3]]
+        assert cursor
+        page, cursor = PersistentMessage.objects.history(user, cursor=cursor, limit=2)
+        assert page == [messages[2], messages[1]]
+        assert [m.is_dismissed for m in page] == [False, True]
+        page, cursor = PersistentMessage.objects.history(user, cursor=cursor, limit=2)
+        assert page == [messages[0]]
+        assert cursor is None
+
+    def test_history__same_created_at(self, user: User) -> None:
+        messages = [PersistentMessage.objects.create(content=f"{i}") for i in range(3)]
+        PersistentMessage.objects.update(created_at=tz_now())
+        page, cursor = PersistentMessage.objects.history(user, limit=2)
+        assert page == [messages[2], messages[1]]
+        page, cursor = PersistentMessage.objects.history(user, cursor=cursor, limit=2)
+        assert page == [messages[0]]
+
+    def test_history__single_query(self, user: User) -> None:
+        for i in range(3):
+            PersistentMessage.objects.create(content=f"{i}")
+        _, cursor = PersistentMessage.objects.history(user, limit=1)
+        with CaptureQueriesContext(connection) as ctx:
+            PersistentMessage.objects.history(user, cursor=cursor, limit=1)
+        assert len(ctx) == 1
+
+    def test_history__invalid_cursor(self, user: User) -> None:
+        with pytest.raises(ValueError):
+            PersistentMessage.objects.history(user, cursor="foo")
+
+
+@pytest.mark.django_db
+class TestForUsers:
+    @pytest.fixture
+    def users(self) -> list[User]:
+        users = [User.objects.create_user(username=f"user{i}") for i in range(6)]
+        users[5].first_name = "Fred"
+        users[5].save()
+        return users
+
+    @pytest.fixture
+    def messages(self, users: list[User]) -> list[PersistentMessage]:
+        group = Group.objects.create(name="group")
+        users[1].groups.add(group)
+        TargetType = PersistentMessage.TargetType
+        all_users = PersistentMessage.objects.create(
+            content="all", target=TargetType.ALL_USERS, level=40
+        )
+        authenticated = PersistentMessage.objects.create(content="auth")
+        PersistentMessage.objects.create(
+            content="anon", target=TargetType.ANONYMOUS_ONLY
+        )
+        direct = PersistentMessage.objects.create(content="direct", user=users[0])
+        by_group = PersistentMessage.objects.create(
+            content="group", target=TargetType.USERS_OR_GROUPS
+        )
+        by_group.target_groups.add(group)
+        custom = PersistentMessage.objects.create(
+            content="custom",
+            target=TargetType.USERS_OR_GROUPS,
+            target_custom_group="fred",
+        )
+        expired = PersistentMessage.objects.create(content="expired", user=users[2])
+        expired.deactivate()
+        authenticated.dismiss(users[3])
+        return [all_users, authenticated, direct, by_group, custom]
+
+    def test_for_users(self, users: list[User], messages: list) -> None:
+        results = dict(
+            PersistentMessage.objects.for_users((u.pk for u in users), chunk_size=4)
+        )
+        assert list(results) == [u.pk for u in users]
+        for user in users:
+            assert results[user.pk] == list(PersistentMessage.objects.filter_user(user))
+
+    def test_for_users__queries(self, users: list[User], messages: list) -> None:
+        user_ids = [u.pk for u in users]
+        with CaptureQueriesContext(connection) as ctx:
+            list(PersistentMessage.objects.for_users(user_ids, chunk_size=3))
+        # 2 up front (messages, target groups) + 4 per chunk
+        assert len(ctx) == 2 + 2 * 4
+
+
+@pytest.mark.django_db
+class TestRecurringWindows:
+    @pytest.fixture
+    def window(self, pm: PersistentMessage) -> RecurringWindow:
+        # a window covering "now" (started an hour ago, lasts two hours)
+        start = localtime() - datetime.timedelta(hours=1)
+        return RecurringWindow.objects.create(
+            message=pm,
+            weekday=start.weekday(),
+            start_time=start.time(),
+            duration=datetime.timedelta(hours=2),
+        )
+
+    def test_get_occurrences(self, pm: PersistentMessage) -> None:
+        window = RecurringWindow(
+            message=pm,
+            weekday=0,
+            start_time=datetime.time(23),
+            duration=datetime.timedelta(hours=2),
+        )
+        occurrences = list(window.get_occurrences(tz_now(), 28))
+        assert len(occurrences) in (4, 5)
+        for starts_at, ends_at in occurrences:
+            assert localtime(starts_at).weekday() == 0
+            assert ends_at - starts_at == datetime.timedelta(hours=2)
+            assert ends_at > tz_now()
+
+    def test_get_occurrences__active_time_zone(
+        self, settings, pm: PersistentMessage
+    ) -> None:
+        settings.TIME_ZONE = "Europe/London"
+        window = RecurringWindow(
+            message=pm,
+            weekday=0,
+            start_time=datetime.time(23),
+            duration=datetime.timedelta(hours=2),
+        )
+        since = tz_now()
+        expected = list(window.get_occurrences(since, 28))
+        # e.g. the time zone of the admin user editing the window
+        with timezone.override("Asia/Tokyo"):
+            assert list(window.get_occurrences(since, 28)) == expected
+        london = zoneinfo.ZoneInfo("Europe/London")
+        for starts_at, _ in expected:
+            assert starts_at.astimezone(london).time() == datetime.time(23)
+
+    def test_clean(self, pm: PersistentMessage) -> None:
+        window = RecurringWindow(
+            message=pm,
+            weekday=0,
+            start_time=datetime.time(),
+            duration=datetime.timedelta(),
+        )
+        with pytest.raises(ValidationError):
+            window.clean()
+
+    def test_active(self, window: RecurringWindow) -> None:
+        pm = PersistentMessage.objects.get()
+        assert pm.is_recurring
+        assert pm.occurrences.exists()
+        assert pm.is_active
+        assert list(PersistentMessage.objects.active()) == [pm]
+
+    def test_inactive(self, window: RecurringWindow) -> None:
+        window.start_time = (localtime() + datetime.timedelta(hours=1)).time()
+        window.duration = datetime.timedelta(minutes=30)
+        window.weekday = (localtime() + datetime.timedelta(hours=1)).weekday()
+        window.save()
+        pm = PersistentMessage.objects.get()
+        assert not pm.is_active
+        assert not PersistentMessage.objects.active().exists()
+        # the window start is the next point at which the active set changes
+        _, next_boundary = PersistentMessage.objects.active_signature()
+        assert next_boundary == pm.occurrences.earliest("starts_at").starts_at
+
+    def test_delete_window(self, window: RecurringWindow) -> None:
+        window.delete()
+        pm = PersistentMessage.objects.get()
+        assert not pm.is_recurring
+        assert not pm.occurrences.exists()
+        assert pm.is_active
+
+    def test_delete_message(self, window: RecurringWindow) -> None:
+        window.message.delete()
+        assert not MessageOccurrence.objects.exists()
+
+    def test_refresh_occurrences__invalidates_cache(
+        self, window: RecurringWindow
+    ) -> None:
+        version = get_message_version()
+        window.message.refresh_occurrences()
+        assert get_message_version() != version
@@ -0,0 +1,134 @@
+import pytest
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpResponse
+from django.template import Context, Template
+
+from persistent_messages.models import PersistentMessage
+from persistent_messages.rollout import (
+    RolloutMiddleware,
+    get_rollout_bucket,
+    get_user_rollout_bucket,
+)
+
+
+def test_get_rollout_bucket() -> None:
+    buckets = [get_rollout_bucket(f"user:{i}") for i in range(1000)]
+    assert buckets == [get_rollout_bucket(f"user:{i}") for i in range(1000)]
+    assert set(buckets) == set(range(100))
+
+
+class TestInRollout:
+    @pytest.mark.parametrize(
+        "percentage,salt,bucket,expected",
+        [
+            (None, 0, None, True),
+            (100, 0, None, True),
+            (99, 0, None, False),
+            (10, 0, 9, True),
+            (10, 0, 10, False),
+            (10, 95, 10, True),
+            (0, 0, 0, False),
+        ],
+    )
+    def test_in_rollout(
+        self, percentage: int | None, salt: int, bucket: int | None, expected: bool
+    ) -> None:
+        pm = PersistentMessage(rollout_percentage=percentage, rollout_salt=salt)
+        assert pm.in_rollout(bucket) == expected
+
+
+@pytest.mark.django_db
+class TestRollout:
+    @pytest.fixture
+    def users(self) -> list[User]:
+        return [User.objects.create_user(username=f"user{i}") for i in range(200)]
+
+    def test_sql_matches_python(self, users: list[User]) -> None:
+        pm = PersistentMessage.objects.create(
+            content="Rollout", rollout_percentage=25, rollout_salt=42
+        )
+        included = 0
+        for user in users:
+            expected = pm.in_rollout(get_user_rollout_bucket(user))
+            assert PersistentMessage.objects.filter_user(user).exists() == expected
+            included += expected
+        assert 20 < included < 80
+
+    def test_ramp_up(self, users: list[User]) -> None:
+        pm = PersistentMessage.objects.create(content="Rollout", rollout_percentage=10)
+
+        def rolled_out() -> set[int]:
+            return {
+                user_id
+                for user_id, messages in PersistentMessage.objects.for_users(
+                    [u.pk for u in users]
+                )
+                if messages
+            }
+
+        before = rolled_out()
+        pm.rollout_percentage = 50
+        pm.save()
+        after = rolled_out()
+        assert before < after
+
+    def test_anonymous(self) -> None:
+        pm = PersistentMessage.objects.create(
+            content="Rollout",
+            target=PersistentMessage.TargetType.ALL_USERS,
+            rollout_percentage=50,
+        )
+        anon = AnonymousUser()
+        assert not PersistentMessage.objects.filter_user(anon).exists()
+        ids = [str(i) for i in range(20)]
+        visible = {
+            rollout_id
+            for rollout_id in ids
+            if PersistentMessage.objects.filter_user(anon, rollout_id=rollout_id)
+        }
+        assert visible == {
+            i for i in ids if pm.in_rollout(get_user_rollout_bucket(anon, i))
+        }
+
+
+@pytest.mark.django_db
+class TestRolloutMiddleware:
+    def test_sets_cookie(self, rf) -> None:
+        seen = []
+
+        def view(request) -> HttpResponse:
+            seen.append(request.persistent_messages_rollout_id)
+            return HttpResponse()
+
+        response = RolloutMiddleware(view)(rf.get("/"))
+        cookie = response.cookies["persistent_messages_rollout"]
+        assert cookie.value == seen[0]
+        assert cookie["httponly"]
+
+    def test_existing_cookie(self, rf) -> None:
+        request = rf.get("/")
+        request.COOKIES["persistent_messages_rollout"] = "abc"
+        response = RolloutMiddleware(lambda r: HttpResponse())(request)
+        assert "persistent_messages_rollout" not in response.cookies
+
+    def test_fragment_cache(self, rf) -> None:
+        # anonymous users in different buckets must not share cached output
+        PersistentMessage.objects.create(
+            content="Rollout",
+            target=PersistentMessage.TargetType.ALL_USERS,
+            rollout_percentage=50,
+            rollout_salt=0,
+        )
+        template = Template(
+            "{% load persistent_message_tags %}{% persistent_messages %}"
+        )
+        rendered = {}
+        for rollout_id in ("0", "1", "2", "8"):
+            request = rf.get("/")
+            request.user = AnonymousUser()
+            request.COOKIES["persistent_messages_rollout"] = rollout_id
+            bucket = get_user_rollout_bucket(request.user, rollout_id)
+            html = template.render(Context({"request": request}))
+            rendered[rollout_id] = ("Rollout" in html, bucket < 50)
+        assert all(shown == expected for shown, expected in rendered.values())
+        assert {expected for _, expected in rendered.values()} == {True, False}
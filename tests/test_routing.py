@@ -0,0 +1,47 @@
+import pytest
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+
+from persistent_messages.models import MessageDismissal, PersistentMessage
+from persistent_messages.routing import db_for_read
+
+
+@pytest.mark.django_db(databases=["default", "replica"])
+class TestReadReplica:
+    @pytest.fixture(autouse=True)
+    def use_replica(self, settings) -> None:
+        settings.PERSISTENT_MESSAGES_READ_DATABASE = "replica"
+
+    @pytest.fixture
+    def pm(self) -> PersistentMessage:
+        # simulate replication by saving the same message to both databases
+        pm = PersistentMessage.objects.create(content="Hello")
+        pm.save(using="replica")
+        return pm
+
+    def test_db_for_read(self, settings, user: User) -> None:
+        assert db_for_read(user) == "replica"
+        assert db_for_read(AnonymousUser()) == "replica"
+        settings.PERSISTENT_MESSAGES_READ_DATABASE = None
+        assert db_for_read(user) is None
+
+    def test_reads_from_replica(self, user: User) -> None:
+        # only exists on the primary database
+        PersistentMessage.objects.create(content="Not replicated")
+        assert not PersistentMessage.objects.filter_user(user).exists()
+        assert not PersistentMessage.objects.filter_user(AnonymousUser()).exists()
+
+    def test_read_your_writes(self, user: User, pm: PersistentMessage) -> None:
+        assert PersistentMessage.objects.filter_user(user).get() == pm
+        # dismiss the message loaded from the replica
+        replica_pm = PersistentMessage.objects.using("replica").get()
+        replica_pm.dismiss(user)
+        # the dismissal is written to the primary only
+        assert MessageDismissal.objects.using("default").count() == 1
+        assert MessageDismissal.objects.using("replica").count() == 0
+        # and the user now reads from the primary
+        assert db_for_read(user) is None
+        assert not PersistentMessage.objects.filter_user(user).exists()
+        # until the marker expires - at which point the replica is stale
+        cache.clear()
+        assert PersistentMessage.objects.filter_user(user).get() == pm
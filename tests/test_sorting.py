@@ -0,0 +1,92 @@
+import gc
+import weakref
+
+import pytest
+from django.contrib import messages
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.base import Message
+from django.contrib.messages.storage.cookie import CookieStorage
+
+from persistent_messages.models import PersistentMessage
+from persistent_messages.shortcuts import get_all_messages, iter_all_messages
+from persistent_messages.sorting import merge_messages, parse_sort_spec, sort_messages
+
+
+def test_parse_sort_spec() -> None:
+    assert parse_sort_spec("") == [("level", False)]
+    assert parse_sort_spec("-level, message") == [("level", True), ("message", False)]
+
+
+class TestSortMessages:
+    def test_multiple_keys(self) -> None:
+        a = Message(level=20, message="a")
+        b = Message(level=20, message="b")
+        c = Message(level=30, message="c")
+        assert sort_messages([a, b, c], "-level,message") == [c, a, b]
+        assert sort_messages([a, b, c], "-level,-message") == [c, b, a]
+        assert sort_messages([b, c, a], "level,message") == [a, b, c]
+
+    def test_stable(self) -> None:
+        a = Message(level=20, message="a")
+        b = Message(level=20, message="b")
+        assert sort_messages([b, a], "level") == [b, a]
+
+
+class TestMergeMessages:
+    def test_merge(self) -> None:
+        flash = [Message(level=30, message="f1"), Message(level=10, message="f2")]
+        persistent = [
+            PersistentMessage(level=40, content="p1"),
+            PersistentMessage(level=20, content="p2"),
+        ]
+        merged = merge_messages(flash, persistent, sort_by="-level")
+        assert [m.message for m in merged] == ["p1", "f1", "p2", "f2"]
+
+    def test_merge__unsorted_source(self) -> None:
+        flash = [Message(level=30, message="f1")]
+        persistent = [
+            PersistentMessage(level=20, content="p1", priority=1),
+            PersistentMessage(level=40, content="p2"),
+        ]
+        merged = merge_messages(flash, persistent, sort_by="-level")
+        assert [m.message for m in merged] == ["p2", "f1", "p1"]
+
+    def test_merge__ties(self) -> None:
+        flash = [Message(level=20, message="f1")]
+        persistent = [PersistentMessage(level=20, content="p1")]
+        merged = merge_messages(flash, persistent, sort_by="level")
+        assert [m.message for m in merged] == ["f1", "p1"]
+
+    def test_merge__is_lazy(self) -> None:
+        merged = merge_messages([Message(level=20, message="f1")], sort_by="foo")
+        with pytest.raises(AttributeError):
+            next(merged)
+
+
+@pytest.mark.django_db
+class TestIterAllMessages:
+    def test_iter_all_messages(self, rf, user: User) -> None:
+        pm = PersistentMessage.objects.create(content="p1", level=30)
+        request = rf.get("/")
+        request.user = user
+        request._messages = CookieStorage(request)
+        messages.error(request, "f1")
+        messages.info(request, "f2")
+        assert [m.message for m in iter_all_messages(request)] == ["f1", "f2", "p1"]
+        assert [m.message for m in iter_all_messages(request, "-level")] == [
+            "f1",
+            "p1",
+            "f2",
+        ]
+        assert get_all_messages(request)[-1] == pm
+
+    def test_get_all_messages__not_cached(self, rf, user: User) -> None:
+        request = rf.get("/")
+        request.user = user
+        request._messages = CookieStorage(request)
+        get_all_messages(request)
+        # the request isn't held on to once it's done with
+        ref = weakref.ref(request)
+        del request
+        gc.collect()
+        assert ref() is None
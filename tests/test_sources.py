@@ -0,0 +1,149 @@
+import json
+from pathlib import Path
+
+import pytest
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from persistent_messages.models import PersistentMessage
+from persistent_messages.shortcuts import get_persistent_messages
+from persistent_messages.sources import (
+    StaticMessage,
+    count_messages,
+    get_first_message,
+    get_sources,
+    has_messages,
+)
+from persistent_messages.templatetags.persistent_message_tags import (
+    serialize_message,
+)
+
+STATIC_MESSAGES = [
+    {"key": "cookies", "content": "Cookies", "target": "ANONYMOUS_USERS"},
+    {"key": "legal", "content": "<b>Terms</b>", "level": "warning"},
+    {"key": "beta", "content": "Beta", "target": "AUTHENTICATED_USERS"},
+]
+
+
+@pytest.fixture
+def static_only(settings) -> None:
+    settings.PERSISTENT_MESSAGES_SOURCES = ["persistent_messages.sources.StaticSource"]
+    settings.PERSISTENT_MESSAGES_STATIC_MESSAGES = STATIC_MESSAGES
+
+
+class TestStaticMessage:
+    def test_from_dict(self) -> None:
+        message = StaticMessage.from_dict(
+            {"key": "x", "content": "<b>x</b>", "level": "error", "custom_tags": "a"}
+        )
+        assert message.level == 40
+        assert message.message == "<b>x</b>"
+        assert message.tags == "persistent undismissable unsafe a error"
+        assert message.dismiss_url() == ""
+        assert message.id is None
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            {"key": "x"},
+            {"key": "x", "content": "x", "foo": "bar"},
+            {"key": "x", "content": "x", "level": "loud"},
+            {"key": "x", "content": "x", "target": "USERS_OR_GROUPS"},
+        ],
+    )
+    def test_from_dict__invalid(self, data: dict) -> None:
+        with pytest.raises(ImproperlyConfigured):
+            StaticMessage.from_dict(data)
+
+    def test_immutable(self) -> None:
+        message = StaticMessage(key="x", content="x")
+        with pytest.raises(AttributeError):
+            message.content = "y"  # type: ignore[misc]
+
+    def test_serialize(self) -> None:
+        data = serialize_message(StaticMessage(key="x", content="x"))
+        assert data["pk"] is None
+        assert data["is_persistent"]
+        assert not data["is_dismissable"]
+
+
+@pytest.mark.django_db
+class TestSources:
+    def test_static__no_queries(self, static_only, rf) -> None:
+        request = rf.get("/")
+        request.user = AnonymousUser()
+        with CaptureQueriesContext(connection) as ctx:
+            messages = get_persistent_messages(request)
+        assert len(ctx) == 0
+        # warning before info
+        assert [m.key for m in messages] == ["legal", "cookies"]
+
+    def test_static__authenticated(self, static_only, rf, user: User) -> None:
+        request = rf.get("/")
+        request.user = user
+        assert [m.key for m in get_persistent_messages(request)] == ["legal", "beta"]
+
+    def test_static__max_displayed(self, static_only, settings, rf) -> None:
+        settings.PERSISTENT_MESSAGES_MAX_DISPLAYED = 1
+        request = rf.get("/")
+        request.user = AnonymousUser()
+        assert [m.key for m in get_persistent_messages(request)] == ["legal"]
+        assert count_messages(request) == 1
+
+    def test_static__parsed_once(self, static_only) -> None:
+        assert get_sources() is get_sources()
+
+    def test_static__duplicate_keys(self, settings) -> None:
+        settings.PERSISTENT_MESSAGES_SOURCES = [
+            "persistent_messages.sources.StaticSource"
+        ]
+        settings.PERSISTENT_MESSAGES_STATIC_MESSAGES = STATIC_MESSAGES * 2
+        with pytest.raises(ImproperlyConfigured):
+            get_sources()
+
+    @pytest.mark.parametrize("suffix", [".json", ".yaml"])
+    def test_static__file(self, settings, tmp_path: Path, suffix: str) -> None:
+        path = tmp_path / f"messages{suffix}"
+        # JSON is valid YAML
+        path.write_text(json.dumps(STATIC_MESSAGES))
+        settings.PERSISTENT_MESSAGES_SOURCES = [
+            "persistent_messages.sources.StaticSource"
+        ]
+        settings.PERSISTENT_MESSAGES_STATIC_MESSAGES_FILE = str(path)
+        (source,) = get_sources()
+        assert len(source.messages) == 3
+
+    def test_merged(self, settings, rf, user: User) -> None:
+        settings.PERSISTENT_MESSAGES_SOURCES = [
+            "persistent_messages.sources.DatabaseSource",
+            "persistent_messages.sources.StaticSource",
+        ]
+        settings.PERSISTENT_MESSAGES_STATIC_MESSAGES = STATIC_MESSAGES
+        settings.PERSISTENT_MESSAGES_MAX_DISPLAYED = 3
+        db_info = PersistentMessage.objects.create(content="DB info")
+        db_error = PersistentMessage.objects.create(content="DB error", level=40)
+        request = rf.get("/")
+        request.user = user
+        messages = get_persistent_messages(request)
+        assert [m.message for m in messages] == [
+            db_error.content,
+            "<b>Terms</b>",
+            db_info.content,
+        ]
+
+    def test_merged__count_and_first(self, settings, rf, user: User) -> None:
+        settings.PERSISTENT_MESSAGES_SOURCES = [
+            "persistent_messages.sources.DatabaseSource",
+            "persistent_messages.sources.StaticSource",
+        ]
+        settings.PERSISTENT_MESSAGES_STATIC_MESSAGES = STATIC_MESSAGES
+        PersistentMessage.objects.create(content="DB info")
+        request = rf.get("/")
+        request.user = user
+        assert has_messages(request)
+        assert count_messages(request) == 3
+        assert get_first_message(request).key == "legal"
+        settings.PERSISTENT_MESSAGES_MAX_DISPLAYED = 2
+        assert count_messages(request) == 2
@@ -0,0 +1,185 @@
+import datetime
+import json
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import Group, User
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from persistent_messages.cache import get_message_version
+from persistent_messages.models import PersistentMessage
+from persistent_messages.sync import MessageSpec, sync_messages
+
+MESSAGES = [
+    {"key": "maintenance", "content": "Down on Sunday", "level": "warning"},
+    {
+        "key": "staff",
+        "content": "Staff only",
+        "target": "USERS_OR_GROUPS",
+        "target_groups": ["staff"],
+        "target_users": ["alice", "bob"],
+        "dismissal_ttl": "7 00:00:00",
+    },
+]
+
+
+def write(path: Path, messages: list[dict]) -> Path:
+    path.write_text(json.dumps(messages))
+    return path
+
+
+@pytest.fixture
+def path(tmp_path: Path) -> Path:
+    return write(tmp_path / "messages.json", MESSAGES)
+
+
+@pytest.fixture
+def targets() -> None:
+    Group.objects.create(name="staff")
+    for username in ("alice", "bob", "carol"):
+        User.objects.create_user(username=username)
+
+
+class TestMessageSpec:
+    def test_from_dict(self) -> None:
+        spec = MessageSpec.from_dict(MESSAGES[1])
+        assert spec.values["target"] == "USERS_OR_GROUPS"
+        assert spec.values["dismissal_ttl"] == datetime.timedelta(days=7)
+        assert spec.values["level"] == 20
+        assert "display_from" not in spec.values
+        assert spec.target_users == {"alice", "bob"}
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            {"content": "x"},
+            {"key": "x"},
+            {"key": "x", "content": "x", "foo": "bar"},
+            {"key": "x", "content": "x", "level": "loud"},
+            {"key": "x", "content": "x", "target": "SOME_USERS"},
+            {"key": "x", "content": "x", "target_custom_group": "nope"},
+        ],
+    )
+    def test_from_dict__invalid(self, data: dict) -> None:
+        with pytest.raises(ValidationError):
+            MessageSpec.from_dict(data)
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("targets")
+class TestSyncMessages:
+    def test_create(self, path: Path, django_capture_on_commit_callbacks) -> None:
+        version = get_message_version()
+        with django_capture_on_commit_callbacks(execute=True):
+            plan = sync_messages(path)
+        assert plan.describe() == [
+            "+ maintenance",
+            "+ staff",
+            "~ staff: target_users +2 -0",
+            "~ staff: target_groups +1 -0",
+        ]
+        staff = PersistentMessage.objects.get(key="staff")
+        assert {u.username for u in staff.target_users.all()} == {"alice", "bob"}
+        assert staff.target_groups.get().name == "staff"
+        assert PersistentMessage.objects.get(key="maintenance").level == 30
+        assert get_message_version() != version
+
+    def test_create__no_returning(self, path: Path) -> None:
+        features = type(connection.features)
+        with mock.patch.object(features, "can_return_rows_from_bulk_insert", False):
+            sync_messages(path)
+        staff = PersistentMessage.objects.get(key="staff")
+        assert {u.username for u in staff.target_users.all()} == {"alice", "bob"}
+        assert staff.target_groups.get().name == "staff"
+
+    def test_idempotent(self, path: Path) -> None:
+        sync_messages(path)
+        version = get_message_version()
+        with CaptureQueriesContext(connection) as ctx:
+            plan = sync_messages(path)
+        assert not plan
+        # users, groups, messages and each through table - no writes
+        assert len(ctx) == 5
+        assert get_message_version() == version
+
+    def test_update(self, tmp_path: Path, path: Path) -> None:
+        sync_messages(path)
+        staff = PersistentMessage.objects.get(key="staff")
+        display_from = staff.display_from
+        changed = [
+            {**MESSAGES[0], "priority": 5},
+            {**MESSAGES[1], "target_users": ["bob", "carol"], "target_groups": []},
+        ]
+        plan = sync_messages(write(tmp_path / "changed.json", changed))
+        assert plan.describe() == [
+            "~ maintenance: priority",
+            "~ staff: target_users +1 -1",
+            "~ staff: target_groups +0 -1",
+        ]
+        assert PersistentMessage.objects.get(key="maintenance").priority == 5
+        staff.refresh_from_db()
+        assert {u.username for u in staff.target_users.all()} == {"bob", "carol"}
+        assert not staff.target_groups.exists()
+        assert staff.display_from == display_from
+
+    def test_unset_field_reverts_to_default(self, tmp_path: Path, path: Path) -> None:
+        sync_messages(path)
+        plan = sync_messages(write(tmp_path / "changed.json", [MESSAGES[0]]))
+        assert plan.describe() == []
+        plan = sync_messages(
+            write(tmp_path / "changed.json", [{"key": "maintenance", "content": "x"}])
+        )
+        assert plan.describe() == ["~ maintenance: content, level"]
+
+    def test_prune(self, tmp_path: Path, path: Path) -> None:
+        sync_messages(path)
+        unkeyed = PersistentMessage.objects.create(content="admin")
+        plan = sync_messages(write(tmp_path / "changed.json", [MESSAGES[0]]))
+        assert not plan.delete
+        plan = sync_messages(tmp_path / "changed.json", prune=True)
+        assert plan.describe() == ["- staff"]
+        assert set(PersistentMessage.objects.values_list("key", flat=True)) == {
+            "maintenance",
+            unkeyed.key,
+        }
+
+    def test_dry_run(self, path: Path) -> None:
+        plan = sync_messages(path, dry_run=True)
+        assert len(plan.create) == 2
+        assert not PersistentMessage.objects.exists()
+
+    def test_unknown_user(self, tmp_path: Path) -> None:
+        messages = [{**MESSAGES[1], "target_users": ["dave"]}]
+        with pytest.raises(ValidationError):
+            sync_messages(write(tmp_path / "messages.json", messages))
+
+    def test_duplicate_keys(self, tmp_path: Path) -> None:
+        with pytest.raises(ValidationError):
+            sync_messages(write(tmp_path / "messages.json", [MESSAGES[0]] * 2))
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("targets")
+class TestSyncCommand:
+    def test_dry_run(self, path: Path) -> None:
+        out = StringIO()
+        call_command("sync_persistent_messages", str(path), dry_run=True, stdout=out)
+        assert "+ maintenance" in out.getvalue()
+        assert "Dry run" in out.getvalue()
+        assert not PersistentMessage.objects.exists()
+
+    def test_no_changes(self, path: Path) -> None:
+        call_command("sync_persistent_messages", str(path))
+        out = StringIO()
+        call_command("sync_persistent_messages", str(path), stdout=out)
+        assert out.getvalue() == "No changes\n"
+
+    def test_invalid(self, tmp_path: Path) -> None:
+        path = write(tmp_path / "messages.json", [{"key": "x"}])
+        with pytest.raises(CommandError):
+            call_command("sync_persistent_messages", str(path))
@@ -1,7 +1,21 @@
+import pytest
+from django.contrib import messages
+from django.contrib.auth.models import User
 from django.contrib.messages.storage.base import Message
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.db import connection
+from django.template import Context, Template
+from django.test.utils import CaptureQueriesContext
+from django.utils.html import json_script
 
 from persistent_messages.models import PersistentMessage
-from persistent_messages.templatetags.persistent_message_tags import sort_messages
+from persistent_messages.shortcuts import get_all_messages
+from persistent_messages.templatetags.persistent_message_tags import (
+    serialize_messages,
+    sort_messages,
+)
+
+FLASH = ("Hello <b>world</b>", "Foo & bar")
 
 
 class TestSortMessages:
@@ -13,3 +27,106 @@ class TestSortMessages:
         assert sort_messages([pm, msg, obj], "-level") == [obj, msg, pm]
         assert sort_messages([pm, msg, obj], "message") == [pm, obj, msg]
         assert sort_messages([pm, msg, obj], "-message") == [msg, obj, pm]
+
+
+@pytest.mark.django_db
+class TestPersistentMessagesTag:
+    def render(self, rf, user, source: str = "{% persistent_messages %}") -> str:
+        request = rf.get("/")
+        request.user = user
+        template = Template("{% load persistent_message_tags %}" + source)
+        return template.render(Context({"request": request}))
+
+    def test_render(self, rf, user: User, pm: PersistentMessage) -> None:
+        html = self.render(rf, user)
+        assert pm.content in html
+        assert pm.dismiss_url() in html
+        assert 'class="message persistent' in html
+
+    def test_render__no_messages(self, rf, user: User) -> None:
+        assert self.render(rf, user).strip() == ""
+
+    def test_render__template_name(self, rf, user: User, pm: PersistentMessage) -> None:
+        html = self.render(rf, user, '{% persistent_messages "custom_messages.html" %}')
+        assert html == f"<p>{pm.content}</p>\n"
+
+    def test_render__no_request(self) -> None:
+        template = Template(
+            "{% load persistent_message_tags %}{% persistent_messages %}"
+        )
+        assert template.render(Context()) == ""
+
+    def test_cached(self, rf, user: User, pm: PersistentMessage) -> None:
+        html = self.render(rf, user)
+        with CaptureQueriesContext(connection) as ctx:
+            assert self.render(rf, user) == html
+        assert len(ctx) == 0
+
+    def test_cache_disabled(
+        self, settings, rf, user: User, pm: PersistentMessage
+    ) -> None:
+        settings.PERSISTENT_MESSAGES_FRAGMENT_CACHE_TIMEOUT = 0
+        self.render(rf, user)
+        with CaptureQueriesContext(connection) as ctx:
+            self.render(rf, user)
+        assert len(ctx) > 0
+
+    def test_invalidated__dismiss(self, rf, user: User, pm: PersistentMessage) -> None:
+        assert pm.content in self.render(rf, user)
+        pm.dismiss(user)
+        assert pm.content not in self.render(rf, user)
+
+    def test_invalidated__save(self, rf, user: User, pm: PersistentMessage) -> None:
+        assert pm.content in self.render(rf, user)
+        pm.content = "Updated content"
+        pm.save()
+        assert "Updated content" in self.render(rf, user)
+
+    def test_invalidated__targeting(
+        self, rf, user: User, pm: PersistentMessage
+    ) -> None:
+        pm.target = PersistentMessage.TargetType.USERS_OR_GROUPS
+        pm.save()
+        assert pm.content not in self.render(rf, user)
+        pm.target_users.add(user)
+        assert pm.content in self.render(rf, user)
+
+
+@pytest.mark.django_db
+class TestPersistentMessagesJsonTag:
+    def get_request(self, rf, user, *flash: str):
+        request = rf.get("/")
+        request.user = user
+        request._messages = CookieStorage(request)
+        for message in flash:
+            messages.info(request, message)
+        return request
+
+    def render(self, request, source: str = "{% persistent_messages_json %}") -> str:
+        template = Template("{% load persistent_message_tags %}" + source)
+        return template.render(Context({"request": request}))
+
+    def expected(self, request, element_id: str = "persistent-messages") -> str:
+        return json_script(serialize_messages(get_all_messages(request)), element_id)
+
+    def test_render(self, rf, user: User, pm: PersistentMessage) -> None:
+        html = self.render(self.get_request(rf, user, *FLASH))
+        assert html == self.expected(self.get_request(rf, user, *FLASH))
+
+    @pytest.mark.parametrize("flash", [(), ("Hello",)])
+    def test_render__no_persistent_messages(self, rf, user: User, flash) -> None:
+        html = self.render(self.get_request(rf, user, *flash))
+        assert html == self.expected(self.get_request(rf, user, *flash))
+
+    def test_render__element_id(self, rf, user: User, pm: PersistentMessage) -> None:
+        html = self.render(
+            self.get_request(rf, user), '{% persistent_messages_json "foo" %}'
+        )
+        assert html == self.expected(self.get_request(rf, user), "foo")
+
+    def test_cached(self, rf, user: User, pm: PersistentMessage) -> None:
+        self.render(self.get_request(rf, user))
+        with CaptureQueriesContext(connection) as ctx:
+            html = self.render(self.get_request(rf, user, *FLASH))
+        assert len(ctx) == 0
+        assert html == self.expected(self.get_request(rf, user, *FLASH))
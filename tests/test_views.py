@@ -0,0 +1,34 @@
+import pytest
+from django.contrib.auth.models import User
+from django.test import Client
+from django.urls import reverse
+
+from persistent_messages.models import PersistentMessage
+
+
+@pytest.mark.django_db
+class TestMessageHistory:
+    url = reverse("persistent_messages:message_history")
+
+    def test_anonymous(self, client: Client) -> None:
+        assert client.get(self.url).status_code == 302
+
+    def test_history(self, client: Client, user: User) -> None:
+        messages = [PersistentMessage.objects.create(content=f"{i}") for i in range(3)]
+        messages[0].dismiss(user)
+        client.force_login(user)
+        response = client.get(self.url, {"limit": 2})
+        assert response.status_code == 200
+        data = response.json()
+        assert [m["pk"] for m in data["messages"]] == [messages[2].pk, messages[1].pk]
+        assert not data["messages"][0]["is_dismissed"]
+        response = client.get(self.url, {"limit": 2, "cursor": data["next_cursor"]})
+        data = response.json()
+        assert [m["pk"] for m in data["messages"]] == [messages[0].pk]
+        assert data["messages"][0]["is_dismissed"]
+        assert data["next_cursor"] is None
+
+    @pytest.mark.parametrize("params", [{"limit": 0}, {"limit": "x"}, {"cursor": "x"}])
+    def test_invalid(self, client: Client, user: User, params: dict) -> None:
+        client.force_login(user)
+        assert client.get(self.url, params).status_code == 400
@@ -0,0 +1,69 @@
+from unittest import mock
+
+import pytest
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.template import Context, Template
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from persistent_messages.audience import audiences
+from persistent_messages.models import PersistentMessage
+from persistent_messages.warmup import warm_up
+
+
+@pytest.mark.django_db
+class TestWarmUp:
+    def test_warm_up(self, rf: RequestFactory) -> None:
+        pm = PersistentMessage.objects.create(
+            content="Cookies", target=PersistentMessage.TargetType.ALL_USERS
+        )
+        assert warm_up()
+        request = rf.get("/")
+        request.user = AnonymousUser()
+        template = Template(
+            "{% load persistent_message_tags %}{% persistent_messages %}"
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            html = template.render(Context({"request": request}))
+        assert len(ctx) == 0
+        assert pm.content in html
+
+    def test_compiled_audiences(self, settings, user) -> None:
+        settings.PERSISTENT_MESSAGES_COMPILED_AUDIENCES = True
+        pm = PersistentMessage.objects.create(
+            content="Hi", target=PersistentMessage.TargetType.USERS_OR_GROUPS
+        )
+        pm.target_users.add(user)
+        assert warm_up()
+        assert audiences.audiences[pm.pk].has_user(user.pk)
+        with CaptureQueriesContext(connection) as ctx:
+            assert list(PersistentMessage.objects.filter_user(user)) == [pm]
+        # no through table queries to compile the audience
+        assert not any("target_users" in q["sql"] for q in ctx.captured_queries)
+
+    def test_database_not_ready(self) -> None:
+        with mock.patch(
+            "persistent_messages.warmup.get_active_signature",
+            side_effect=OperationalError("no such table"),
+        ):
+            assert not warm_up()
+
+    def test_command(self) -> None:
+        call_command("warm_persistent_messages")
+        with mock.patch(
+            "persistent_messages.management.commands.warm_persistent_messages.warm_up",
+            return_value=False,
+        ):
+            with pytest.raises(CommandError):
+                call_command("warm_persistent_messages")
+
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_ready(settings, enabled: bool) -> None:
+    settings.PERSISTENT_MESSAGES_WARM_UP_ON_STARTUP = enabled
+    with mock.patch("persistent_messages.warmup.warm_up") as mock_warm_up:
+        apps.get_app_config("persistent_messages").ready()
+    assert mock_warm_up.called == enabled